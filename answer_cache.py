@@ -0,0 +1,289 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+import numpy as np
+
+from context_budget import CONTEXT_TOKEN_BUDGET
+
+# 答案快取設定，可透過環境變數調整
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+# 快取目錄：entries.sqlite 存問題與答案，embeddings.npy 存問題向量（每筆一列，依 slot 定位）
+ANSWER_CACHE_DIR = os.getenv("ANSWER_CACHE_DIR", "./cache/answer")
+# 語意相似快取的 cosine 門檻，越接近 1 越保守
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95"))
+# 快取筆數上限，超過時淘汰最久未使用的項目
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "2000"))
+
+ENTRIES_FILE = "entries.sqlite"
+EMBEDDINGS_FILE = "embeddings.npy"
+
+
+def normalize_question(question):
+    """統一全半形、大小寫與空白，並移除結尾標點，讓等價問題對應到同一個 key"""
+    text = unicodedata.normalize("NFKC", question).lower().strip()
+    text = re.sub(r"\s+", " ", text)
+    return text.rstrip(" ?？。.!！")
+
+
+def make_scope(dataset_type=None, ignore_image_processing=False, context_budget=CONTEXT_TOKEN_BUDGET, document_scope=None, retrieval_mode="flat"):
+    """不同的回答格式、是否使用圖片、上下文 token 預算、限定的文件範圍或檢索模式，答案都不能共用"""
+    scope = f"{dataset_type or 'default'}|{'text' if ignore_image_processing else 'image'}|ctx{context_budget}"
+    if retrieval_mode != "flat":
+        scope += f"|{retrieval_mode}"
+    if document_scope:
+        scope += f"|doc{json.dumps(document_scope, sort_keys=True, ensure_ascii=False)}"
+    return scope
+
+
+class AnswerCache:
+    """
+    兩層答案快取：
+      1. 正規化後問題的完全比對（O(1) dict 查詢）
+      2. 問題向量的 cosine 相似度比對（超過門檻即視為同一問題）
+    每筆快取記錄貢獻答案的來源檔名，檔案被重新匯入或刪除時一併失效。
+
+    問題與答案存於 SQLite，每次寫入只新增 / 更新一列；問題向量存於固定容量的 .npy（memmap），
+    每筆佔一個 slot，寫入時只更新該列，查詢直接以整個矩陣做一次矩陣乘法，不必從 JSON 重建。
+    SQLite 的 data_version 在其他 process（例如獨立的 ingest）寫入後會改變，此時才重新讀取項目，
+    ingestion 與查詢在不同 process 時也能同步失效。
+    """
+
+    def __init__(self, cache_dir=ANSWER_CACHE_DIR, similarity_threshold=ANSWER_CACHE_SIMILARITY,
+                 max_entries=ANSWER_CACHE_MAX_ENTRIES, embed_fn=None):
+        self.cache_dir = cache_dir
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+        self._embed_fn = embed_fn
+        self._conn = None
+        self._data_version = None
+        # key -> 項目（不含向量），scope -> 該 scope 的 slot 陣列（延遲建立）
+        self._entries = {}
+        self._slot_keys = {}
+        self._scope_slots = {}
+        self._matrix = None
+        self._lock = threading.Lock()
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    def _get_embed_fn(self):
+        if self._embed_fn is None:
+            from vector_db import get_embedding_function
+            self._embed_fn = get_embedding_function()
+        return self._embed_fn
+
+    def _embed(self, text):
+        vector = np.asarray(self._get_embed_fn()([text])[0], dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    @property
+    def _embeddings_path(self):
+        return os.path.join(self.cache_dir, EMBEDDINGS_FILE)
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # isolation_level=None：交易由 BEGIN IMMEDIATE 明確控制；查詢在多個執行緒執行，由 self._lock 保護
+            self._conn = sqlite3.connect(os.path.join(self.cache_dir, ENTRIES_FILE), timeout=30,
+                                         isolation_level=None, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, slot INTEGER NOT NULL, question TEXT, scope TEXT, answer TEXT, "
+                "files TEXT, created_at REAL, last_used REAL)"
+            )
+        return self._conn
+
+    def _open_matrix(self, dim=None):
+        """開啟向量檔；dim 與現有檔案不同（嵌入模型或 EMBEDDING_DIM 改變）時回傳 False"""
+        path = self._embeddings_path
+        if os.path.exists(path):
+            matrix = np.lib.format.open_memmap(path, mode="r+")
+            if dim is not None and matrix.shape[1] != dim:
+                return False
+            if matrix.shape[0] < self.max_entries:
+                # 上限調大：擴充容量，既有的 slot 位置不變
+                grown = np.zeros((self.max_entries, matrix.shape[1]), dtype=np.float32)
+                grown[:matrix.shape[0]] = matrix
+                del matrix
+                np.save(path, grown)
+                matrix = np.lib.format.open_memmap(path, mode="r+")
+            self._matrix = matrix
+        elif dim is not None:
+            self._matrix = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=(self.max_entries, dim))
+        else:
+            self._matrix = None
+        return True
+
+    def _load(self):
+        """其他 process 寫入過（data_version 改變）時重新讀取項目；向量檔為共用 memmap，不需重新讀取"""
+        conn = self._connect()
+        version = conn.execute("PRAGMA data_version").fetchone()[0]
+        if version == self._data_version:
+            return
+        self._reload(conn)
+        self._data_version = version
+
+    def _reload(self, conn):
+        rows = conn.execute("SELECT key, slot, question, scope, answer, files, created_at, last_used FROM entries").fetchall()
+        self._entries = {
+            key: {"slot": slot, "question": question, "scope": scope, "answer": answer,
+                  "files": json.loads(files), "created_at": created_at, "last_used": last_used}
+            for key, slot, question, scope, answer, files, created_at, last_used in rows
+        }
+        self._slot_keys = {e["slot"]: key for key, e in self._entries.items()}
+        self._scope_slots = {}
+        # 向量檔可能被其他 process 重建（維度改變或容量擴充），重新開啟 memmap
+        self._open_matrix()
+
+    def _slots_for(self, scope):
+        slots = self._scope_slots.get(scope)
+        if slots is None:
+            slots = np.fromiter((e["slot"] for e in self._entries.values() if e["scope"] == scope), dtype=np.int64)
+            self._scope_slots[scope] = slots
+        return slots
+
+    def _touch(self, key, entry):
+        entry["last_used"] = time.time()
+        self._connect().execute("UPDATE entries SET last_used = ? WHERE key = ?", (entry["last_used"], key))
+
+    @staticmethod
+    def _key(normalized, scope):
+        return hashlib.sha256(f"{scope}\n{normalized}".encode("utf-8")).hexdigest()
+
+    def lookup(self, question, scope):
+        """回傳快取中的答案，找不到時回傳 None"""
+        normalized = normalize_question(question)
+        key = self._key(normalized, scope)
+        with self._lock:
+            self._load()
+            entry = self._entries.get(key)
+            if entry:
+                self._touch(key, entry)
+                self.exact_hits += 1
+                print(f"[INFO] 答案快取命中（完全比對）：{question}")
+                return entry["answer"]
+            if not len(self._slots_for(scope)) or self._matrix is None:
+                self.misses += 1
+                return None
+
+        query_vector = self._embed(normalized)
+        with self._lock:
+            self._load()
+            slots = self._slots_for(scope)
+            if len(slots) and self._matrix is not None and self._matrix.shape[1] == len(query_vector):
+                scores = (self._matrix @ query_vector)[slots]
+                best = int(np.argmax(scores))
+                if scores[best] >= self.similarity_threshold:
+                    slot = int(slots[best])
+                    key = self._slot_keys[slot]
+                    entry = self._entries[key]
+                    self._touch(key, entry)
+                    self.semantic_hits += 1
+                    print(f"[INFO] 答案快取命中（語意相似 {scores[best]:.4f}）：{question} -> {entry['question']}")
+                    return entry["answer"]
+            self.misses += 1
+        return None
+
+    def store(self, question, scope, answer, source_files):
+        """寫入一筆答案，source_files 為貢獻上下文的檔名（metadata 中的 file_name）"""
+        if not answer:
+            return
+        normalized = normalize_question(question)
+        key = self._key(normalized, scope)
+        embedding = self._embed(normalized)
+        now = time.time()
+        files = sorted(set(f for f in source_files if f))
+        with self._lock:
+            conn = self._connect()
+            # BEGIN IMMEDIATE 取得寫入鎖，多個 process 同時寫入時 slot 分配不會衝突
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._load()
+                if (self._matrix is None or self._matrix.shape[1] != len(embedding)) and not self._open_matrix(len(embedding)):
+                    print("[INFO] 問題向量維度改變，清空答案快取")
+                    conn.execute("DELETE FROM entries")
+                    self._entries, self._slot_keys, self._scope_slots = {}, {}, {}
+                    del self._matrix
+                    os.remove(self._embeddings_path)
+                    self._open_matrix(len(embedding))
+
+                entry = self._entries.get(key)
+                if entry is not None:
+                    slot = entry["slot"]
+                else:
+                    free = (s for s in range(self._matrix.shape[0]) if s not in self._slot_keys)
+                    slot = next(free, None) if len(self._entries) < self.max_entries else None
+                    if slot is None:
+                        # 已滿：淘汰最久未使用的項目並重用它的 slot
+                        evicted_key = min(self._entries, key=lambda k: self._entries[k]["last_used"])
+                        evicted = self._entries.pop(evicted_key)
+                        slot = evicted["slot"]
+                        del self._slot_keys[slot]
+                        self._scope_slots.pop(evicted["scope"], None)
+                        conn.execute("DELETE FROM entries WHERE key = ?", (evicted_key,))
+
+                self._matrix[slot] = embedding
+                self._matrix.flush()
+                conn.execute(
+                    "INSERT OR REPLACE INTO entries (key, slot, question, scope, answer, files, created_at, last_used) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (key, slot, question, scope, answer, json.dumps(files, ensure_ascii=False), now, now),
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                self._data_version = None
+                raise
+            self._entries[key] = {"slot": slot, "question": question, "scope": scope, "answer": answer,
+                                  "files": files, "created_at": now, "last_used": now}
+            self._slot_keys[slot] = key
+            self._scope_slots.pop(scope, None)
+            self._data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def invalidate_files(self, file_names):
+        """刪除所有引用到指定檔名的快取，回傳刪除筆數"""
+        file_names = set(file_names)
+        if not file_names:
+            return 0
+        with self._lock:
+            self._load()
+            stale_keys = [k for k, e in self._entries.items() if file_names.intersection(e["files"])]
+            if stale_keys:
+                conn = self._connect()
+                conn.execute("BEGIN IMMEDIATE")
+                conn.executemany("DELETE FROM entries WHERE key = ?", [(k,) for k in stale_keys])
+                conn.execute("COMMIT")
+                for key in stale_keys:
+                    del self._slot_keys[self._entries.pop(key)["slot"]]
+                # 釋出的 slot 不需清空向量，下次寫入時直接覆蓋
+                self._scope_slots = {}
+        if stale_keys:
+            print(f"[INFO] 答案快取失效 {len(stale_keys)} 筆（來源: {sorted(file_names)}）")
+        return len(stale_keys)
+
+    def clear(self):
+        with self._lock:
+            self._connect().execute("DELETE FROM entries")
+            self._entries, self._slot_keys, self._scope_slots = {}, {}, {}
+            self._data_version = None
+
+    def report(self):
+        total = self.exact_hits + self.semantic_hits + self.misses
+        if not total:
+            return
+        hit_rate = (self.exact_hits + self.semantic_hits) / total
+        print(
+            f"[INFO] 答案快取：完全比對命中 {self.exact_hits}，語意命中 {self.semantic_hits}，"
+            f"未命中 {self.misses}，命中率 {hit_rate:.1%}"
+        )
+
+
+# 全域快取，rag_query_pipeline 與 process_pdf_changes 共用
+answer_cache = AnswerCache()
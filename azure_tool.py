@@ -15,6 +15,7 @@ from ragas.metrics import (
     context_recall,
 )
 from ragas import evaluate
+from ragas.run_config import RunConfig
 
 
 # 設定 Azure OpenAI 環境變數
@@ -24,6 +25,11 @@ deployment = os.getenv("DEPLOYMENT_NAME", "gpt-4o")
 api_version = "2024-02-15-preview"
 embedding_deployment="text-embedding-ada-002"
 embedding_api_version="2023-05-15"
+OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
+# RAGAS 評測使用的指標、評審模型與 Embedding 模型（評分快取的 key 會包含這些設定）
+RAGAS_METRICS = [context_precision, context_recall, faithfulness, answer_relevancy]
+RAGAS_JUDGE_MODEL = f"{deployment}@{api_version}"
+RAGAS_EMBEDDING_MODEL = "mxbai-embed-large"
 
 def local_image_to_data_url(image_path):
     """
@@ -40,12 +46,27 @@ def local_image_to_data_url(image_path):
 
 
 
-def generate_with_openai(text_prompt, image_path=None, system_prompt=None):
+def image_bytes_to_data_url(image_bytes, mime_type="image/png"):
     """
-    使用 Azure OpenAI 生成回答。
-    可選地接受 system_prompt 作為系統訊息，如果為 None 則不包含。
-    如果提供 image_path，會將本地圖片轉成 base64 data URL 並附加至 user 訊息中。
+    將記憶體中的圖片 bytes 轉換為 base64 編碼的 data URL
     """
+    base64_encoded_data = base64.b64encode(image_bytes).decode("utf-8")
+    return f"data:{mime_type};base64,{base64_encoded_data}"
+
+
+def build_image_content(data_url, detail=None):
+    """組成 chat completion 的 image_url 內容，有指定 detail 時一併帶入"""
+    image_url = {"url": data_url}
+    if detail:
+        image_url["detail"] = detail
+    return {"type": "image_url", "image_url": image_url}
+
+
+def build_chat_messages(text_prompt, image_path=None, system_prompt=None, image_bytes=None, mime_type="image/png", detail=None):
+    """組成 chat completion 的 messages（system + user 文字，可附加一張圖片）"""
+    if image_path and image_bytes:
+        raise ValueError("請只傳入 image_path 或 image_bytes 其中之一，不能同時傳入")
+
     messages = []
 
     # 如果有系統提示，先加入 system message
@@ -64,21 +85,41 @@ def generate_with_openai(text_prompt, image_path=None, system_prompt=None):
     # 如果有圖片，轉檔並加入同一 user 訊息
     if image_path:
         data_url = local_image_to_data_url(image_path)
-        messages[-1]["content"].append({
-            "type": "image_url",
-            "image_url": {"url": data_url}
-        })
+        messages[-1]["content"].append(build_image_content(data_url, detail))
+    elif image_bytes:
+        data_url = image_bytes_to_data_url(image_bytes, mime_type)
+        messages[-1]["content"].append(build_image_content(data_url, detail))
+    return messages
 
-    # 初始化 Azure OpenAI 客戶端
-    client = AzureOpenAI(
-        api_key=api_key,
-        api_version=api_version,
-        base_url=f"{endpoint}openai/deployments/{deployment}",
-    )
+
+_openai_client = None
+
+
+def get_openai_client():
+    """Azure OpenAI 客戶端只建立一次，重複使用連線池"""
+    global _openai_client
+    if _openai_client is None:
+        _openai_client = AzureOpenAI(
+            api_key=api_key,
+            api_version=api_version,
+            base_url=f"{endpoint}openai/deployments/{deployment}",
+        )
+    return _openai_client
+
+
+def generate_with_openai(text_prompt, image_path=None, system_prompt=None, image_bytes=None, mime_type="image/png", detail=None):
+    """
+    使用 Azure OpenAI 生成回答。
+    可選地接受 system_prompt 作為系統訊息，如果為 None 則不包含。
+    如果提供 image_path，會將本地圖片轉成 base64 data URL 並附加至 user 訊息中；
+    也可直接傳入 image_bytes（搭配 mime_type），省去寫入暫存檔。
+    detail 對應 GPT-4o 的 low / high / auto。
+    """
+    messages = build_chat_messages(text_prompt, image_path, system_prompt, image_bytes, mime_type, detail)
 
     # 呼叫 chat completion 並加上錯誤處理
     try:
-        completion = client.chat.completions.create(
+        completion = get_openai_client().chat.completions.create(
             model=deployment,
             messages=messages,
             max_tokens=800,
@@ -97,7 +138,34 @@ def generate_with_openai(text_prompt, image_path=None, system_prompt=None):
         return ""
 
 
-def generate_with_langchain(text_prompt, image_path=None, image_bytes=None):
+def stream_with_openai(text_prompt, image_path=None, system_prompt=None, image_bytes=None, mime_type="image/png", detail=None):
+    """
+    與 generate_with_openai 相同，但以串流方式逐段 yield 回答文字。
+    發生錯誤時結束串流，不拋出例外。
+    """
+    messages = build_chat_messages(text_prompt, image_path, system_prompt, image_bytes, mime_type, detail)
+
+    try:
+        stream = get_openai_client().chat.completions.create(
+            model=deployment,
+            messages=messages,
+            max_tokens=800,
+            temperature=0.7,
+            top_p=0.95,
+            frequency_penalty=0,
+            presence_penalty=0,
+            stop=None,
+            stream=True
+        )
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    except Exception as e:
+        print("[ERROR] OpenAI 串流生成錯誤：", e)
+
+
+def generate_with_langchain(text_prompt, image_path=None, image_bytes=None, mime_type="image/png", detail=None):
     if image_path and image_bytes:
         raise ValueError("請只傳入 image_path 或 image_bytes 其中之一，不能同時傳入")
 
@@ -111,18 +179,12 @@ def generate_with_langchain(text_prompt, image_path=None, image_bytes=None):
                 mime_type, _ = guess_type(image_path)
             else:
                 img_bytes = image_bytes
-                mime_type = "image/png"  # 預設為 PNG，可根據需要調整
 
             if mime_type is None:
                 mime_type = "application/octet-stream"
 
-            base64_data = base64.b64encode(img_bytes).decode("utf-8")
-            data_url = f"data:{mime_type};base64,{base64_data}"
-
-            messages[0]["content"].append({
-                "type": "image_url",
-                "image_url": {"url": data_url}
-            })
+            data_url = image_bytes_to_data_url(img_bytes, mime_type)
+            messages[0]["content"].append(build_image_content(data_url, detail))
 
         # 初始化 Azure OpenAI 客戶端
         azure_model = AzureChatOpenAI(
@@ -155,7 +217,8 @@ def embedding_with_langchain(text_embedding):
     return query_result
 
 
-def evaluating_RAG_with_ragas(test_questions, answers, contexts, ground_truth):
+def evaluating_RAG_with_ragas(test_questions, answers, contexts, ground_truth, metrics=None, max_workers=None):
+    """metrics 未指定時評測全部 RAGAS_METRICS；max_workers 限制同時送往評審模型的請求數"""
     # 轉換 ground_truths 的格式，使 reference 為單一字串
     dataset = Dataset.from_dict({
         "question": test_questions,
@@ -175,17 +238,18 @@ def evaluating_RAG_with_ragas(test_questions, answers, contexts, ground_truth):
 
     # ✅ **使用與 ChromaDB 相同的 `OllamaEmbeddings`**
     embedding_model = OllamaEmbeddings(
-        model="mxbai-embed-large",  # 確保與 ChromaDB 相同
-        base_url="http://localhost:11434"
+        model=RAGAS_EMBEDDING_MODEL,  # 確保與 ChromaDB 相同
+        base_url=OLLAMA_BASE_URL
     )
 
     # ✅ **評估時改用 `OllamaEmbeddings`，而不是 Azure OpenAI**
-    result = evaluate(dataset=dataset, metrics=[
-        context_precision,
-        context_recall,
-        faithfulness,
-        answer_relevancy,
-    ], llm=azure_model, embeddings=embedding_model)
+    result = evaluate(
+        dataset=dataset,
+        metrics=metrics or RAGAS_METRICS,
+        llm=azure_model,
+        embeddings=embedding_model,
+        run_config=RunConfig(max_workers=max_workers) if max_workers else None,
+    )
 
     return result
 
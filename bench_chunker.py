@@ -0,0 +1,59 @@
+import glob
+import time
+import argparse
+import fitz  # PyMuPDF
+
+import layout_chunker
+import pdf_text_chunker
+
+# 比較舊版（"dict" 擷取 + 逐區塊 RecursiveCharacterTextSplitter）與 layout_chunker 的分塊吞吐量
+
+
+def legacy_chunks(pdf_path):
+    text_blocks = pdf_text_chunker.extract_text_blocks(pdf_path)
+    return pdf_text_chunker.split_text_blocks(text_blocks, chunk_size=512)
+
+
+def layout_chunks(pdf_path):
+    return layout_chunker.chunk_pdf(pdf_path)
+
+
+def run(name, chunk_fn, pdf_paths, pages, repeat):
+    best, chunks = None, []
+    for _ in range(repeat):
+        start = time.monotonic()
+        chunks = [chunk for path in pdf_paths for chunk in chunk_fn(path)]
+        elapsed = time.monotonic() - start
+        best = elapsed if best is None else min(best, elapsed)
+    chars = sum(len(chunk["text"]) for chunk in chunks)
+    return {"name": name, "seconds": best, "pages_per_sec": pages / best, "chunks": len(chunks), "chars": chars}
+
+
+def main(pattern, repeat):
+    pdf_paths = sorted(glob.glob(pattern))
+    if not pdf_paths:
+        raise FileNotFoundError(f"找不到 PDF：{pattern}")
+    pages = 0
+    for path in pdf_paths:
+        with fitz.open(path) as doc:
+            pages += len(doc)
+    # 先載入 tokenizer，避免第一次下載 / 初始化的時間算進結果
+    layout_chunker.get_encoder()
+    print(f"[INFO] {len(pdf_paths)} 個 PDF，共 {pages} 頁，每種方法取 {repeat} 次中最快一次")
+
+    rows = [
+        run("legacy (dict + splitter)", legacy_chunks, pdf_paths, pages, repeat),
+        run("layout_chunker", layout_chunks, pdf_paths, pages, repeat),
+    ]
+    print(f"{'method':<26}{'seconds':>10}{'pages/s':>10}{'chunks':>9}{'chars':>11}")
+    for row in rows:
+        print(f"{row['name']:<26}{row['seconds']:>10.2f}{row['pages_per_sec']:>10.1f}{row['chunks']:>9}{row['chars']:>11}")
+    print(f"[INFO] 加速 {rows[0]['seconds'] / rows[1]['seconds']:.2f}x（chars 含 chunk 間的重疊文字）")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="PDF 分塊吞吐量比較（pages/sec）")
+    parser.add_argument("--pdfs", default="RAG_raw_data/*.pdf", help="PDF 檔案 glob")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    main(args.pdfs, args.repeat)
@@ -0,0 +1,117 @@
+import os
+import glob
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import fitz  # PyMuPDF
+import psutil
+
+import clip_onnx
+
+# 比較 CLIP 評分的三種執行方式：目前的 PyTorch 路徑、process 內 int8 ONNX、共用推論 worker
+# 每種方式在獨立 process 中執行，RSS 才不會互相干擾
+
+
+def rss_mb(pid=None):
+    return psutil.Process(pid).memory_info().rss / 1024 / 1024
+
+
+def load_samples(pattern, limit, texts_per_image):
+    """把 PDF 頁面渲染成 PNG 當作圖片，配上同頁的文字區塊當作候選文字"""
+    samples = []
+    for path in sorted(glob.glob(pattern)):
+        with fitz.open(path) as doc:
+            for page in doc:
+                texts = [block[4].strip() for block in page.get_text("blocks") if block[6] == 0 and block[4].strip()]
+                if not texts:
+                    continue
+                samples.append((page.get_pixmap().tobytes("png"), texts[:texts_per_image]))
+                if len(samples) >= limit:
+                    return samples
+    return samples
+
+
+def run_torch(samples):
+    os.environ["CLIP_BACKEND"] = "torch"
+    import image_processor
+    rss_before = rss_mb()
+    image_processor.get_torch_clip()
+    start = time.monotonic()
+    for image_bytes, texts in samples:
+        image_processor.get_clip_cosine_scores(image_bytes, texts)
+    elapsed = time.monotonic() - start
+    return {"seconds": elapsed, "rss_mb": rss_mb(), "model_rss_mb": rss_mb() - rss_before}
+
+
+def run_onnx(samples):
+    rss_before = rss_mb()
+    model = clip_onnx.ClipOnnxModel()
+    start = time.monotonic()
+    for image_bytes, texts in samples:
+        model.cosine_scores(image_bytes, texts)
+    elapsed = time.monotonic() - start
+    return {"seconds": elapsed, "rss_mb": rss_mb(), "model_rss_mb": rss_mb() - rss_before}
+
+
+def run_worker_client(samples):
+    service = clip_onnx.get_clip_service()
+    for image_bytes, texts in samples:
+        service.score(image_bytes, texts)
+    return rss_mb()
+
+
+def run_worker(samples, clients):
+    # 先啟動（或連上）worker 並暖機，模型載入時間不算進吞吐量
+    service = clip_onnx.get_clip_service()
+    service.score(*samples[0])
+    shards = [samples[i::clients] for i in range(clients)]
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=clients, mp_context=context) as pool:
+        start = time.monotonic()
+        client_rss = list(pool.map(run_worker_client, shards))
+        elapsed = time.monotonic() - start
+    stats = service.stats()
+    worker_rss = rss_mb(stats["pid"])
+    return {
+        "seconds": elapsed,
+        "rss_mb": worker_rss,
+        "model_rss_mb": worker_rss,
+        "client_rss_mb": max(client_rss),
+        "avg_batch": stats["requests"] / max(stats["batches"], 1),
+    }
+
+
+def main(pattern, limit, texts_per_image, clients, backends):
+    samples = load_samples(pattern, limit, texts_per_image)
+    print(f"[INFO] {len(samples)} 張圖片，每張 {texts_per_image} 段候選文字，intra-op 執行緒 {clip_onnx.CLIP_INTRA_OP_THREADS}")
+    context = multiprocessing.get_context("spawn")
+    rows = []
+    for name in backends:
+        if name == "worker":
+            result = run_worker(samples, clients)
+            label = f"onnx-int8 worker ({clients} clients)"
+        else:
+            # 每種方式在全新的 process 中執行，量到的是該方式自己的記憶體
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                result = pool.submit(run_torch if name == "torch" else run_onnx, samples).result()
+            label = "torch fp32" if name == "torch" else "onnx-int8 in-process"
+        result["name"] = label
+        rows.append(result)
+
+    print(f"{'backend':<32}{'images/s':>10}{'RSS(MB)':>10}{'model+(MB)':>12}")
+    for row in rows:
+        print(f"{row['name']:<32}{len(samples) / row['seconds']:>10.1f}{row['rss_mb']:>10.0f}{row['model_rss_mb']:>12.0f}")
+        if "client_rss_mb" in row:
+            print(f"{'':<4}每個 client process 最大 RSS {row['client_rss_mb']:.0f}MB，worker 平均每批合併 {row['avg_batch']:.1f} 個請求")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CLIP 評分吞吐量與記憶體比較（torch vs int8 ONNX）")
+    parser.add_argument("--pdfs", default="RAG_raw_data/*.pdf", help="用來渲染測試圖片的 PDF glob")
+    parser.add_argument("--images", type=int, default=100)
+    parser.add_argument("--texts-per-image", type=int, default=8)
+    parser.add_argument("--clients", type=int, default=4, help="共用 worker 模式下同時送請求的 process 數")
+    parser.add_argument("--backends", nargs="+", choices=["torch", "onnx", "worker"], default=["torch", "onnx", "worker"])
+    args = parser.parse_args()
+    main(args.pdfs, args.images, args.texts_per_image, args.clients, args.backends)
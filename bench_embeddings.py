@@ -0,0 +1,99 @@
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+
+import numpy_store
+from numpy_store import NumpyClient
+from vector_db import truncate_embeddings
+from bench_vector_store import synthetic_corpus, corpus_from_chroma, make_queries, recall_at_k, dir_size_mb, rss_mb
+
+# 比較不同截斷維度與量化方式（float16 / binary + 重新計分）的記憶體、延遲與 recall@k
+# ground truth 一律為完整維度 float32 的精確搜尋，因此 recall 同時反映截斷與量化的損失
+
+
+def truncate(vectors, dim):
+    return np.asarray(truncate_embeddings(vectors, dim), dtype=np.float32)
+
+
+def bench_config(corpus, queries, truth_ids, dim, dtype, rescore_factor, k, work_dir):
+    path = os.path.join(work_dir, f"{dtype}_{dim}_{rescore_factor}")
+    collection = NumpyClient(path, dtype=dtype).get_or_create_collection("bench")
+    vectors = truncate(corpus, dim)
+    query_vectors = truncate(queries, dim)
+
+    ids = [str(i) for i in range(len(vectors))]
+    start = time.monotonic()
+    for i in range(0, len(vectors), 5000):
+        collection.add(ids=ids[i:i + 5000], embeddings=vectors[i:i + 5000], metadatas=[{}] * len(ids[i:i + 5000]))
+    build_seconds = time.monotonic() - start
+
+    numpy_store.NUMPY_RESCORE_FACTOR = rescore_factor
+    rss_before = rss_mb()
+    latencies, results = [], []
+    for q in query_vectors:
+        start = time.monotonic()
+        result = collection.query(query_embeddings=[q], n_results=k, include=["distances"])
+        latencies.append(time.monotonic() - start)
+        results.append(result["ids"][0])
+    lat = np.asarray(latencies) * 1000
+
+    # 每次查詢都要完整掃過的矩陣大小；binary 的 float32 向量只讀取候選列
+    scanned_mb = len(vectors) * collection._row_width() * np.dtype(collection._np_dtype()).itemsize / 1024 / 1024
+    return {
+        "name": f"{dtype}-{dim}" + (f"-x{rescore_factor}" if dtype == numpy_store.BINARY else ""),
+        "build_s": build_seconds,
+        "p50_ms": float(np.percentile(lat, 50)),
+        "p95_ms": float(np.percentile(lat, 95)),
+        "scanned_mb": scanned_mb,
+        "disk_mb": dir_size_mb(path),
+        "rss_delta_mb": rss_mb() - rss_before,
+        "recall": recall_at_k(results, truth_ids),
+    }
+
+
+def main(args):
+    corpus = corpus_from_chroma() if args.from_chroma else synthetic_corpus(args.n, args.dim)
+    queries = make_queries(corpus, args.queries)
+    full_dim = corpus.shape[1]
+    print(f"[INFO] 語料 {len(corpus)} 筆，維度 {full_dim}，查詢 {args.queries} 筆，k={args.k}")
+    if not args.from_chroma:
+        print("[WARN] 合成語料沒有 Matryoshka 的維度重要性排序，截斷的 recall 會偏低；請以 --from-chroma 在實際語料上評估")
+
+    truth = np.argsort(-(queries @ corpus.T), axis=1)[:, :args.k]
+    truth_ids = [[str(i) for i in row] for row in truth]
+
+    dims = [full_dim] + [d for d in args.dims if d < full_dim]
+    configs = []
+    for dim in dims:
+        configs.append((dim, "float16", 0))
+        configs.extend((dim, numpy_store.BINARY, factor) for factor in args.rescore_factors)
+
+    work_dir = tempfile.mkdtemp(prefix="bench_embeddings_")
+    rows = []
+    try:
+        for dim, dtype, factor in configs:
+            rows.append(bench_config(corpus, queries, truth_ids, dim, dtype, factor, args.k, work_dir))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(f"{'config':<20}{'build(s)':>10}{'p50(ms)':>10}{'p95(ms)':>10}{'scan(MB)':>10}{'disk(MB)':>10}{'RSS+(MB)':>10}{'recall@k':>10}")
+    for row in rows:
+        print(
+            f"{row['name']:<20}{row['build_s']:>10.2f}{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}"
+            f"{row['scanned_mb']:>10.1f}{row['disk_mb']:>10.1f}{row['rss_delta_mb']:>10.1f}{row['recall']:>10.4f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="截斷維度與 binary 量化（含重新計分）的記憶體、延遲與 recall 比較")
+    parser.add_argument("--n", type=int, default=100000, help="合成語料筆數")
+    parser.add_argument("--dim", type=int, default=1024, help="合成語料維度（mxbai-embed-large 為 1024）")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--dims", type=int, nargs="+", default=[512, 256], help="要比較的截斷維度")
+    parser.add_argument("--rescore-factors", type=int, nargs="+", default=[4, 10], help="binary 第一階段取 k × 倍數個候選")
+    parser.add_argument("--from-chroma", action="store_true", help="改用目前 ChromaDB 文字集合的實際向量")
+    main(parser.parse_args())
@@ -0,0 +1,119 @@
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import chromadb
+
+from numpy_store import NumpyClient
+from vector_db import TEXT_COLLECTION_NAME
+from collection_alias import versioned_name
+from hierarchical_index import get_summary_collection, summary_records, hierarchical_search
+from bench_vector_store import make_queries, recall_at_k
+
+# 比較 flat 檢索與階層式（文件 → 頁面 → chunk）檢索在不同語料規模下的延遲與 recall
+
+
+def hierarchical_corpus(num_docs, pages_per_doc, chunks_per_page, dim, seed=0):
+    """文件中心 → 頁面中心 → chunk 的三層群聚結構，近似真實文件中同頁、同篇內容較相近的分佈"""
+    rng = np.random.default_rng(seed)
+    doc_centers = rng.standard_normal((num_docs, dim)).astype(np.float32)
+    page_centers = np.repeat(doc_centers, pages_per_doc, axis=0)
+    page_centers += 0.6 * rng.standard_normal(page_centers.shape).astype(np.float32)
+    chunks = np.repeat(page_centers, chunks_per_page, axis=0)
+    chunks += 0.6 * rng.standard_normal(chunks.shape).astype(np.float32)
+    chunks /= np.linalg.norm(chunks, axis=1, keepdims=True)
+    metadatas = [
+        {"file_name": f"doc{i // (pages_per_doc * chunks_per_page)}.pdf", "page": (i // chunks_per_page) % pages_per_doc + 1}
+        for i in range(len(chunks))
+    ]
+    return chunks, metadatas
+
+
+def make_client(backend, path):
+    if backend == "numpy":
+        return NumpyClient(path)
+    return chromadb.PersistentClient(path=path)
+
+
+def timed_queries(search, queries):
+    latencies, results = [], []
+    for q in queries:
+        start = time.monotonic()
+        result = search([q])
+        latencies.append(time.monotonic() - start)
+        results.append(result["ids"][0])
+    lat = np.asarray(latencies) * 1000
+    return float(np.percentile(lat, 50)), float(np.percentile(lat, 95)), results
+
+
+def bench_size(num_docs, args, work_dir):
+    corpus, metadatas = hierarchical_corpus(num_docs, args.pages_per_doc, args.chunks_per_page, args.dim)
+    queries = make_queries(corpus, args.queries)
+    truth = np.argsort(-(queries @ corpus.T), axis=1)[:, :args.k]
+    truth_ids = [[str(i) for i in row] for row in truth]
+
+    client = make_client(args.backend, os.path.join(work_dir, f"docs{num_docs}"))
+    text_collection = client.get_or_create_collection(
+        versioned_name(TEXT_COLLECTION_NAME, f"bench{num_docs}"), metadata={"hnsw:space": "cosine"}, embedding_function=None
+    )
+    ids = [str(i) for i in range(len(corpus))]
+    batch_size = min(5000, client.get_max_batch_size())
+    for i in range(0, len(corpus), batch_size):
+        text_collection.add(ids=ids[i:i + batch_size], embeddings=corpus[i:i + batch_size], metadatas=metadatas[i:i + batch_size])
+
+    # 建立摘要向量（與 update_summaries 相同的 mean pooling）
+    start = time.monotonic()
+    summary = get_summary_collection(text_collection, client)
+    per_doc = args.pages_per_doc * args.chunks_per_page
+    for d in range(num_docs):
+        rows = slice(d * per_doc, (d + 1) * per_doc)
+        s_ids, s_vectors, s_metas = summary_records(f"doc{d}.pdf", corpus[rows], metadatas[rows])
+        summary.add(ids=s_ids, embeddings=np.asarray(s_vectors), metadatas=s_metas)
+    summary_seconds = time.monotonic() - start
+
+    flat = timed_queries(lambda q: text_collection.query(query_embeddings=q, n_results=args.k), queries)
+    # 不預先暖機：階層式檢索以頁面條件直接查詢向量庫，量測的即為冷啟動時每次查詢的實際成本
+    hier = timed_queries(lambda q: hierarchical_search(text_collection, q, args.k, args.top_documents, args.top_pages), queries)
+    return {
+        "chunks": len(corpus),
+        "summary_s": summary_seconds,
+        "flat_p50": flat[0], "flat_p95": flat[1], "flat_recall": recall_at_k(flat[2], truth_ids),
+        "hier_p50": hier[0], "hier_p95": hier[1], "hier_recall": recall_at_k(hier[2], truth_ids),
+    }
+
+
+def main(args):
+    print(
+        f"[INFO] 每份文件 {args.pages_per_doc} 頁 × 每頁 {args.chunks_per_page} chunk，維度 {args.dim}，查詢 {args.queries} 筆，"
+        f"k={args.k}，第一階段取 {args.top_documents} 份文件 / {args.top_pages} 頁，後端 {args.backend}"
+    )
+    work_dir = tempfile.mkdtemp(prefix="bench_hierarchical_")
+    rows = []
+    try:
+        for num_docs in args.docs:
+            rows.append(bench_size(num_docs, args, work_dir))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(f"{'chunks':>9}{'summary(s)':>12}{'flat p50':>10}{'flat p95':>10}{'flat R@k':>10}{'hier p50':>10}{'hier p95':>10}{'hier R@k':>10}")
+    for row in rows:
+        print(
+            f"{row['chunks']:>9}{row['summary_s']:>12.2f}{row['flat_p50']:>10.2f}{row['flat_p95']:>10.2f}{row['flat_recall']:>10.4f}"
+            f"{row['hier_p50']:>10.2f}{row['hier_p95']:>10.2f}{row['hier_recall']:>10.4f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="flat 與階層式（粗到細）檢索的延遲與 recall 比較")
+    parser.add_argument("--docs", type=int, nargs="+", default=[100, 500, 2000], help="各輪的文件數")
+    parser.add_argument("--pages-per-doc", type=int, default=10)
+    parser.add_argument("--chunks-per-page", type=int, default=10)
+    parser.add_argument("--dim", type=int, default=1024, help="向量維度（mxbai-embed-large 為 1024）")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=4, help="main.py 取 4 筆上下文")
+    parser.add_argument("--top-documents", type=int, default=5)
+    parser.add_argument("--top-pages", type=int, default=20)
+    parser.add_argument("--backend", choices=["chroma", "numpy"], default="chroma")
+    main(parser.parse_args())
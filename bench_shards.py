@@ -0,0 +1,113 @@
+import os
+import time
+import shutil
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import chromadb
+
+from numpy_store import NumpyClient
+from sharded_store import ShardedClient
+from bench_vector_store import synthetic_corpus, make_queries, recall_at_k, dir_size_mb
+
+# 以合成的多文件語料量測分片數對建立時間、查詢延遲、併發吞吐量與 recall 的影響
+
+
+def make_client(backend, path):
+    if backend == "numpy":
+        return NumpyClient(path)
+    return chromadb.PersistentClient(path=path)
+
+
+def bench_shards(num_shards, num_dirs, backend, corpus, queries, k, chunks_per_doc, concurrency, work_dir):
+    paths = [os.path.join(work_dir, f"s{num_shards}_d{i}") for i in range(num_dirs)]
+    client = ShardedClient([make_client(backend, path) for path in paths], num_shards, shard_key="file_name")
+    collection = client.get_or_create_collection("bench", metadata={"hnsw:space": "cosine"})
+
+    ids = [str(i) for i in range(len(corpus))]
+    metadatas = [{"file_name": f"doc{i // chunks_per_doc}.pdf"} for i in range(len(corpus))]
+    batch_size = min(5000, client.get_max_batch_size())
+    start = time.monotonic()
+    for i in range(0, len(corpus), batch_size):
+        collection.add(ids=ids[i:i + batch_size], embeddings=corpus[i:i + batch_size], metadatas=metadatas[i:i + batch_size])
+    build_seconds = time.monotonic() - start
+
+    latencies, results = [], []
+    for q in queries:
+        start = time.monotonic()
+        result = collection.query(query_embeddings=[q], n_results=k, include=["distances"])
+        latencies.append(time.monotonic() - start)
+        results.append(result["ids"][0])
+
+    # 多個查詢執行緒同時送出，量測扇出後的整體吞吐量
+    def run_one(q):
+        collection.query(query_embeddings=[q], n_results=k, include=["distances"])
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(run_one, queries))
+    concurrent_qps = len(queries) / (time.monotonic() - start)
+
+    # 限定單一文件的查詢只會送到該文件所在的分片
+    start = time.monotonic()
+    for i, q in enumerate(queries[:50]):
+        collection.query(query_embeddings=[q], n_results=k, where={"file_name": metadatas[i * 7 % len(corpus)]["file_name"]})
+    scoped_ms = (time.monotonic() - start) / min(50, len(queries)) * 1000
+
+    stats = collection.shard_stats()
+    counts = np.asarray([s["count"] for s in stats])
+    lat = np.asarray(latencies) * 1000
+    return {
+        "shards": num_shards,
+        "build_s": build_seconds,
+        "p50_ms": float(np.percentile(lat, 50)),
+        "p95_ms": float(np.percentile(lat, 95)),
+        "qps": concurrent_qps,
+        "scoped_ms": scoped_ms,
+        "imbalance": float(counts.max() / counts.mean()),
+        "slowest_shard_p95_ms": max(s["p95_ms"] for s in stats),
+        "disk_mb": sum(dir_size_mb(path) for path in paths),
+        "results": results,
+    }
+
+
+def main(n, dim, m, k, shard_counts, num_dirs, backend, chunks_per_doc, concurrency):
+    corpus = synthetic_corpus(n, dim)
+    queries = make_queries(corpus, m)
+    print(f"[INFO] 語料 {n} 筆（每份文件 {chunks_per_doc} 個 chunk），維度 {dim}，查詢 {m} 筆，k={k}，後端 {backend}")
+
+    truth = np.argsort(-(queries @ corpus.T), axis=1)[:, :k]
+    truth_ids = [[str(i) for i in row] for row in truth]
+
+    work_dir = tempfile.mkdtemp(prefix="bench_shards_")
+    rows = []
+    try:
+        for num_shards in shard_counts:
+            rows.append(bench_shards(num_shards, min(num_dirs, num_shards), backend, corpus, queries, k,
+                                     chunks_per_doc, concurrency, work_dir))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(f"{'shards':>7}{'build(s)':>10}{'p50(ms)':>10}{'p95(ms)':>10}{'qps':>9}{'scoped(ms)':>12}{'max/mean':>10}{'shard p95':>11}{'disk(MB)':>10}{'recall@k':>10}")
+    for row in rows:
+        recall = recall_at_k(row["results"], truth_ids)
+        print(
+            f"{row['shards']:>7}{row['build_s']:>10.2f}{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}{row['qps']:>9.1f}"
+            f"{row['scoped_ms']:>12.2f}{row['imbalance']:>10.2f}{row['slowest_shard_p95_ms']:>11.2f}{row['disk_mb']:>10.1f}{recall:>10.4f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="向量集合分片擴展性測試（合成多文件語料）")
+    parser.add_argument("--n", type=int, default=200000, help="合成語料筆數")
+    parser.add_argument("--dim", type=int, default=1024, help="向量維度（mxbai-embed-large 為 1024）")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--dirs", type=int, default=1, help="分片分散到幾個持久化目錄")
+    parser.add_argument("--backend", choices=["chroma", "numpy"], default="chroma")
+    parser.add_argument("--chunks-per-doc", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=8, help="併發吞吐量測試的查詢執行緒數")
+    args = parser.parse_args()
+    main(args.n, args.dim, args.queries, args.k, args.shards, args.dirs, args.backend, args.chunks_per_doc, args.concurrency)
@@ -0,0 +1,139 @@
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import psutil
+import chromadb
+
+from numpy_store import NumpyClient
+from vector_db import init_chroma_client, TEXT_COLLECTION_NAME
+from collection_alias import current_generation, versioned_name
+
+# 比較 ChromaDB (HNSW) 與 NumPy memmap 精確搜尋後端的延遲、記憶體與 recall
+
+
+def rss_mb():
+    return psutil.Process().memory_info().rss / 1024 / 1024
+
+
+def dir_size_mb(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return total / 1024 / 1024
+
+
+def synthetic_corpus(n, dim, seed=0):
+    """產生有群聚結構的正規化向量，比純亂數更接近真實 Embedding 分佈"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(1, n // 200), dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, len(centers), n)] + 0.5 * rng.standard_normal((n, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def corpus_from_chroma():
+    """使用目前 ChromaDB 文字集合中的實際向量"""
+    client = init_chroma_client()
+    data = client.get_collection(versioned_name(TEXT_COLLECTION_NAME, current_generation())).get(include=["embeddings"])
+    vectors = np.asarray(data["embeddings"], dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def make_queries(corpus, m, seed=1):
+    rng = np.random.default_rng(seed)
+    picks = corpus[rng.integers(0, len(corpus), m)]
+    queries = picks + 0.3 * rng.standard_normal(picks.shape).astype(np.float32) / np.sqrt(corpus.shape[1])
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+
+def recall_at_k(result_ids, truth_ids):
+    hits = sum(len(set(r) & set(t)) for r, t in zip(result_ids, truth_ids))
+    return hits / sum(len(t) for t in truth_ids)
+
+
+def bench_backend(name, collection, corpus, queries, k, batch_size):
+    ids = [str(i) for i in range(len(corpus))]
+    rss_before = rss_mb()
+    start = time.monotonic()
+    for i in range(0, len(corpus), batch_size):
+        collection.add(ids=ids[i:i + batch_size], embeddings=corpus[i:i + batch_size],
+                       metadatas=[{"shard": j % 10} for j in range(i, min(i + batch_size, len(corpus)))])
+    build_seconds = time.monotonic() - start
+
+    latencies, results = [], []
+    for q in queries:
+        start = time.monotonic()
+        result = collection.query(query_embeddings=[q], n_results=k)
+        latencies.append(time.monotonic() - start)
+        results.append(result["ids"][0])
+
+    start = time.monotonic()
+    collection.query(query_embeddings=queries, n_results=k)
+    batch_seconds = time.monotonic() - start
+
+    start = time.monotonic()
+    collection.query(query_embeddings=queries[:20], n_results=k, where={"shard": 3})
+    filter_seconds = (time.monotonic() - start) / min(20, len(queries))
+
+    lat = np.asarray(latencies) * 1000
+    return {
+        "backend": name,
+        "build_s": build_seconds,
+        "p50_ms": float(np.percentile(lat, 50)),
+        "p95_ms": float(np.percentile(lat, 95)),
+        "batch_qps": len(queries) / batch_seconds,
+        "filter_ms": filter_seconds * 1000,
+        "rss_delta_mb": rss_mb() - rss_before,
+        "results": results,
+    }
+
+
+def main(n, dim, m, k, dtype, from_chroma):
+    corpus = corpus_from_chroma() if from_chroma else synthetic_corpus(n, dim)
+    queries = make_queries(corpus, m)
+    print(f"[INFO] 語料 {len(corpus)} 筆，維度 {corpus.shape[1]}，查詢 {m} 筆，k={k}")
+
+    # 以 float32 精確搜尋作為 ground truth
+    truth = np.argsort(-(queries @ corpus.T), axis=1)[:, :k]
+    truth_ids = [[str(i) for i in row] for row in truth]
+
+    work_dir = tempfile.mkdtemp(prefix="bench_vector_store_")
+    rows = []
+    try:
+        chroma_path = os.path.join(work_dir, "chroma")
+        chroma_client = chromadb.PersistentClient(path=chroma_path)
+        chroma_collection = chroma_client.create_collection("bench", metadata={"hnsw:space": "cosine"}, embedding_function=None)
+        batch_size = min(5000, chroma_client.get_max_batch_size())
+        row = bench_backend("chroma-hnsw", chroma_collection, corpus, queries, k, batch_size)
+        row["disk_mb"] = dir_size_mb(chroma_path)
+        rows.append(row)
+
+        numpy_path = os.path.join(work_dir, "numpy")
+        numpy_collection = NumpyClient(numpy_path, dtype=dtype).get_or_create_collection("bench")
+        row = bench_backend(f"numpy-{dtype}", numpy_collection, corpus, queries, k, batch_size)
+        row["disk_mb"] = dir_size_mb(numpy_path)
+        rows.append(row)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(f"{'backend':<16}{'build(s)':>10}{'p50(ms)':>10}{'p95(ms)':>10}{'batch qps':>11}{'filter(ms)':>12}{'RSS+(MB)':>10}{'disk(MB)':>10}{'recall@k':>10}")
+    for row in rows:
+        recall = recall_at_k(row["results"], truth_ids)
+        print(
+            f"{row['backend']:<16}{row['build_s']:>10.2f}{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}"
+            f"{row['batch_qps']:>11.1f}{row['filter_ms']:>12.2f}{row['rss_delta_mb']:>10.1f}{row['disk_mb']:>10.1f}{recall:>10.4f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ChromaDB 與 NumPy memmap 向量搜尋後端比較")
+    parser.add_argument("--n", type=int, default=100000, help="合成語料筆數")
+    parser.add_argument("--dim", type=int, default=1024, help="向量維度（mxbai-embed-large 為 1024）")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--dtype", choices=["float16", "int8"], default="float16")
+    parser.add_argument("--from-chroma", action="store_true", help="改用目前 ChromaDB 文字集合的實際向量")
+    args = parser.parse_args()
+    main(args.n, args.dim, args.queries, args.k, args.dtype, args.from_chroma)
@@ -0,0 +1,327 @@
+import io
+import os
+import sys
+import time
+import queue
+import hashlib
+import secrets
+import argparse
+import threading
+import subprocess
+from concurrent.futures import Future
+from multiprocessing.managers import BaseManager
+import numpy as np
+from PIL import Image
+
+# CLIP 推論後端設定，可透過環境變數調整
+CLIP_MODEL_NAME = "openai/clip-vit-base-patch32"
+# 匯出並量化後的 ONNX 模型與 processor 存放位置
+CLIP_ONNX_DIR = os.getenv("CLIP_ONNX_DIR", os.path.join("models", "clip-onnx"))
+# onnxruntime 單一運算子可用的執行緒數；多個匯入 worker 共用同一個推論 process，避免 CPU 超額分配
+CLIP_INTRA_OP_THREADS = int(os.getenv("CLIP_INTRA_OP_THREADS", str(max(1, (os.cpu_count() or 2) // 2))))
+# 共用推論 worker 的位址與驗證金鑰；未設定金鑰時，第一次使用會在模型資料夾產生一把僅本機帳號可讀的隨機金鑰
+CLIP_WORKER_HOST = os.getenv("CLIP_WORKER_HOST", "127.0.0.1")
+CLIP_WORKER_PORT = int(os.getenv("CLIP_WORKER_PORT", "50055"))
+CLIP_WORKER_AUTHKEY = os.getenv("CLIP_WORKER_AUTHKEY", "")
+CLIP_WORKER_AUTHKEY_FILE = os.getenv("CLIP_WORKER_AUTHKEY_FILE", os.path.join(CLIP_ONNX_DIR, "worker.authkey"))
+# 連不上 worker 時是否自動啟動
+CLIP_WORKER_AUTOSTART = os.getenv("CLIP_WORKER_AUTOSTART", "true").lower() == "true"
+# 跨請求合併批次的時間窗與上限（以請求數計）
+CLIP_BATCH_WINDOW_MS = float(os.getenv("CLIP_BATCH_WINDOW_MS", "10"))
+CLIP_BATCH_MAX_SIZE = int(os.getenv("CLIP_BATCH_MAX_SIZE", "16"))
+
+IMAGE_MODEL_FILE = "image_encoder.int8.onnx"
+TEXT_MODEL_FILE = "text_encoder.int8.onnx"
+# CLIP 文字編碼器的最大長度
+TEXT_MAX_LENGTH = 77
+
+
+def worker_authkey():
+    """
+    worker 與用戶端共用的驗證金鑰：優先使用 CLIP_WORKER_AUTHKEY，
+    否則讀取 CLIP_WORKER_AUTHKEY_FILE，檔案不存在時產生一把隨機金鑰（權限 0600）。
+    先寫入暫存檔再以 link 建立，多個程序同時初始化時只有一把金鑰生效。
+    """
+    if CLIP_WORKER_AUTHKEY:
+        return CLIP_WORKER_AUTHKEY.encode("utf-8")
+    if not os.path.exists(CLIP_WORKER_AUTHKEY_FILE):
+        os.makedirs(os.path.dirname(CLIP_WORKER_AUTHKEY_FILE) or ".", exist_ok=True)
+        tmp_path = f"{CLIP_WORKER_AUTHKEY_FILE}.{os.getpid()}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(secrets.token_hex(32))
+        try:
+            os.link(tmp_path, CLIP_WORKER_AUTHKEY_FILE)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
+    with open(CLIP_WORKER_AUTHKEY_FILE, "r") as f:
+        return f.read().strip().encode("utf-8")
+
+
+def model_missing_message(model_dir=CLIP_ONNX_DIR):
+    return f"找不到 ONNX 模型，請先執行：python clip_onnx.py export --output {model_dir}"
+
+
+def export_clip_onnx(output_dir=CLIP_ONNX_DIR, model_name=CLIP_MODEL_NAME):
+    """
+    將 CLIP 的圖片 / 文字編碼器分別匯出為 ONNX，再做 int8 動態量化。
+    只在匯出時需要 torch；推論端只依賴 onnxruntime。
+    """
+    import torch
+    from transformers import CLIPModel, CLIPProcessor
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    os.makedirs(output_dir, exist_ok=True)
+    model = CLIPModel.from_pretrained(model_name).eval()
+    processor = CLIPProcessor.from_pretrained(model_name)
+    processor.save_pretrained(output_dir)
+
+    class ImageEncoder(torch.nn.Module):
+        def forward(self, pixel_values):
+            return model.get_image_features(pixel_values=pixel_values)
+
+    class TextEncoder(torch.nn.Module):
+        def forward(self, input_ids, attention_mask):
+            return model.get_text_features(input_ids=input_ids, attention_mask=attention_mask)
+
+    dummy_image = processor(images=Image.new("RGB", (224, 224)), return_tensors="pt")["pixel_values"]
+    dummy_text = processor(text=["a photo"], return_tensors="pt", padding="max_length", max_length=TEXT_MAX_LENGTH)
+
+    exports = [
+        (ImageEncoder(), (dummy_image,), ["pixel_values"], {"pixel_values": {0: "batch"}}, IMAGE_MODEL_FILE),
+        (
+            TextEncoder(),
+            (dummy_text["input_ids"], dummy_text["attention_mask"]),
+            ["input_ids", "attention_mask"],
+            {"input_ids": {0: "batch", 1: "sequence"}, "attention_mask": {0: "batch", 1: "sequence"}},
+            TEXT_MODEL_FILE,
+        ),
+    ]
+    for module, args, input_names, dynamic_axes, file_name in exports:
+        fp32_path = os.path.join(output_dir, file_name.replace(".int8", ""))
+        with torch.no_grad():
+            torch.onnx.export(
+                module, args, fp32_path,
+                input_names=input_names,
+                output_names=["features"],
+                dynamic_axes={**dynamic_axes, "features": {0: "batch"}},
+                opset_version=17,
+            )
+        # 只量化 MatMul / Gemm：CPU EP 不支援 int8 的 ConvInteger（patch embedding 維持 fp32）
+        quantize_dynamic(
+            fp32_path,
+            os.path.join(output_dir, file_name),
+            weight_type=QuantType.QInt8,
+            op_types_to_quantize=["MatMul", "Gemm"],
+        )
+        os.remove(fp32_path)
+        print(f"[INFO] 已匯出量化模型：{os.path.join(output_dir, file_name)}")
+
+
+class ClipOnnxModel:
+    """以 onnxruntime 執行 int8 CLIP，執行緒數由 intra_op_threads 明確控制"""
+
+    def __init__(self, model_dir=CLIP_ONNX_DIR, intra_op_threads=CLIP_INTRA_OP_THREADS):
+        import onnxruntime as ort
+        from transformers import CLIPProcessor
+
+        if not os.path.exists(os.path.join(model_dir, IMAGE_MODEL_FILE)):
+            raise FileNotFoundError(model_missing_message(model_dir))
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = 1
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        providers = ["CPUExecutionProvider"]
+        self.image_session = ort.InferenceSession(os.path.join(model_dir, IMAGE_MODEL_FILE), options, providers=providers)
+        self.text_session = ort.InferenceSession(os.path.join(model_dir, TEXT_MODEL_FILE), options, providers=providers)
+        self.processor = CLIPProcessor.from_pretrained(model_dir)
+
+    @staticmethod
+    def _normalize(features):
+        return features / np.linalg.norm(features, axis=1, keepdims=True)
+
+    def image_features(self, images):
+        pixel_values = self.processor(images=images, return_tensors="np")["pixel_values"].astype(np.float32)
+        return self._normalize(self.image_session.run(None, {"pixel_values": pixel_values})[0])
+
+    def text_features(self, texts):
+        inputs = self.processor(text=texts, return_tensors="np", padding=True, truncation=True, max_length=TEXT_MAX_LENGTH)
+        return self._normalize(self.text_session.run(None, {
+            "input_ids": inputs["input_ids"].astype(np.int64),
+            "attention_mask": inputs["attention_mask"].astype(np.int64),
+        })[0])
+
+    def cosine_scores(self, image_bytes, texts):
+        image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+        return (self.text_features(texts) @ self.image_features([image])[0]).tolist()
+
+
+class ClipBatcher:
+    """
+    合併來自各匯入 worker 的評分請求：在時間窗內收集後，
+    相同圖片只編碼一次，所有文字一起編碼，再分別算出各請求的 cosine 分數。
+    """
+
+    def __init__(self, model, max_batch_size=CLIP_BATCH_MAX_SIZE, window_ms=CLIP_BATCH_WINDOW_MS):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.window = window_ms / 1000
+        self._queue = queue.Queue()
+        self.batches = 0
+        self.requests = 0
+        self.images = 0
+        threading.Thread(target=self._run, name="clip-batcher", daemon=True).start()
+
+    def score(self, image_bytes, texts):
+        future = Future()
+        self._queue.put((image_bytes, list(texts), future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                image_keys = [hashlib.sha1(image_bytes).hexdigest() for image_bytes, _, _ in batch]
+                unique_images = dict(zip(image_keys, (image_bytes for image_bytes, _, _ in batch)))
+                unique_texts = list(dict.fromkeys(text for _, texts, _ in batch for text in texts))
+                image_features = dict(zip(unique_images, self.model.image_features(
+                    [Image.open(io.BytesIO(b)).convert("RGB") for b in unique_images.values()]
+                )))
+                text_rows = {text: i for i, text in enumerate(unique_texts)}
+                text_features = self.model.text_features(unique_texts) if unique_texts else None
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.requests += len(batch)
+            self.images += len(unique_images)
+            for key, (_, texts, future) in zip(image_keys, batch):
+                if not texts:
+                    future.set_result([])
+                    continue
+                rows = text_features[[text_rows[text] for text in texts]]
+                future.set_result((rows @ image_features[key]).tolist())
+
+
+class ClipService:
+    """共用推論 worker 對外提供的介面（透過 multiprocessing manager 代理呼叫）"""
+
+    def __init__(self, batcher):
+        self.batcher = batcher
+
+    def score(self, image_bytes, texts):
+        return self.batcher.score(image_bytes, texts)
+
+    def stats(self):
+        return {
+            "pid": os.getpid(),
+            "batches": self.batcher.batches,
+            "requests": self.batcher.requests,
+            "images": self.batcher.images,
+        }
+
+
+class ClipManager(BaseManager):
+    pass
+
+
+def serve(host=CLIP_WORKER_HOST, port=CLIP_WORKER_PORT):
+    """啟動共用 CLIP 推論 worker；manager 為每個連線開一條執行緒，請求在 ClipBatcher 中合併"""
+    service = ClipService(ClipBatcher(ClipOnnxModel()))
+    ClipManager.register("clip_service", callable=lambda: service)
+    manager = ClipManager(address=(host, port), authkey=worker_authkey())
+    server = manager.get_server()
+    print(f"[INFO] CLIP 推論 worker 已啟動：{host}:{port}（intra-op 執行緒 {CLIP_INTRA_OP_THREADS}）")
+    server.serve_forever()
+
+
+_client_service = None
+_client_lock = threading.Lock()
+
+
+def _connect():
+    ClipManager.register("clip_service")
+    manager = ClipManager(address=(CLIP_WORKER_HOST, CLIP_WORKER_PORT), authkey=worker_authkey())
+    manager.connect()
+    return manager.clip_service()
+
+
+def get_clip_service(startup_timeout=120):
+    """連線到共用 worker；連不上且允許自動啟動時，於背景啟動一個 worker process 後重試"""
+    global _client_service
+    with _client_lock:
+        if _client_service is not None:
+            return _client_service
+        try:
+            _client_service = _connect()
+        except (ConnectionRefusedError, FileNotFoundError):
+            if not CLIP_WORKER_AUTOSTART:
+                raise
+            # 模型尚未匯出時 worker 只會啟動失敗，不必等到逾時
+            if not os.path.exists(os.path.join(CLIP_ONNX_DIR, IMAGE_MODEL_FILE)):
+                raise FileNotFoundError(model_missing_message())
+            print("[INFO] 找不到 CLIP 推論 worker，啟動新的 worker process")
+            subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), "serve"],
+                start_new_session=True,
+            )
+            deadline = time.monotonic() + startup_timeout
+            while True:
+                try:
+                    _client_service = _connect()
+                    break
+                except ConnectionRefusedError:
+                    if time.monotonic() > deadline:
+                        raise
+                    time.sleep(0.5)
+        return _client_service
+
+
+def reset_clip_service(service):
+    """連線中斷（worker 重啟或結束）時丟棄快取的代理物件，下次呼叫重新連線"""
+    global _client_service
+    with _client_lock:
+        if _client_service is service:
+            _client_service = None
+
+
+def clip_cosine_scores(image_bytes, texts):
+    """回傳圖片與每段文字的 cosine 相似度（由共用 worker 批次計算）；連線中斷時重新連線並重試一次"""
+    if not texts:
+        return []
+    service = get_clip_service()
+    try:
+        return service.score(image_bytes, list(texts))
+    except (EOFError, ConnectionError):
+        print("[WARN] 與 CLIP 推論 worker 的連線中斷，重新連線")
+        reset_clip_service(service)
+    return get_clip_service().score(image_bytes, list(texts))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CLIP ONNX 推論後端")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export", help="匯出並量化 ONNX 模型")
+    export_parser.add_argument("--output", default=CLIP_ONNX_DIR)
+    subparsers.add_parser("serve", help="啟動共用推論 worker")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export_clip_onnx(args.output)
+    else:
+        serve()
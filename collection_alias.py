@@ -0,0 +1,48 @@
+import os
+import json
+import time
+
+# 集合世代（generation）別名：記錄目前對外服務的是哪一組版本化集合，
+# 切換時以 os.replace 原子性地覆寫檔案，查詢端讀到的永遠是完整的一組設定
+COLLECTION_ALIAS_FILE = os.getenv("COLLECTION_ALIAS_FILE", "collection_aliases.json")
+# 空字串代表尚未做過重建的原始集合（rag_text_collection / rag_image_collection）
+LEGACY_GENERATION = ""
+
+
+def load_aliases(path=COLLECTION_ALIAS_FILE):
+    if not os.path.exists(path):
+        return {"current": LEGACY_GENERATION, "previous": None, "history": []}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def current_generation(path=COLLECTION_ALIAS_FILE):
+    return load_aliases(path)["current"]
+
+
+def aliases_mtime(path=COLLECTION_ALIAS_FILE):
+    return os.path.getmtime(path) if os.path.exists(path) else None
+
+
+def new_generation():
+    return time.strftime("g%Y%m%d%H%M%S")
+
+
+def versioned_name(base_name, generation):
+    return f"{base_name}__{generation}" if generation else base_name
+
+
+def swap_alias(generation, path=COLLECTION_ALIAS_FILE):
+    """把別名指向新世代，原本的世代記為 previous（回滾目標）；回傳被取代的世代"""
+    aliases = load_aliases(path)
+    replaced = aliases["current"]
+    aliases["history"] = (aliases.get("history") or []) + [
+        {"generation": generation, "swapped_at": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    ]
+    aliases["previous"] = replaced
+    aliases["current"] = generation
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(aliases, f, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, path)
+    return replaced
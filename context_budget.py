@@ -0,0 +1,144 @@
+import os
+import re
+import threading
+import unicodedata
+import tiktoken
+
+# 上下文組裝設定，可透過環境變數調整
+# 背景資訊的 token 上限；0 表示不限制（維持全部檢索結果）。
+# 預設不限制，與加入預算前的行為相同；請以 main.py 比較各預算的 RAGAS 分數後再設定
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "0"))
+# 是否刪去與問題、關鍵字無關的句子
+CONTEXT_TRIM_SENTENCES = os.getenv("CONTEXT_TRIM_SENTENCES", "false").lower() == "true"
+# GPT-4o 使用的 tokenizer
+CONTEXT_TOKENIZER = os.getenv("CONTEXT_TOKENIZER", "o200k_base")
+# 同一 chunk 被多個查詢變體檢索到時，每多一次的加分
+MULTI_HIT_BONUS = 0.1
+# 剩餘預算少於此 token 數就不再嘗試塞入更小的 chunk
+MIN_FILL_TOKENS = 32
+
+SENTENCE_PATTERN = re.compile(r"(?<=[.!?。！？])\s+|(?<=[。！？])")
+TERM_PATTERN = re.compile(r"[a-z0-9]+|[一-鿿]")
+# 英文常見虛詞不列入句子相關度計算
+STOPWORDS = {
+    "a", "an", "the", "of", "to", "in", "on", "for", "and", "or", "is", "are", "was", "were", "be", "by",
+    "with", "what", "which", "how", "do", "does", "did", "this", "that", "it", "as", "at", "from", "their",
+}
+
+_encoder = None
+
+
+def get_encoder():
+    global _encoder
+    if _encoder is None:
+        _encoder = tiktoken.get_encoding(CONTEXT_TOKENIZER)
+    return _encoder
+
+
+def count_tokens(text):
+    return len(get_encoder().encode(text, disallowed_special=()))
+
+
+def terms(text):
+    text = unicodedata.normalize("NFKC", text).lower()
+    return {term for term in TERM_PATTERN.findall(text) if term not in STOPWORDS}
+
+
+def normalize_for_dedup(text):
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", text).lower()).strip()
+
+
+def trim_sentences(text, query_terms):
+    """只保留與問題 / 關鍵字有字詞重疊的句子；全部無關時保留第一句，避免 chunk 整段消失"""
+    sentences = [s for s in SENTENCE_PATTERN.split(text) if s.strip()]
+    if len(sentences) <= 1:
+        return text
+    kept = [s for s in sentences if terms(s) & query_terms]
+    return " ".join(kept or sentences[:1])
+
+
+class ContextStats:
+    """累計每次查詢組裝前後的 token 數，回報節省的 prompt token"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def record(self, raw_tokens, packed_tokens, raw_chunks, packed_chunks):
+        with self._lock:
+            self.queries += 1
+            self.raw_tokens += raw_tokens
+            self.packed_tokens += packed_tokens
+            self.raw_chunks += raw_chunks
+            self.packed_chunks += packed_chunks
+
+    def stats(self):
+        saved = self.raw_tokens - self.packed_tokens
+        return {
+            "queries": self.queries,
+            "raw_tokens": self.raw_tokens,
+            "packed_tokens": self.packed_tokens,
+            "saved_tokens": saved,
+            "saved_ratio": saved / self.raw_tokens if self.raw_tokens else 0.0,
+        }
+
+    def report(self):
+        if not self.queries:
+            return
+        stats = self.stats()
+        print(
+            f"[INFO] 上下文組裝：{self.queries} 次查詢，背景資訊 {stats['raw_tokens']} → {stats['packed_tokens']} tokens"
+            f"（省下 {stats['saved_tokens']}，{stats['saved_ratio']:.1%}），chunk {self.raw_chunks} → {self.packed_chunks}"
+            f"（預算 {CONTEXT_TOKEN_BUDGET or '不限'}，句子刪減 {'開' if CONTEXT_TRIM_SENTENCES else '關'}）"
+        )
+
+    def reset(self):
+        self.queries = 0
+        self.raw_tokens = 0
+        self.packed_tokens = 0
+        self.raw_chunks = 0
+        self.packed_chunks = 0
+
+
+context_stats = ContextStats()
+
+
+def assemble_context(candidates, query_texts, budget=CONTEXT_TOKEN_BUDGET, trim=CONTEXT_TRIM_SENTENCES):
+    """
+    將檢索候選 chunk 組成背景資訊：
+      1. 依分數排序（距離越近越高，被多個查詢命中再加分），去除內容重複或被包含的 chunk
+      2. 可選擇刪去與問題無關的句子
+      3. 依序放入 token 預算，放不下的跳過、繼續嘗試較短的 chunk
+    candidates 為 {"text", "distance", "hits", "metadata"} 的清單；
+    回傳 (選入的候選清單, 合併後文字)，並記錄節省的 token 數。
+    """
+    def score(candidate):
+        distance = candidate.get("distance")
+        similarity = 1.0 / (1.0 + distance) if distance is not None else 0.0
+        return similarity + MULTI_HIT_BONUS * (candidate.get("hits", 1) - 1)
+
+    ranked = sorted(candidates, key=score, reverse=True)
+    raw_tokens = count_tokens("\n".join(c["text"] for c in candidates)) if candidates else 0
+
+    query_terms = set()
+    for text in query_texts:
+        query_terms |= terms(text)
+
+    selected, seen_texts, used = [], [], 0
+    for candidate in ranked:
+        normalized = normalize_for_dedup(candidate["text"])
+        if any(normalized in seen or seen in normalized for seen in seen_texts):
+            continue
+        text = trim_sentences(candidate["text"], query_terms) if trim else candidate["text"]
+        tokens = count_tokens(text)
+        if budget and used + tokens > budget:
+            if used and budget - used < MIN_FILL_TOKENS:
+                break
+            continue
+        seen_texts.append(normalized)
+        selected.append({**candidate, "text": text})
+        used += tokens
+
+    merged = "\n".join(c["text"] for c in selected)
+    context_stats.record(raw_tokens, count_tokens(merged) if merged else 0, len(candidates), len(selected))
+    return selected, merged
@@ -0,0 +1,487 @@
+import os
+import re
+import json
+import zlib
+import sqlite3
+import threading
+import unicodedata
+from contextlib import contextmanager
+from collections import defaultdict
+import numpy as np
+
+from retrieval_cache import bump_generation
+from collection_alias import current_generation, LEGACY_GENERATION
+from numpy_store import match_where
+
+# 近似重複 chunk 偵測設定，可透過環境變數調整
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "true").lower() == "true"
+# 去重索引存於 SQLite；舊版的 dedup_index.json 會在第一次開啟時匯入
+DEDUP_INDEX_FILE = os.getenv("DEDUP_INDEX_FILE", "dedup_index.sqlite")
+# 估計 Jaccard 相似度達到門檻才視為重複
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", "0.85"))
+# MinHash 排列數 = LSH bands × rows；16 × 8 時候選門檻約為 (1/16)^(1/8) ≈ 0.71
+DEDUP_BANDS = int(os.getenv("DEDUP_BANDS", "16"))
+DEDUP_ROWS = int(os.getenv("DEDUP_ROWS", "8"))
+# 以字元 n-gram 當作 shingle，中英文都適用
+DEDUP_SHINGLE_SIZE = int(os.getenv("DEDUP_SHINGLE_SIZE", "5"))
+
+# 2^31 - 1 的 Mersenne 質數，(a * x + b) 在 uint64 內不會溢位
+_PRIME = (1 << 31) - 1
+# SQLite 單一查詢可帶入的參數數量上限（保守值）
+_SQL_BATCH = 900
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS chunks (id TEXT PRIMARY KEY, file_name TEXT, signature BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS refs (dup_id TEXT PRIMARY KEY, canonical_id TEXT NOT NULL, file_name TEXT, metadata TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS refs_file_name ON refs (file_name);
+CREATE INDEX IF NOT EXISTS refs_canonical_id ON refs (canonical_id);
+"""
+
+
+def normalize_text(text):
+    text = unicodedata.normalize("NFKC", text).lower()
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def where_file_names(where):
+    """
+    where 條件限定的檔名集合（file_name 等值、$eq、$in，以及 $and / $or 組合），
+    沒有限定檔名時回傳 None；只用來縮小候選，結果仍需以 match_where 過濾。
+    """
+    if not isinstance(where, dict):
+        return None
+    for key, value in where.items():
+        if key == "$and":
+            for clause in value:
+                names = where_file_names(clause)
+                if names is not None:
+                    return names
+        elif key == "$or":
+            parts = [where_file_names(clause) for clause in value]
+            if parts and all(part is not None for part in parts):
+                return set().union(*parts)
+        elif key == "file_name":
+            if not isinstance(value, dict):
+                return {value}
+            if "$eq" in value:
+                return {value["$eq"]}
+            if "$in" in value:
+                return set(value["$in"])
+    return None
+
+
+def shingles(text, size=DEDUP_SHINGLE_SIZE):
+    text = normalize_text(text)
+    if len(text) <= size:
+        return {text}
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+class DedupIndex:
+    """
+    以 MinHash + LSH 維護文字 chunk 的近似重複索引：
+      - 第一次出現的內容為 canonical，實際寫入向量庫並計算 Embedding
+      - 之後出現的近似重複 chunk 不寫入向量庫，只記錄為 canonical 的 back-reference
+      - 刪除 canonical 時，若仍有 back-reference，將第一筆升格為新的 canonical（沿用既有向量，不重新 Embedding）
+    重複 chunk 的 metadata（檔名、頁碼）只存在 back-reference 中，限定文件範圍的檢索與摘要向量
+    透過 reference_chunks 以 canonical 的內容與向量展開，仍能找到這些 chunk。
+
+    索引存於 SQLite，每次新增 / 刪除只寫入變動的列；寫入以 BEGIN IMMEDIATE 取得寫入鎖，
+    開始前若其他 process 寫入過（data_version 改變）就重新載入 signature，多個寫入端不會互相覆蓋。
+    back-reference 依 file_name 建索引，限定文件的查詢只讀取該檔案的列。
+    signature 與 LSH bucket 只在寫入端需要比對時才載入記憶體，只查詢 back-reference 的 process 不會載入。
+    """
+
+    def __init__(self, path=DEDUP_INDEX_FILE, threshold=DEDUP_THRESHOLD, bands=DEDUP_BANDS, rows=DEDUP_ROWS):
+        self.path = path
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = rows
+        num_perm = bands * rows
+        rng = np.random.default_rng(1)
+        self._a = rng.integers(1, _PRIME, num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, _PRIME, num_perm, dtype=np.uint64)
+        # canonical_id -> signature（uint32 陣列），延遲載入
+        self._signatures = None
+        self.buckets = defaultdict(set)
+        self._data_version = None
+        # 寫入與查詢各用一條連線：寫入交易期間（可能包含向量庫的升格寫入）查詢仍可讀取已提交的資料
+        self._write_conn = None
+        self._read_conn = None
+        self._write_lock = threading.RLock()
+        self._read_lock = threading.Lock()
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_SCHEMA)
+        return conn
+
+    def _writer(self):
+        if self._write_conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._write_conn = self._open()
+            with self.transaction() as conn:
+                self._init_meta(conn)
+        return self._write_conn
+
+    def _reader(self):
+        if self._read_conn is None:
+            self._writer()
+            self._read_conn = self._open()
+        return self._read_conn
+
+    def _init_meta(self, conn):
+        """新的索引記錄 LSH 參數（有舊版 JSON 時一併匯入）；參數與既有索引不同時清空重建"""
+        meta = dict(conn.execute("SELECT key, value FROM meta").fetchall())
+        if not meta:
+            conn.executemany("INSERT INTO meta (key, value) VALUES (?, ?)",
+                             [("bands", self.bands), ("rows", self.rows), ("embeddings_avoided", 0)])
+            legacy_path = f"{os.path.splitext(self.path)[0]}.json"
+            if os.path.exists(legacy_path):
+                self._import_json(conn, legacy_path)
+        elif meta.get("bands") != self.bands or meta.get("rows") != self.rows:
+            print("[WARNING] 去重索引的 LSH 參數已變更，將重新建立索引")
+            conn.execute("DELETE FROM chunks")
+            conn.execute("DELETE FROM refs")
+            conn.executemany("UPDATE meta SET value = ? WHERE key = ?",
+                             [(self.bands, "bands"), (self.rows, "rows"), (0, "embeddings_avoided")])
+            self._signatures = None
+
+    def _import_json(self, conn, json_path):
+        """匯入舊版（整份 JSON）的去重索引"""
+        with open(json_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("bands") != self.bands or data.get("rows") != self.rows:
+            print(f"[WARNING] {json_path} 的 LSH 參數與目前設定不同，不匯入")
+            return
+        chunks = data.get("chunks", {})
+        conn.executemany(
+            "INSERT OR REPLACE INTO chunks (id, file_name, signature) VALUES (?, ?, ?)",
+            [(cid, e.get("file_name"), np.asarray(e["signature"], dtype=np.uint32).tobytes()) for cid, e in chunks.items()],
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO refs (dup_id, canonical_id, file_name, metadata) VALUES (?, ?, ?, ?)",
+            [(dup_id, cid, m.get("file_name"), json.dumps(m, ensure_ascii=False))
+             for cid, e in chunks.items() for dup_id, m in e["refs"].items()],
+        )
+        conn.execute("UPDATE meta SET value = ? WHERE key = 'embeddings_avoided'", (data.get("embeddings_avoided", 0),))
+        print(f"[INFO] 已匯入舊版去重索引 {json_path}：{len(chunks)} 筆 canonical")
+
+    @contextmanager
+    def transaction(self):
+        """寫入交易：取得 SQLite 寫入鎖，並確認記憶體中的 signature 與其他 process 的寫入一致"""
+        with self._write_lock:
+            conn = self._writer()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                version = conn.execute("PRAGMA data_version").fetchone()[0]
+                if version != self._data_version:
+                    # 其他 process 寫入過：下次比對前重新載入
+                    self._signatures = None
+                    self._data_version = version
+                yield conn
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                self._signatures = None
+                raise
+
+    def _load_signatures(self, conn):
+        if self._signatures is not None:
+            return
+        self._signatures = {}
+        self.buckets = defaultdict(set)
+        for chunk_id, blob in conn.execute("SELECT id, signature FROM chunks"):
+            signature = np.frombuffer(blob, dtype=np.uint32)
+            self._signatures[chunk_id] = signature
+            self._index_buckets(chunk_id, signature)
+
+    def signature(self, text):
+        hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingles(text)), dtype=np.uint64)
+        hashes %= np.uint64(_PRIME)
+        # 每個排列 (a * x + b) mod p 取最小值
+        return ((np.outer(hashes, self._a) + self._b) % np.uint64(_PRIME)).min(axis=0).astype(np.uint32)
+
+    def _band_keys(self, signature):
+        for band in range(self.bands):
+            yield band, signature[band * self.rows:(band + 1) * self.rows].tobytes()
+
+    def _index_buckets(self, canonical_id, signature):
+        for key in self._band_keys(signature):
+            self.buckets[key].add(canonical_id)
+
+    def _unindex_buckets(self, canonical_id, signature):
+        for key in self._band_keys(signature):
+            self.buckets[key].discard(canonical_id)
+            if not self.buckets[key]:
+                del self.buckets[key]
+
+    def find_duplicate(self, signature):
+        """回傳估計相似度達門檻的 canonical id，沒有則回傳 None（需在 transaction 內呼叫）"""
+        candidates = set()
+        for key in self._band_keys(signature):
+            candidates.update(self.buckets.get(key, ()))
+        best_id, best_score = None, self.threshold
+        for canonical_id in candidates:
+            score = float(np.mean(self._signatures[canonical_id] == signature))
+            if score >= best_score:
+                best_id, best_score = canonical_id, score
+        return best_id
+
+    def _add_canonical(self, conn, chunk_id, signature, file_name):
+        conn.execute("INSERT OR REPLACE INTO chunks (id, file_name, signature) VALUES (?, ?, ?)",
+                     (chunk_id, file_name, signature.tobytes()))
+        self._signatures[chunk_id] = signature
+        self._index_buckets(chunk_id, signature)
+
+    @staticmethod
+    def _add_reference(conn, canonical_id, chunk_id, metadata):
+        conn.execute(
+            "INSERT OR REPLACE INTO refs (dup_id, canonical_id, file_name, metadata) VALUES (?, ?, ?, ?)",
+            (chunk_id, canonical_id, metadata.get("file_name"), json.dumps(metadata, ensure_ascii=False)),
+        )
+
+    def filter_new_chunks(self, ids, documents, metadatas):
+        """
+        將待寫入的 chunk 分成 canonical（需寫入向量庫）與重複（只記 back-reference），
+        回傳需寫入的 (ids, documents, metadatas) 與本次略過的筆數。
+        """
+        # signature 的計算不需持有寫入鎖
+        signatures = [self.signature(document) for document in documents]
+        kept_ids, kept_documents, kept_metadatas = [], [], []
+        duplicates = 0
+        with self.transaction() as conn:
+            self._load_signatures(conn)
+            for chunk_id, document, metadata, signature in zip(ids, documents, metadatas, signatures):
+                canonical_id = self.find_duplicate(signature)
+                if canonical_id is not None:
+                    self._add_reference(conn, canonical_id, chunk_id, metadata)
+                    duplicates += 1
+                    continue
+                # 同一批次中後面的重複也要能比對到前面的 chunk
+                self._add_canonical(conn, chunk_id, signature, metadata.get("file_name"))
+                kept_ids.append(chunk_id)
+                kept_documents.append(document)
+                kept_metadatas.append(metadata)
+            if duplicates:
+                conn.execute("UPDATE meta SET value = value + ? WHERE key = 'embeddings_avoided'", (duplicates,))
+        return kept_ids, kept_documents, kept_metadatas, duplicates
+
+    def _read(self, sql, params=()):
+        with self._read_lock:
+            return self._reader().execute(sql, params).fetchall()
+
+    def reference_ids_for_file(self, file_name):
+        """某檔案被記為重複（未寫入向量庫）的 chunk id"""
+        return {row[0] for row in self._read("SELECT dup_id FROM refs WHERE file_name = ?", (file_name,))}
+
+    def reference_file_names(self):
+        return {row[0] for row in self._read("SELECT DISTINCT file_name FROM refs WHERE file_name IS NOT NULL")}
+
+    def references_matching(self, where):
+        """metadata 符合 where 條件的重複 chunk，回傳 {canonical_id: [(dup_id, metadata), ...]}"""
+        names = where_file_names(where)
+        if names is None:
+            rows = self._read("SELECT dup_id, canonical_id, metadata FROM refs ORDER BY rowid")
+        else:
+            names = sorted(names, key=str)
+            rows = []
+            for start in range(0, len(names), _SQL_BATCH):
+                batch = names[start:start + _SQL_BATCH]
+                rows += self._read(
+                    f"SELECT dup_id, canonical_id, metadata FROM refs WHERE file_name IN ({','.join('?' * len(batch))}) ORDER BY rowid",
+                    batch,
+                )
+        matched = defaultdict(list)
+        for dup_id, canonical_id, metadata in rows:
+            metadata = json.loads(metadata)
+            if match_where(metadata, where):
+                matched[canonical_id].append((dup_id, metadata))
+        return matched
+
+    def references(self, chunk_id):
+        """canonical chunk 的 back-reference，回傳 {dup_id: metadata}"""
+        rows = self._read("SELECT dup_id, metadata FROM refs WHERE canonical_id = ? ORDER BY rowid", (chunk_id,))
+        return {dup_id: json.loads(metadata) for dup_id, metadata in rows}
+
+    @property
+    def embeddings_avoided(self):
+        return self._read("SELECT value FROM meta WHERE key = 'embeddings_avoided'")[0][0]
+
+    def remove(self, collection, chunk_ids):
+        """
+        從索引與向量庫移除 chunk：
+          - 重複 chunk：只移除 back-reference（向量庫中本來就沒有）
+          - 有 back-reference 的 canonical：把第一筆重複升格，以既有向量寫入新 id 後刪除舊 id
+          - 其他（包含索引建立前就存在的 chunk）：直接從向量庫刪除
+        """
+        to_delete, promoted, dropped_refs = [], 0, 0
+        with self.transaction() as conn:
+            self._load_signatures(conn)
+            for chunk_id in chunk_ids:
+                if conn.execute("DELETE FROM refs WHERE dup_id = ?", (chunk_id,)).rowcount:
+                    dropped_refs += 1
+                    continue
+                signature = self._signatures.pop(chunk_id, None)
+                to_delete.append(chunk_id)
+                if signature is None:
+                    continue
+                conn.execute("DELETE FROM chunks WHERE id = ?", (chunk_id,))
+                self._unindex_buckets(chunk_id, signature)
+                refs = conn.execute(
+                    "SELECT dup_id, metadata FROM refs WHERE canonical_id = ? ORDER BY rowid LIMIT 1", (chunk_id,)
+                ).fetchall()
+                if not refs:
+                    continue
+
+                new_id, metadata = refs[0][0], json.loads(refs[0][1])
+                stored = collection.get(ids=[chunk_id], include=["documents", "embeddings"])
+                if not stored["ids"]:
+                    # canonical 已不在向量庫中，無法沿用向量：移除其 back-reference，
+                    # 這些 chunk 之後同步所屬檔案時會被視為新 chunk 重新寫入
+                    dropped = conn.execute("DELETE FROM refs WHERE canonical_id = ?", (chunk_id,)).rowcount
+                    print(f"[WARN] canonical chunk {chunk_id} 已不在向量庫中，捨棄其 {dropped} 筆 back-reference")
+                    continue
+                collection.upsert(
+                    ids=[new_id],
+                    documents=stored["documents"],
+                    metadatas=[metadata],
+                    embeddings=stored["embeddings"],
+                )
+                conn.execute("DELETE FROM refs WHERE dup_id = ?", (new_id,))
+                conn.execute("UPDATE refs SET canonical_id = ? WHERE canonical_id = ?", (new_id, chunk_id))
+                self._add_canonical(conn, new_id, signature, metadata.get("file_name"))
+                promoted += 1
+
+            if to_delete:
+                collection.delete(ids=to_delete)
+        if to_delete:
+            print(f"[INFO] 從 '{collection.name}' 刪除 {len(to_delete)} 筆資料（升格重複 chunk {promoted} 筆）")
+        if to_delete or dropped_refs:
+            # back-reference 也會出現在限定文件範圍的檢索結果中
+            bump_generation(collection)
+
+    def backup(self, dest_path):
+        """以 SQLite backup 複製一份一致的索引（包含尚未寫回主檔的 WAL 內容）"""
+        target = sqlite3.connect(dest_path)
+        try:
+            with self._read_lock:
+                self._reader().backup(target)
+        finally:
+            target.close()
+
+    def close(self):
+        for conn in (self._read_conn, self._write_conn):
+            if conn is not None:
+                conn.close()
+        self._read_conn = self._write_conn = None
+
+    def report(self, collection=None):
+        duplicates = self._read("SELECT COUNT(*) FROM refs")[0][0]
+        stored = collection.count() if collection is not None else self._read("SELECT COUNT(*) FROM chunks")[0][0]
+        logical = stored + duplicates
+        shrink = duplicates / logical if logical else 0.0
+        print(
+            f"[INFO] 近似重複 chunk：目前 {duplicates} 筆以 back-reference 保存，"
+            f"向量庫 {stored} 筆 / 原始 {logical} 筆（縮減 {shrink:.1%}），"
+            f"累計省下 {self.embeddings_avoided} 次 Embedding"
+        )
+
+
+def generation_of(collection_name):
+    """由版本化的集合名稱（例如 rag_text_collection__g20260101120000）取得世代"""
+    match = re.search(r"__(g\d+)", collection_name)
+    return match.group(1) if match else LEGACY_GENERATION
+
+
+def dedup_index_path(generation=None):
+    """每個集合世代各有一份去重索引，重建時不會動到線上世代的索引"""
+    if generation is None:
+        generation = current_generation()
+    if not generation:
+        return DEDUP_INDEX_FILE
+    root, ext = os.path.splitext(DEDUP_INDEX_FILE)
+    return f"{root}.{generation}{ext}"
+
+
+_dedup_indexes = {}
+
+
+def get_dedup_index(path=None):
+    """同一個索引檔在 process 內共用一個實例；其他 process 的寫入由 SQLite 同步，不需重新建立"""
+    path = path or dedup_index_path()
+    index = _dedup_indexes.get(path)
+    if index is None:
+        index = _dedup_indexes[path] = DedupIndex(path=path)
+    return index
+
+
+def copy_dedup_index(src_path, dest_path):
+    """複製去重索引（匯出 / 匯入快照）；來源為舊版 JSON 時轉成 SQLite"""
+    remove_dedup_index(dest_path)
+    if src_path.endswith(".json"):
+        index = DedupIndex(path=dest_path)
+        with index.transaction() as conn:
+            conn.execute("DELETE FROM chunks")
+            conn.execute("DELETE FROM refs")
+            index._import_json(conn, src_path)
+        index.close()
+        return
+    index = DedupIndex(path=src_path)
+    index.backup(dest_path)
+    index.close()
+
+
+def remove_dedup_index(path):
+    """刪除索引檔（含 WAL），並丟掉快取的實例"""
+    index = _dedup_indexes.pop(path, None)
+    if index is not None:
+        index.close()
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def dedup_index_exists(path):
+    """索引檔存在，或有尚未匯入的舊版 JSON（第一次開啟時匯入）"""
+    return os.path.exists(path) or os.path.exists(f"{os.path.splitext(path)[0]}.json")
+
+
+def _collection_index(collection):
+    path = dedup_index_path(generation_of(collection.name))
+    return get_dedup_index(path) if DEDUP_ENABLED and dedup_index_exists(path) else None
+
+
+def reference_file_names(collection):
+    """在去重索引中有重複 chunk 的檔名（這些檔案可能沒有任何 chunk 寫入向量庫）"""
+    dedup = _collection_index(collection)
+    if dedup is None:
+        return set()
+    return dedup.reference_file_names()
+
+
+def reference_chunks(collection, where):
+    """
+    展開符合 where 條件、但因近似重複只存在去重索引中的 chunk：
+    內容與向量取自 canonical chunk，id 與 metadata 為重複 chunk 本身的值。
+    回傳與 collection.get 相同格式的 dict（含 embeddings），沒有符合的 chunk 時各欄位為空清單。
+    """
+    result = {"ids": [], "documents": [], "metadatas": [], "embeddings": []}
+    dedup = _collection_index(collection) if where else None
+    if dedup is None:
+        return result
+    matched = dedup.references_matching(where)
+    if not matched:
+        return result
+    stored = collection.get(ids=list(matched), include=["documents", "embeddings"])
+    for canonical_id, document, embedding in zip(stored["ids"], stored["documents"], stored["embeddings"]):
+        for dup_id, metadata in matched[canonical_id]:
+            result["ids"].append(dup_id)
+            result["documents"].append(document)
+            result["metadatas"].append(metadata)
+            result["embeddings"].append(embedding)
+    return result
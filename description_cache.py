@@ -0,0 +1,53 @@
+import os
+import hashlib
+from diskcache import Cache
+import image_processor
+
+# 圖片描述快取設定，可透過環境變數調整
+DESCRIPTION_CACHE_ENABLED = os.getenv("DESCRIPTION_CACHE_ENABLED", "true").lower() == "true"
+DESCRIPTION_CACHE_DIR = os.getenv("DESCRIPTION_CACHE_DIR", "./cache/descriptions")
+# 磁碟容量上限（bytes），超過時以 LRU 淘汰
+DESCRIPTION_CACHE_SIZE_LIMIT = int(os.getenv("DESCRIPTION_CACHE_SIZE_LIMIT", str(256 * 1024 * 1024)))
+
+_cache = None
+
+
+def get_cache():
+    """延遲建立 diskcache，使用 least-recently-used 淘汰策略"""
+    global _cache
+    if _cache is None:
+        os.makedirs(DESCRIPTION_CACHE_DIR, exist_ok=True)
+        _cache = Cache(
+            DESCRIPTION_CACHE_DIR,
+            eviction_policy="least-recently-used",
+            size_limit=DESCRIPTION_CACHE_SIZE_LIMIT,
+        )
+    return _cache
+
+
+def make_key(image_bytes, mime_type, detail, content_key=None):
+    """
+    有 content_key（PDF 頁面內容 hash，見 pdf_chunker.page_content_digest）時以它為 key，
+    不受渲染倍率與編碼設定影響；否則以圖片 bytes 的 hash 為 key，不同格式或 detail 分開快取
+    """
+    if content_key:
+        return content_key
+    return f"{mime_type}:{detail or ''}:{hashlib.sha256(image_bytes).hexdigest()}"
+
+
+def describe_image(image_bytes, mime_type="image/png", detail=None, content_key=None):
+    """
+    VLM 描述的輸出不固定，同一張圖每次描述都不同。以圖片內容快取描述：
+    重新匯入時未改變的圖片沿用同一段描述，合併描述後的文字 chunk 內容 hash 也就不變，
+    不必再付一次 VLM 呼叫與 Embedding。只快取非空的描述，失敗的呼叫下次仍會重試。
+    """
+    if not DESCRIPTION_CACHE_ENABLED:
+        return image_processor.describe_image_with_azure(image_bytes=image_bytes, mime_type=mime_type, detail=detail)
+    key = make_key(image_bytes, mime_type, detail, content_key)
+    description = get_cache().get(key)
+    if description is not None:
+        return description
+    description = image_processor.describe_image_with_azure(image_bytes=image_bytes, mime_type=mime_type, detail=detail)
+    if description:
+        get_cache().set(key, description)
+    return description
@@ -1,10 +1,13 @@
 import hashlib
 import os
 import json
+from layout_chunker import CHUNKER_VERSION
 
 # 載入環境變數
 RAG_RAW_FILE_PATH  = os.getenv('RAG_RAW_FILE_PATH')
 HASH_DB_FILE = "file_hashes.json"
+# 需要追蹤變動的原始檔案類型
+SUPPORTED_EXTENSIONS = (".pdf", ".doc", ".docx")
 
 def calculate_file_hash(file_path):
     """計算檔案的 SHA-256 哈希值"""
@@ -14,6 +17,13 @@ def calculate_file_hash(file_path):
             hasher.update(chunk)
     return hasher.hexdigest()
 
+def file_record(file_path):
+    """
+    檔案的紀錄值：內容哈希加上分塊版本。
+    分塊設定或邏輯改變後紀錄不再相符，內容沒變的檔案也會重新分塊；舊格式（只有哈希）同樣視為過期。
+    """
+    return f"{calculate_file_hash(file_path)}@{CHUNKER_VERSION}"
+
 def normalize_path(file_path):
     """統一使用 `/` 作為路徑分隔符"""
     return file_path.replace("\\", "/")
@@ -42,12 +52,12 @@ def check_for_changes(directory):
 
     for root, _, files in os.walk(directory):
         for file in files:
-             if file.endswith((".pdf", ".doc", ".docx")):  # 檢查 PDF, DOC 和 DOCX
+             if file.endswith(SUPPORTED_EXTENSIONS):  # 檢查 PDF, DOC 和 DOCX
                 file_path = normalize_path(os.path.join(root, file)) 
-                file_hash = calculate_file_hash(file_path)
+                file_hash = file_record(file_path)
                 current_hashes[file_path] = file_hash
 
-                # 如果檔案是新的或哈希值變更，則標記為變更
+                # 如果檔案是新的、哈希值變更或分塊版本不同，則標記為變更
                 if file_path not in previous_hashes or previous_hashes[file_path] != file_hash:
                     changed_files.append(file_path)
 
@@ -68,6 +78,34 @@ def check_for_changes(directory):
 
     return changed_files, list(deleted_files)
 
+def check_paths_for_changes(paths):
+    """
+    只檢查指定的檔案（例如檔案監控事件回報的路徑），不掃描整個資料夾。
+    存在且哈希值改變者視為變更，已不存在但有舊紀錄者視為刪除，並只更新這些檔案的紀錄。
+    """
+    hashes = load_previous_hashes()
+    changed_files = []
+    deleted_files = []
+
+    for file_path in dict.fromkeys(normalize_path(p) for p in paths):
+        if not file_path.endswith(SUPPORTED_EXTENSIONS):
+            continue
+        if os.path.isfile(file_path):
+            file_hash = file_record(file_path)
+            if hashes.get(file_path) != file_hash:
+                changed_files.append(file_path)
+                hashes[file_path] = file_hash
+        elif file_path in hashes:
+            deleted_files.append(file_path)
+            del hashes[file_path]
+
+    if changed_files or deleted_files:
+        save_current_hashes(hashes)
+        print("有變更的檔案:", changed_files)
+        if deleted_files:
+            print("已刪除的檔案:", deleted_files)
+    return changed_files, deleted_files
+
 def clear_hash_records():
     """清除所有紀錄並重新檢查變動的檔案"""
     if os.path.exists(HASH_DB_FILE):
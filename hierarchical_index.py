@@ -0,0 +1,194 @@
+import os
+import argparse
+from collections import defaultdict
+import numpy as np
+
+from vector_db import init_chroma_client, init_collections, load_hnsw_config, TEXT_COLLECTION_NAME
+from retrieval_cache import bump_generation
+from scoped_retrieval import document_indexes, query_with_references
+from dedup_index import reference_chunks, reference_file_names
+
+# 階層式（粗到細）檢索設定，可透過環境變數調整
+# 文字檢索模式：flat（直接搜尋所有 chunk）或 hierarchical（先選文件與頁面，再搜尋其中的 chunk）
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "flat").lower()
+# 是否在匯入時維護文件 / 頁面摘要向量
+HIERARCHICAL_INDEX_ENABLED = os.getenv("HIERARCHICAL_INDEX_ENABLED", "true").lower() == "true"
+# 第一階段選出的文件數與（這些文件中的）頁面數
+HIER_TOP_DOCUMENTS = int(os.getenv("HIER_TOP_DOCUMENTS", "5"))
+HIER_TOP_PAGES = int(os.getenv("HIER_TOP_PAGES", "20"))
+
+SUMMARY_COLLECTION_NAME = "rag_summary_collection"
+LEVEL_DOCUMENT = "document"
+LEVEL_PAGE = "page"
+
+_client = None
+_summary_collections = {}
+
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = init_chroma_client()
+    return _client
+
+
+def summary_collection_name(text_collection):
+    """文字集合對應的摘要集合名稱，與文字集合同一世代（例如 rag_summary_collection__g20260101120000）"""
+    return text_collection.name.replace(TEXT_COLLECTION_NAME, SUMMARY_COLLECTION_NAME, 1)
+
+
+def get_summary_collection(text_collection, client=None):
+    """文字集合對應的摘要集合，不存在時建立"""
+    name = summary_collection_name(text_collection)
+    if name not in _summary_collections:
+        _summary_collections[name] = (client or get_client()).get_or_create_collection(
+            name=name,
+            metadata={"description": "PDF 文件 / 頁面摘要向量", **load_hnsw_config()},
+            embedding_function=None,
+        )
+    return _summary_collections[name]
+
+
+def forget_summary_collection(name):
+    """摘要集合被刪除後（例如 drop_generation）丟掉快取的集合物件，下次 get_summary_collection 重新取得"""
+    _summary_collections.pop(name, None)
+
+
+def mean_pool(vectors):
+    """平均後正規化；chunk 向量多為單位長度，摘要向量也維持單位長度才能與查詢向量直接比較距離"""
+    pooled = np.mean(np.asarray(vectors, dtype=np.float32), axis=0)
+    norm = np.linalg.norm(pooled)
+    return pooled / norm if norm > 0 else pooled
+
+
+def summary_records(file_name, embeddings, metadatas):
+    """由一份文件的 chunk 向量產生文件層與頁面層的摘要向量，回傳 (ids, embeddings, metadatas)"""
+    pages = defaultdict(list)
+    for vector, metadata in zip(embeddings, metadatas):
+        pages[metadata.get("page")].append(vector)
+    ids = [f"{file_name}::doc"]
+    vectors = [mean_pool(embeddings)]
+    records = [{"level": LEVEL_DOCUMENT, "file_name": file_name, "chunks": len(embeddings)}]
+    for page, page_vectors in sorted(pages.items(), key=lambda item: (item[0] is None, item[0])):
+        ids.append(f"{file_name}::page{page}")
+        vectors.append(mean_pool(page_vectors))
+        records.append({"level": LEVEL_PAGE, "file_name": file_name, "page": page, "chunks": len(page_vectors)})
+    return ids, vectors, records
+
+
+def update_summaries(text_collection, changed_files=(), deleted_files=()):
+    """
+    重新計算指定文件的摘要向量（以 chunk 向量平均，不需額外 Embedding 或 LLM 呼叫），
+    並移除已刪除文件的摘要。file 參數皆為 PDF 檔名。
+    因近似重複只存在去重索引中的 chunk 以 canonical 的向量計入，文件的摘要才不會缺頁。
+    """
+    summary = get_summary_collection(text_collection)
+    written = 0
+    for file_name in list(deleted_files) + list(changed_files):
+        summary.delete(where={"file_name": file_name})
+    for file_name in changed_files:
+        stored = text_collection.get(where={"file_name": file_name}, include=["embeddings", "metadatas"])
+        references = reference_chunks(text_collection, {"file_name": file_name})
+        embeddings = (list(stored["embeddings"]) if len(stored["ids"]) else []) + references["embeddings"]
+        if not embeddings:
+            continue
+        ids, vectors, records = summary_records(file_name, embeddings, list(stored["metadatas"]) + references["metadatas"])
+        summary.upsert(ids=ids, embeddings=np.asarray(vectors), metadatas=records)
+        written += len(ids)
+    if changed_files or deleted_files:
+        bump_generation(summary)
+        print(f"[INFO] 摘要向量：更新 {len(changed_files)} 份文件（{written} 筆），移除 {len(deleted_files)} 份")
+
+
+def rebuild_all_summaries(text_collection):
+    """依文字集合現有資料重建所有文件的摘要向量（舊資料首次啟用階層檢索時使用）"""
+    file_names = set()
+    offset = 0
+    while True:
+        page = text_collection.get(limit=1000, offset=offset, include=["metadatas"])
+        if not page["ids"]:
+            break
+        file_names.update(m.get("file_name") for m in page["metadatas"] if m.get("file_name"))
+        offset += len(page["ids"])
+    file_names |= reference_file_names(text_collection)
+    update_summaries(text_collection, sorted(file_names))
+
+
+def _level_filter(level, file_names=None):
+    if not file_names:
+        return {"level": level}
+    names = sorted(file_names)
+    return {"$and": [{"level": level}, {"file_name": names[0]} if len(names) == 1 else {"file_name": {"$in": names}}]}
+
+
+def select_pages(summary, query_embedding, top_documents=HIER_TOP_DOCUMENTS, top_pages=HIER_TOP_PAGES):
+    """第一階段：先選最接近的文件，再在這些文件中選最接近的頁面，回傳 {file_name: {page, ...}}"""
+    documents = summary.query(query_embeddings=[query_embedding], n_results=top_documents,
+                              where=_level_filter(LEVEL_DOCUMENT), include=["metadatas"])
+    file_names = {m["file_name"] for m in documents["metadatas"][0]}
+    if not file_names:
+        return {}
+    pages = summary.query(query_embeddings=[query_embedding], n_results=top_pages,
+                          where=_level_filter(LEVEL_PAGE, file_names), include=["metadatas"])
+    selected = defaultdict(set)
+    for metadata in pages["metadatas"][0]:
+        selected[metadata["file_name"]].add(metadata.get("page"))
+    return selected
+
+
+def _page_filter(file_name, pages):
+    page_values = sorted(p for p in pages if p is not None)
+    if not page_values:
+        return {"file_name": file_name}
+    return {"$and": [{"file_name": file_name}, {"page": {"$in": page_values}}]}
+
+
+def hierarchical_search(text_collection, query_embeddings, n_results, top_documents=HIER_TOP_DOCUMENTS, top_pages=HIER_TOP_PAGES):
+    """
+    粗到細檢索，回傳與 collection.query 相同格式的結果：
+      1. 在摘要集合中選出前 top_documents 份文件，再選出其中前 top_pages 個頁面
+      2. 只在這些頁面的 chunk 中搜尋：所有選中頁面合成一個 where 條件交給向量庫過濾查詢，
+         只讀取選中頁面的 chunk，不為每份文件載入整份子索引；
+         文件子索引已因限定文件的查詢而在快取中時，直接在子索引中精確搜尋
+    摘要集合為空（尚未建立）時退回整個集合的搜尋。
+    """
+    summary = get_summary_collection(text_collection)
+    if summary.count() == 0:
+        print("[WARN] 摘要集合為空，改用 flat 檢索（可執行 python hierarchical_index.py build 建立）")
+        return text_collection.query(query_embeddings=query_embeddings, n_results=n_results)
+
+    result = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+    for query_embedding in query_embeddings:
+        parts, filters = [], []
+        for file_name, pages in select_pages(summary, query_embedding, top_documents, top_pages).items():
+            index = document_indexes.peek(text_collection, {"file_name": file_name})
+            if index is None:
+                filters.append(_page_filter(file_name, pages))
+            else:
+                rows = [i for i, metadata in enumerate(index.metadatas) if metadata.get("page") in pages]
+                parts.append(index.search([query_embedding], n_results, rows=rows))
+        if filters:
+            where = filters[0] if len(filters) == 1 else {"$or": filters}
+            parts.append(query_with_references(text_collection, [query_embedding], n_results, where))
+        candidates = [
+            tuple(part[key][0][rank] for key in ("distances", "ids", "documents", "metadatas"))
+            for part in parts
+            for rank in range(len(part["ids"][0]))
+        ]
+        candidates.sort(key=lambda item: item[0])
+        top = candidates[:n_results]
+        result["distances"].append([c[0] for c in top])
+        result["ids"].append([c[1] for c in top])
+        result["documents"].append([c[2] for c in top])
+        result["metadatas"].append([c[3] for c in top])
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="文件 / 頁面摘要向量（階層式檢索）")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("build", help="依目前世代的文字集合重建所有摘要向量")
+    args = parser.parse_args()
+
+    text_collection, _ = init_collections(get_client())
+    rebuild_all_summaries(text_collection)
@@ -0,0 +1,184 @@
+import os
+import math
+import fitz  # PyMuPDF
+from memory_budget import memory_budget, fit_zoom
+
+# 圖片送往 VLM（GPT-4o）時的 payload 策略，可透過環境變數調整
+# 最長邊像素上限（GPT-4o high detail 會先縮到 2048 內，再把短邊縮到 768，超過的像素只會浪費上傳頻寬）
+IMAGE_MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", "1536"))
+# 512x512 tile 數量上限（0 表示不限制，只看 IMAGE_MAX_DIMENSION）
+IMAGE_TILE_BUDGET = int(os.getenv("IMAGE_TILE_BUDGET", "0"))
+# 編碼格式：jpeg / webp / png
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "jpeg").lower()
+# JPEG / WebP 壓縮品質（1-100）
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "80"))
+# GPT-4o 的 detail 參數：low / high / auto
+IMAGE_DETAIL = os.getenv("IMAGE_DETAIL", "high").lower()
+# 舊版固定的渲染倍率，用來估算節省量
+BASELINE_ZOOM = 3
+# 與舊版 3 倍 PNG 比較節省 bytes 的方式（預設 off，每次執行仍會回報不需額外計算的像素數與 token 節省量）：
+#   estimate：把已渲染的 pixmap 再編成一次 PNG，依邊長比例換算成 3 倍的大小（不另外渲染，但每頁多一次 PNG 編碼；
+#             換算比例只在少量抽樣頁面上比對過，數字僅供參考）
+#   measure：實際再渲染一次 3 倍 PNG 量測（準確，但每頁多一次大尺寸渲染與編碼）
+#   off：不比較 bytes
+# 舊的 IMAGE_MEASURE_BASELINE=true 等同 measure
+IMAGE_BASELINE_MODE = os.getenv(
+    "IMAGE_BASELINE_MODE",
+    "measure" if os.getenv("IMAGE_MEASURE_BASELINE", "false").lower() == "true" else "off",
+).lower()
+
+MIME_TYPES = {
+    "jpeg": "image/jpeg",
+    "jpg": "image/jpeg",
+    "webp": "image/webp",
+    "png": "image/png",
+}
+
+
+def estimate_image_tokens(width, height, detail=IMAGE_DETAIL):
+    """
+    依照 GPT-4o 的計價規則估算一張圖片的 token 數：
+      - low：固定 85 tokens
+      - high/auto：縮到 2048x2048 內，短邊再縮到 768，每個 512x512 tile 170 tokens，另加 85
+    """
+    if detail == "low":
+        return 85
+    if width <= 0 or height <= 0:
+        return 0
+    scale = min(1.0, 2048 / max(width, height))
+    w, h = width * scale, height * scale
+    scale = min(1.0, 768 / min(w, h))
+    w, h = w * scale, h * scale
+    tiles = math.ceil(w / 512) * math.ceil(h / 512)
+    return 170 * tiles + 85
+
+
+def _tiles_for(width, height):
+    """計算縮放後的 512x512 tile 數量（與 estimate_image_tokens 使用相同的縮放規則）"""
+    return (estimate_image_tokens(width, height, detail="high") - 85) // 170
+
+
+def compute_zoom(page_width, page_height, max_dimension=IMAGE_MAX_DIMENSION, tile_budget=IMAGE_TILE_BUDGET):
+    """
+    根據頁面大小（PDF point）計算渲染倍率，
+    讓最長邊不超過 max_dimension，且 tile 數不超過 tile_budget，並且不超過舊版的 3 倍。
+    """
+    longest = max(page_width, page_height)
+    if longest <= 0:
+        return BASELINE_ZOOM
+    zoom = min(BASELINE_ZOOM, max_dimension / longest) if max_dimension > 0 else BASELINE_ZOOM
+
+    if tile_budget > 0:
+        # tile 數隨倍率單調遞增，逐步縮小直到符合預算
+        while zoom > 0.25 and _tiles_for(page_width * zoom, page_height * zoom) > tile_budget:
+            zoom *= 0.9
+    return zoom
+
+
+def encode_pixmap(pix, image_format=IMAGE_FORMAT, quality=IMAGE_QUALITY):
+    """
+    直接從 PyMuPDF 的 pixmap 編碼成 bytes，不經過 PIL 轉存。
+    PyMuPDF 原生支援 PNG / JPEG；WebP 需要透過 pix.pil_tobytes。
+    回傳 (image_bytes, mime_type)
+    """
+    image_format = image_format.lower()
+    if image_format in ("jpeg", "jpg"):
+        return pix.tobytes("jpeg", jpg_quality=quality), MIME_TYPES["jpeg"]
+    if image_format == "webp":
+        return pix.pil_tobytes(format="WEBP", quality=quality), MIME_TYPES["webp"]
+    if image_format == "png":
+        return pix.tobytes("png"), MIME_TYPES["png"]
+    raise ValueError(f"不支援的圖片格式：{image_format}")
+
+
+class PayloadStats:
+    """累計每次執行送出的圖片 bytes 與 token，並與舊版 3 倍 PNG 比較節省量"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.images = 0
+        self.payload_bytes = 0
+        self.payload_tokens = 0
+        self.payload_pixels = 0
+        self.baseline_pixels = 0
+        self.baseline_tokens = 0
+        self.baseline_bytes = 0
+        self.measured_images = 0
+        self.estimated_images = 0
+        self.measured_payload_bytes = 0
+
+    def record(self, payload_bytes, width, height, baseline_width, baseline_height, detail=IMAGE_DETAIL, baseline_bytes=None,
+               baseline_estimated=False):
+        self.images += 1
+        self.payload_bytes += payload_bytes
+        self.payload_tokens += estimate_image_tokens(width, height, detail)
+        self.payload_pixels += width * height
+        self.baseline_pixels += int(baseline_width * baseline_height)
+        # 舊版沒有指定 detail，預設等同 auto（以 high 規則計算）
+        self.baseline_tokens += estimate_image_tokens(baseline_width, baseline_height, "high")
+        if baseline_bytes is not None:
+            self.baseline_bytes += baseline_bytes
+            if baseline_estimated:
+                self.estimated_images += 1
+            else:
+                self.measured_images += 1
+            self.measured_payload_bytes += payload_bytes
+
+    def report(self):
+        if not self.images:
+            print("[INFO] 本次執行未送出任何圖片")
+            return
+        saved_tokens = self.baseline_tokens - self.payload_tokens
+        print(
+            f"[INFO] 圖片 payload：{self.images} 張，共 {self.payload_bytes / 1024:.1f} KB，"
+            f"約 {self.payload_tokens} tokens（節省 {saved_tokens} tokens），"
+            f"像素數為 3 倍渲染的 {self.payload_pixels / max(self.baseline_pixels, 1):.0%}"
+        )
+        if self.measured_images or self.estimated_images:
+            saved_bytes = self.baseline_bytes - self.measured_payload_bytes
+            counts = "、".join(
+                f"{label} {count} 張"
+                for label, count in (("量測", self.measured_images), ("估算", self.estimated_images))
+                if count
+            )
+            print(f"[INFO] 與 3 倍 PNG 相比節省 {saved_bytes / 1024:.1f} KB（{counts}）")
+
+
+# 全域統計，process_pdf_changes 與 rag_query_pipeline 共用
+payload_stats = PayloadStats()
+
+
+def render_page_payload(page, image_format=IMAGE_FORMAT, quality=IMAGE_QUALITY, detail=IMAGE_DETAIL):
+    """
+    依照 payload 策略渲染一個 fitz.Page，回傳 (image_bytes, mime_type, detail) 並記錄統計。
+    """
+    rect = page.rect
+    zoom = compute_zoom(rect.width, rect.height)
+    pix = page.get_pixmap(matrix=memory_budget.render_matrix(rect, zoom), alpha=False)
+    memory_budget.record_pixmap(pix)
+    image_bytes, mime_type = encode_pixmap(pix, image_format, quality)
+    width, height = pix.width, pix.height
+
+    baseline_bytes = None
+    if IMAGE_BASELINE_MODE == "estimate" and width > 0:
+        png_bytes = len(image_bytes) if mime_type == MIME_TYPES["png"] else len(pix.tobytes("png"))
+        baseline_bytes = round(png_bytes * rect.width * BASELINE_ZOOM / width)
+    del pix
+
+    # 舊版 3 倍渲染超出記憶體預算的頁面（海報、大圖紙）不量測，避免為了統計而配置巨大的 pixmap
+    if IMAGE_BASELINE_MODE == "measure" and fit_zoom(rect, BASELINE_ZOOM) >= BASELINE_ZOOM:
+        baseline_bytes = len(page.get_pixmap(matrix=fitz.Matrix(BASELINE_ZOOM, BASELINE_ZOOM)).tobytes("png"))
+
+    payload_stats.record(
+        len(image_bytes),
+        width,
+        height,
+        rect.width * BASELINE_ZOOM,
+        rect.height * BASELINE_ZOOM,
+        detail=detail,
+        baseline_bytes=baseline_bytes,
+        baseline_estimated=IMAGE_BASELINE_MODE == "estimate",
+    )
+    return image_bytes, mime_type, detail
@@ -5,15 +5,30 @@ import sys
 import io
 import pytesseract
 from PIL import Image
+import os
+import threading
 import ollama
-import torch
-from transformers import CLIPProcessor, CLIPModel
-import torch.nn.functional as F
+import clip_onnx
 
-# 建議把 model 跟 processor 移到函式外，只 load 一次
-model_name = "openai/clip-vit-base-patch32"
-processor = CLIPProcessor.from_pretrained(model_name)
-model     = CLIPModel.from_pretrained(model_name)
+# CLIP 後端：torch（在本 process 載入 PyTorch 模型）或 onnx（int8 ONNX，由共用推論 worker 批次計算）
+CLIP_BACKEND = os.getenv("CLIP_BACKEND", "torch").lower()
+
+# PyTorch 模型只在 torch 後端第一次使用時載入，onnx 後端的 process 不會 import torch
+model_name = clip_onnx.CLIP_MODEL_NAME
+_torch_clip = None
+_torch_clip_lock = threading.Lock()
+
+
+def get_torch_clip():
+    global _torch_clip
+    with _torch_clip_lock:
+        if _torch_clip is None:
+            import torch
+            from transformers import CLIPProcessor, CLIPModel
+            # 與 onnx 後端使用相同的執行緒上限，平行匯入時不會超額分配 CPU
+            torch.set_num_threads(clip_onnx.CLIP_INTRA_OP_THREADS)
+            _torch_clip = (CLIPProcessor.from_pretrained(model_name), CLIPModel.from_pretrained(model_name))
+    return _torch_clip
 
 # 設定 Tesseract OCR 執行檔路徑
 pytesseract.pytesseract.tesseract_cmd = r"C:/Program Files/Tesseract-OCR/tesseract.exe"
@@ -53,23 +68,34 @@ def encode_image(image_path=None, image_bytes=None):
     
 
 
-def get_clip_cosine_score(image_bytes: bytes, text: str) -> float:
+def get_clip_cosine_scores(image_bytes: bytes, texts) -> list:
+    """計算一張圖片與多段文字的 cosine 相似度（值域 [-1,1]），圖片只編碼一次"""
+    texts = list(texts)
+    if not texts:
+        return []
+    if CLIP_BACKEND == "onnx":
+        return clip_onnx.clip_cosine_scores(image_bytes, texts)
+
+    import torch
+    processor, model = get_torch_clip()
     image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
 
     # 分別 encode image/text
     pixel_inputs = processor(images=image, return_tensors="pt")
-    text_inputs  = processor(text=[text], return_tensors="pt", padding=True, truncation=True, max_length=77)
+    text_inputs  = processor(text=texts, return_tensors="pt", padding=True, truncation=True, max_length=77)
 
     with torch.no_grad():
         img_feats = model.get_image_features(**pixel_inputs)   # [1, D]
-        txt_feats = model.get_text_features(**text_inputs)     # [1, D]
+        txt_feats = model.get_text_features(**text_inputs)     # [N, D]
 
-    # L2 正規化
+    # L2 正規化後內積即為 cosine 相似度
     img_norm = img_feats / img_feats.norm(dim=-1, keepdim=True)
     txt_norm = txt_feats / txt_feats.norm(dim=-1, keepdim=True)
+    return (txt_norm @ img_norm[0]).tolist()
+
 
-    # Cosine 相似度 (值域 [-1,1])
-    score = F.cosine_similarity(img_norm, txt_norm).item()
+def get_clip_cosine_score(image_bytes: bytes, text: str) -> float:
+    score = get_clip_cosine_scores(image_bytes, [text])[0]
     # 如果你想讓它落在 [0,1]，可以做 (score+1)/2
     return score
 
@@ -124,9 +150,10 @@ def describe_image_with_ollama(image_path=None, image_bytes=None):
         return ""
 
 # 使用 Azure Tool 進行圖片描述
-def describe_image_with_azure(image_path=None, image_bytes=None):
+def describe_image_with_azure(image_path=None, image_bytes=None, mime_type="image/png", detail=None):
     """
     使用 Azure Tool 分析圖片內容，並結合 OCR 文字來提供描述。
+    傳入 image_bytes 時可指定 mime_type（例如 JPEG / WebP payload）與 detail。
     """
     if (image_path and image_bytes) or (not image_path and not image_bytes):
         raise ValueError("必須提供 image_path 或 image_bytes ，且不能同時提供兩者")
@@ -154,7 +181,7 @@ def describe_image_with_azure(image_path=None, image_bytes=None):
         if image_path:
             response_text = generate_with_langchain(prompt_text, image_path=image_path)
         else:
-            response_text = generate_with_langchain(prompt_text, image_bytes=image_bytes)
+            response_text = generate_with_langchain(prompt_text, image_bytes=image_bytes, mime_type=mime_type, detail=detail)
         return response_text.strip()
 
     except Exception as e:
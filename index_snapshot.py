@@ -0,0 +1,273 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import numpy as np
+import pyarrow as pa
+
+import file_hashes
+from answer_cache import answer_cache
+from collection_alias import load_aliases, new_generation, versioned_name, swap_alias
+from dedup_index import dedup_index_path, dedup_index_exists, copy_dedup_index
+from hierarchical_index import get_summary_collection, rebuild_all_summaries, SUMMARY_COLLECTION_NAME, HIERARCHICAL_INDEX_ENABLED
+from rebuild_index import drop_generation
+from vector_db import (
+    init_chroma_client,
+    init_collections,
+    get_embedding_function,
+    collection_embedding_dim,
+    EMBEDDING_MODEL,
+    EMBEDDING_DIM,
+    EMBEDDING_DIM_KEY,
+    EXPORT_PAGE_SIZE,
+    TEXT_COLLECTION_NAME,
+    IMAGE_COLLECTION_NAME,
+)
+
+# 快照格式版本，格式不相容的變更時遞增
+SNAPSHOT_FORMAT_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+HASHES_FILE = "file_hashes.json"
+DEDUP_FILE = "dedup_index.sqlite"
+# 匯入時每批寫入 ChromaDB 的筆數（會再受 client.get_max_batch_size() 限制）
+IMPORT_BATCH_SIZE = int(os.getenv("SNAPSHOT_IMPORT_BATCH_SIZE", "5000"))
+
+
+def sha256_file(path):
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def snapshot_schema(dim):
+    return pa.schema([
+        ("id", pa.string()),
+        ("document", pa.string()),
+        ("metadata", pa.string()),
+        ("embedding", pa.list_(pa.float16(), dim)),
+    ])
+
+
+def export_collection_snapshot(collection, output_path, page_size=EXPORT_PAGE_SIZE):
+    """
+    將一個集合分頁寫成 Arrow IPC 檔（可 memory-map）：
+    id / document / metadata(JSON) / embedding(float16 固定長度)。回傳 (筆數, 向量維度)。
+    """
+    writer = None
+    total, dim, offset = 0, None, 0
+    try:
+        while True:
+            data = collection.get(limit=page_size, offset=offset, include=["documents", "metadatas", "embeddings"])
+            ids = data.get("ids", [])
+            if not ids:
+                break
+            vectors = np.asarray(data["embeddings"], dtype=np.float16)
+            if writer is None:
+                dim = vectors.shape[1]
+                writer = pa.ipc.new_file(output_path, snapshot_schema(dim))
+            table = pa.Table.from_arrays(
+                [
+                    pa.array(ids, pa.string()),
+                    pa.array(data.get("documents") or [None] * len(ids), pa.string()),
+                    pa.array([json.dumps(m, ensure_ascii=False) for m in (data.get("metadatas") or [{}] * len(ids))], pa.string()),
+                    pa.FixedSizeListArray.from_arrays(pa.array(vectors.reshape(-1), pa.float16()), dim),
+                ],
+                schema=snapshot_schema(dim),
+            )
+            writer.write_table(table)
+            total += len(ids)
+            offset += len(ids)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if writer is None:
+        # 空集合也寫出一個空檔，讓匯入端流程一致
+        with pa.ipc.new_file(output_path, snapshot_schema(0)):
+            pass
+        dim = 0
+    return total, dim
+
+
+def snapshot_collections(client):
+    """快照包含的集合：以不含世代後綴的名稱為 key，對應目前世代的文字、圖片與摘要集合"""
+    text_collection, image_collection = init_collections(client)
+    return {
+        TEXT_COLLECTION_NAME: text_collection,
+        IMAGE_COLLECTION_NAME: image_collection,
+        SUMMARY_COLLECTION_NAME: get_summary_collection(text_collection, client),
+    }
+
+
+def export_snapshot(snapshot_dir):
+    """
+    匯出文字、圖片、摘要（階層式檢索）三個集合，以及 file_hashes 紀錄與目前世代的去重索引到 snapshot_dir，
+    並寫入含 sha256 的 manifest
+    """
+    os.makedirs(snapshot_dir, exist_ok=True)
+    client = init_chroma_client()
+
+    manifest = {
+        "format_version": SNAPSHOT_FORMAT_VERSION,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "embedding_model": EMBEDDING_MODEL,
+        "embedding_dtype": "float16",
+        "collections": {},
+        "files": {},
+    }
+    # 以不含世代後綴的集合名稱當 key，快照可匯入任何世代
+    for name, collection in snapshot_collections(client).items():
+        file_name = f"{name}.arrow"
+        path = os.path.join(snapshot_dir, file_name)
+        count, dim = export_collection_snapshot(collection, path)
+        manifest["collections"][name] = {"file": file_name, "count": count, "dim": dim, "metadata": collection.metadata}
+        print(f"[INFO] 已匯出 '{collection.name}'：{count} 筆，維度 {dim}")
+
+    if os.path.exists(file_hashes.HASH_DB_FILE):
+        shutil.copy(file_hashes.HASH_DB_FILE, os.path.join(snapshot_dir, HASHES_FILE))
+    # 近似重複的 chunk 只存在去重索引中，少了它限定文件範圍的檢索會缺少這些 chunk
+    if dedup_index_exists(dedup_index_path()):
+        copy_dedup_index(dedup_index_path(), os.path.join(snapshot_dir, DEDUP_FILE))
+        manifest["dedup_index"] = DEDUP_FILE
+
+    for file_name in sorted(os.listdir(snapshot_dir)):
+        if file_name != MANIFEST_FILE:
+            manifest["files"][file_name] = sha256_file(os.path.join(snapshot_dir, file_name))
+
+    with open(os.path.join(snapshot_dir, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=4)
+    print(f"[INFO] 快照已輸出至 {snapshot_dir}")
+    return manifest
+
+
+def load_manifest(snapshot_dir):
+    """讀取 manifest 並檢查版本與所有檔案的 sha256"""
+    with open(os.path.join(snapshot_dir, MANIFEST_FILE), "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("format_version") != SNAPSHOT_FORMAT_VERSION:
+        raise ValueError(f"不支援的快照版本：{manifest.get('format_version')}（目前為 {SNAPSHOT_FORMAT_VERSION}）")
+    if manifest.get("embedding_model") != EMBEDDING_MODEL:
+        raise ValueError(f"快照的 Embedding 模型 {manifest.get('embedding_model')} 與目前設定 {EMBEDDING_MODEL} 不一致")
+    for file_name, expected in manifest["files"].items():
+        actual = sha256_file(os.path.join(snapshot_dir, file_name))
+        if actual != expected:
+            raise ValueError(f"快照檔案校驗失敗：{file_name}")
+    return manifest
+
+
+def create_generation_collections(client, generation, manifest):
+    """
+    在新世代建立快照中的集合，metadata 採用匯出端記錄的設定（hnsw:space、截斷維度等），
+    不套用本機目前的設定，向量與索引參數才會一致
+    """
+    collections = {}
+    for name, info in manifest["collections"].items():
+        metadata = info.get("metadata") or None
+        # 之後寫入的文件向量截斷到快照的維度（見 vector_db.init_collections）；摘要集合只有向量，不需要 embedding function
+        dim = int((metadata or {}).get(EMBEDDING_DIM_KEY, 0))
+        collections[name] = client.get_or_create_collection(
+            name=versioned_name(name, generation),
+            metadata=metadata,
+            embedding_function=None if name == SUMMARY_COLLECTION_NAME else get_embedding_function(dim),
+        )
+    snapshot_dim = collection_embedding_dim(collections[TEXT_COLLECTION_NAME])
+    if snapshot_dim != EMBEDDING_DIM:
+        print(
+            f"[WARN] 快照的截斷維度為 {snapshot_dim or '完整'}，與本機 EMBEDDING_DIM={EMBEDDING_DIM or '完整'} 不同；"
+            f"查詢與寫入沿用快照的維度，之後執行 python rebuild_index.py rebuild 才會套用本機設定"
+        )
+    return collections
+
+
+def load_collection_file(collection, path, dim, batch_size):
+    """以 memory-map 讀取快照檔，分批寫入集合"""
+    with pa.memory_map(path, "r") as source:
+        table = pa.ipc.open_file(source).read_all()
+        for batch in table.to_batches(max_chunksize=batch_size):
+            vectors = batch.column("embedding").flatten().to_numpy(zero_copy_only=False)
+            vectors = vectors.reshape(len(batch), dim).astype(np.float32)
+            documents = batch.column("document").to_pylist()
+            collection.add(
+                ids=batch.column("id").to_pylist(),
+                # 摘要集合只有向量，沒有文件內容
+                documents=documents if any(d is not None for d in documents) else None,
+                metadatas=[json.loads(m) for m in batch.column("metadata").to_pylist()],
+                embeddings=vectors,
+            )
+
+
+def import_snapshot(snapshot_dir, force=False):
+    """
+    將快照直接載入新節點：向量已預先計算，全程不呼叫任何模型。
+    與 rebuild_index 相同採藍綠切換：先寫入新的集合世代，筆數核對無誤後才切換別名，
+    匯入中途失敗時線上世代完全不受影響。目前世代已有資料時需 force=True，被取代的世代保留為回滾目標。
+    """
+    manifest = load_manifest(snapshot_dir)
+    client = init_chroma_client()
+    current_text, current_image = init_collections(client)
+    if (current_text.count() or current_image.count()) and not force:
+        raise RuntimeError("目前世代已有資料，若要以快照取代請加上 --force")
+
+    aliases = load_aliases()
+    old_generation, previous_generation = aliases["current"], aliases["previous"]
+    generation = new_generation()
+    batch_size = min(IMPORT_BATCH_SIZE, client.get_max_batch_size())
+    print(f"[INFO] 匯入快照至新世代 {generation}（目前 {old_generation or '(legacy)'}）")
+    try:
+        collections = create_generation_collections(client, generation, manifest)
+        for name, info in manifest["collections"].items():
+            start = time.monotonic()
+            collection = collections[name]
+            load_collection_file(collection, os.path.join(snapshot_dir, info["file"]), info["dim"], batch_size)
+            if collection.count() != info["count"]:
+                raise RuntimeError(f"集合 '{name}' 載入 {collection.count()} 筆，與快照記錄的 {info['count']} 筆不符")
+            print(f"[INFO] 已載入 '{name}'：{info['count']} 筆，耗時 {time.monotonic() - start:.1f}s")
+
+        if manifest.get("dedup_index"):
+            # 舊快照的去重索引為 JSON，複製時轉成 SQLite
+            copy_dedup_index(os.path.join(snapshot_dir, manifest["dedup_index"]), dedup_index_path(generation))
+            print(f"[INFO] 已還原去重索引至 {dedup_index_path(generation)}")
+        else:
+            print("[WARN] 快照不含去重索引，新世代從空的去重索引開始")
+
+        # 舊快照沒有摘要集合時，由匯入的 chunk 向量重建
+        if SUMMARY_COLLECTION_NAME not in manifest["collections"] and HIERARCHICAL_INDEX_ENABLED:
+            print("[INFO] 快照不含摘要集合，依匯入的 chunk 向量重建")
+            rebuild_all_summaries(collections[TEXT_COLLECTION_NAME])
+    except Exception:
+        print(f"[ERROR] 匯入失敗，刪除未完成的世代 {generation}，線上世代維持 {old_generation or '(legacy)'}")
+        drop_generation(client, generation)
+        raise
+
+    swap_alias(generation)
+    # 新世代的集合名稱不同，檢索快取自然不會命中；答案快取以問題為 key，需另外清空
+    answer_cache.clear()
+    print(f"[INFO] 別名已切換到 {generation}，回滾請執行 python rebuild_index.py rollback")
+    if previous_generation is not None and previous_generation not in (old_generation, generation):
+        drop_generation(client, previous_generation)
+
+    hashes_path = os.path.join(snapshot_dir, HASHES_FILE)
+    if os.path.exists(hashes_path):
+        shutil.copy(hashes_path, file_hashes.HASH_DB_FILE)
+        print("[INFO] 已還原 file_hashes 紀錄，後續只會處理快照之後變更的檔案")
+    return generation
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="向量資料庫快照匯出 / 匯入")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export", help="匯出快照")
+    export_parser.add_argument("snapshot_dir")
+    import_parser = subparsers.add_parser("import", help="匯入快照到本節點")
+    import_parser.add_argument("snapshot_dir")
+    import_parser.add_argument("--force", action="store_true", help="目前世代已有資料時仍以快照取代（舊世代保留為回滾目標）")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export_snapshot(args.snapshot_dir)
+    else:
+        import_snapshot(args.snapshot_dir, force=args.force)
@@ -0,0 +1,181 @@
+import os
+import time
+import queue
+import argparse
+import threading
+from watchfiles import watch, Change
+
+import file_hashes
+from profiler import add_profile_arguments, configure_from_args
+
+# 檔案監控匯入設定，可透過環境變數調整
+RAG_RAW_FILE_PATH = os.getenv("RAG_RAW_FILE_PATH")
+# 同一檔案連續寫入時，等待多久沒有新事件才視為寫入完成（毫秒）
+INGEST_DEBOUNCE_MS = int(os.getenv("INGEST_DEBOUNCE_MS", "2000"))
+# 待處理批次的佇列上限，滿了會讓監控執行緒暫停取事件（backpressure）
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "8"))
+# 定期完整掃描的間隔（秒），用來補抓遺漏的事件；0 表示停用
+INGEST_RECONCILE_SECONDS = int(os.getenv("INGEST_RECONCILE_SECONDS", "3600"))
+
+# 佇列中代表「做一次完整掃描」的標記
+FULL_SCAN = None
+
+
+def to_raw_path(path):
+    """把監控事件回報的絕對路徑轉成與 file_hashes 紀錄一致的路徑格式"""
+    relative = os.path.relpath(path, os.path.abspath(RAG_RAW_FILE_PATH))
+    return file_hashes.normalize_path(os.path.join(RAG_RAW_FILE_PATH, relative))
+
+
+def is_supported_file(change, path):
+    return path.endswith(file_hashes.SUPPORTED_EXTENSIONS)
+
+
+class IngestWatcher:
+    """
+    常駐監控 RAG_RAW_FILE_PATH：
+      - 監控執行緒以 inotify 事件（watchfiles）取得變動檔案，debounce 期間內的多次寫入合併為一批
+      - 批次放入有上限的佇列，佇列滿時監控端會阻塞，形成 backpressure
+      - 匯入執行緒取出批次後，將佇列中其他等待的批次一起合併，再交給 process_fn(raw_paths)
+      - 定期送出完整掃描（raw_paths=None），補抓遺漏的事件
+    """
+
+    def __init__(self, process_fn, directory=RAG_RAW_FILE_PATH, debounce_ms=INGEST_DEBOUNCE_MS,
+                 queue_size=INGEST_QUEUE_SIZE, reconcile_seconds=INGEST_RECONCILE_SECONDS):
+        self.process_fn = process_fn
+        self.directory = directory
+        self.debounce_ms = debounce_ms
+        self.reconcile_seconds = reconcile_seconds
+        self.work_queue = queue.Queue(maxsize=queue_size)
+        self.stop_event = threading.Event()
+        self.threads = []
+        self.batches_processed = 0
+        self.files_processed = 0
+
+    def start(self):
+        targets = [self._watch_loop, self._work_loop]
+        if self.reconcile_seconds > 0:
+            targets.append(self._reconcile_loop)
+        for target in targets:
+            thread = threading.Thread(target=target, name=f"ingest-{target.__name__.strip('_')}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        print(f"[INFO] 開始監控資料夾：{self.directory}（debounce {self.debounce_ms}ms）")
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        # 喚醒等待中的匯入執行緒
+        try:
+            self.work_queue.put_nowait(FULL_SCAN)
+        except queue.Full:
+            pass
+
+    def request_full_scan(self):
+        self._put(FULL_SCAN)
+
+    def _put(self, item):
+        # 佇列滿時阻塞等待（backpressure），同時定期檢查是否要停止
+        while not self.stop_event.is_set():
+            try:
+                self.work_queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def _watch_loop(self):
+        for changes in watch(
+            self.directory,
+            watch_filter=is_supported_file,
+            debounce=self.debounce_ms,
+            stop_event=self.stop_event,
+            recursive=True,
+        ):
+            paths = {to_raw_path(path) for change, path in changes if change in (Change.added, Change.modified, Change.deleted)}
+            if paths:
+                self._put(paths)
+
+    def _reconcile_loop(self):
+        while not self.stop_event.wait(self.reconcile_seconds):
+            print("[INFO] 定期完整掃描，補抓遺漏的檔案事件")
+            self.request_full_scan()
+
+    def _drain(self, first):
+        """合併佇列中所有等待的批次；只要有任何一批是完整掃描，就改做完整掃描"""
+        paths = set() if first is FULL_SCAN else set(first)
+        full_scan = first is FULL_SCAN
+        while True:
+            try:
+                item = self.work_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is FULL_SCAN:
+                full_scan = True
+            else:
+                paths.update(item)
+        return None if full_scan else sorted(paths)
+
+    def _work_loop(self):
+        while not self.stop_event.is_set():
+            first = self.work_queue.get()
+            if self.stop_event.is_set():
+                break
+            raw_paths = self._drain(first)
+            start = time.monotonic()
+            try:
+                self.process_fn(raw_paths)
+            except Exception as e:
+                print(f"[ERROR] 監控匯入失敗：{e}")
+                continue
+            self.batches_processed += 1
+            self.files_processed += len(raw_paths) if raw_paths is not None else 0
+            target = "完整掃描" if raw_paths is None else f"{len(raw_paths)} 個檔案"
+            print(f"[INFO] 監控匯入完成：{target}，耗時 {time.monotonic() - start:.1f}s")
+
+
+def main(ignore_image_processing=False):
+    # 延遲 import：只有實際執行監控時才載入向量庫與轉檔相關套件
+    from vector_db import init_chroma_client, init_collections
+    from process_files import process_pdf_changes
+    from collection_alias import aliases_mtime, current_generation
+
+    client = init_chroma_client()
+    resolved = {"mtime": object(), "generation": None, "collections": None}
+
+    def resolve_collections():
+        """與 query_server 的 refresh_collections 相同：別名檔（rebuild / rollback）有變動時改寫入新世代的集合"""
+        mtime = aliases_mtime()
+        if mtime != resolved["mtime"]:
+            generation = current_generation()
+            if resolved["collections"] is not None and generation != resolved["generation"]:
+                print(f"[INFO] 集合世代切換：{resolved['generation'] or '(legacy)'} → {generation or '(legacy)'}，之後的匯入寫入新世代")
+            resolved.update(mtime=mtime, generation=generation, collections=init_collections(client, generation))
+        return resolved["collections"]
+
+    def process_fn(raw_paths):
+        text_collection, image_collection = resolve_collections()
+        process_pdf_changes(
+            text_collection, image_collection,
+            ignore_image_processing=ignore_image_processing,
+            raw_paths=raw_paths,
+        )
+
+    watcher = IngestWatcher(process_fn)
+    # 啟動時先做一次完整掃描，補上停機期間的變更
+    watcher.request_full_scan()
+    watcher.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        print("[INFO] 停止監控")
+        watcher.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="監控 RAG_RAW_FILE_PATH 並即時匯入向量資料庫")
+    parser.add_argument("--ignore-image-processing", action="store_true", help="略過圖片處理（baseline 模式）")
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    configure_from_args(args)
+    main(ignore_image_processing=args.ignore_image_processing)
@@ -0,0 +1,150 @@
+import os
+import re
+import bisect
+import fitz  # PyMuPDF
+import tiktoken
+
+# 版面感知的文字分塊設定，可透過環境變數調整
+# 每個 chunk 的 token 上限與相鄰 chunk 的重疊 token 數
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "128"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "16"))
+CHUNK_TOKENIZER = os.getenv("CHUNK_TOKENIZER", "cl100k_base")
+# 寬度超過頁寬此比例，或橫跨頁面中線的區塊視為跨欄（標題、摘要、全寬圖表說明）
+FULL_WIDTH_RATIO = 0.6
+# 切點往回找「區塊或句子邊界」時，最多退到 chunk 長度的這個比例
+MIN_CHUNK_FILL = 0.5
+
+# 只取文字、保留連字、裁到頁面範圍；不取圖片，比 "dict" 模式輕量
+TEXT_FLAGS = fitz.TEXT_PRESERVE_LIGATURES | fitz.TEXT_MEDIABOX_CLIP
+SENTENCE_ENDINGS = ".!?。！？；;:"
+# 分塊版本：改動切塊邏輯時遞增 CHUNKER_REVISION；連同上面的設定一起寫進 file_hashes 紀錄，
+# 版本不同的檔案即使內容沒變也會重新分塊（chunk id 取自內容，只有邊界變動的 chunk 需要重新嵌入）
+CHUNKER_REVISION = 1
+CHUNKER_VERSION = f"layout-{CHUNKER_REVISION}/{CHUNK_MAX_TOKENS}/{CHUNK_OVERLAP_TOKENS}/{CHUNK_TOKENIZER}"
+
+_encoder = None
+
+
+def get_encoder():
+    global _encoder
+    if _encoder is None:
+        _encoder = tiktoken.get_encoding(CHUNK_TOKENIZER)
+    return _encoder
+
+
+def clean_block_text(text):
+    """合併區塊內的換行：行尾連字號直接接回，其餘換行改為空白"""
+    text = re.sub(r"(\w)-\n(\w)", r"\1\2", text)
+    return re.sub(r"\s*\n\s*", " ", text).strip()
+
+
+def reading_order(blocks, page_width):
+    """
+    依閱讀順序排列區塊：跨欄區塊把頁面切成上下數段，
+    每段內先讀左欄再讀右欄，欄內由上而下。
+    blocks 為 (x0, y0, x1, y1, text)。
+    """
+    mid = page_width / 2
+    ordered, segment = [], []
+
+    def flush():
+        segment.sort(key=lambda b: (0 if b[0] < mid else 1, b[1], b[0]))
+        ordered.extend(segment)
+        segment.clear()
+
+    for block in sorted(blocks, key=lambda b: (b[1], b[0])):
+        x0, _, x1, _, _ = block
+        if x1 - x0 > page_width * FULL_WIDTH_RATIO or (x0 < mid - 1 and x1 > mid + 1):
+            flush()
+            ordered.append(block)
+        else:
+            segment.append(block)
+    flush()
+    return ordered
+
+
+def iter_page_blocks(page):
+    """以 "blocks" 模式取出頁面文字區塊（含每行所有 span），依閱讀順序回傳"""
+    blocks = []
+    for x0, y0, x1, y1, text, _, block_type in page.get_text("blocks", flags=TEXT_FLAGS, sort=False):
+        if block_type != 0:
+            continue
+        text = clean_block_text(text)
+        if text:
+            blocks.append((x0, y0, x1, y1, text))
+    return reading_order(blocks, page.rect.width)
+
+
+def chunk_page(blocks, page_num, max_tokens=CHUNK_MAX_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS):
+    """
+    將一頁的區塊串成一段文字後一次 tokenize，以 token 數切塊並保留重疊；
+    切點優先落在區塊或句子邊界，bbox 取 chunk 涵蓋區塊的聯集。
+    """
+    if not blocks:
+        return []
+    encoder = get_encoder()
+    page_text = "\n".join(block[4] for block in blocks)
+    block_starts = []
+    position = 0
+    for block in blocks:
+        block_starts.append(position)
+        position += len(block[4]) + 1
+
+    tokens = encoder.encode(page_text, disallowed_special=())
+    # 每個 token 在 page_text 中的起始字元位置，用來切回原文（避免多位元組字元被切斷）
+    _, offsets = encoder.decode_with_offsets(tokens)
+    offsets.append(len(page_text))
+    n = len(tokens)
+
+    def is_boundary(i):
+        char_pos = offsets[i]
+        if char_pos == 0 or page_text[char_pos - 1] == "\n":
+            return True
+        return page_text[max(0, char_pos - 4):char_pos].rstrip()[-1:] in SENTENCE_ENDINGS
+
+    chunks = []
+    start = 0
+    while start < n:
+        end = min(start + max_tokens, n)
+        if end < n:
+            floor = start + max(1, int(max_tokens * MIN_CHUNK_FILL))
+            for candidate in range(end, floor - 1, -1):
+                if is_boundary(candidate):
+                    end = candidate
+                    break
+        char_start, char_end = offsets[start], offsets[end]
+        text = page_text[char_start:char_end].strip()
+        if text:
+            first = bisect.bisect_right(block_starts, char_start) - 1
+            last = bisect.bisect_left(block_starts, char_end) - 1
+            covered = blocks[max(first, 0):max(last, first) + 1]
+            chunks.append({
+                "text": text,
+                "x1": min(b[0] for b in covered),
+                "y1": min(b[1] for b in covered),
+                "x2": max(b[2] for b in covered),
+                "y2": max(b[3] for b in covered),
+                "page": page_num,
+            })
+        if end >= n:
+            break
+        start = max(end - overlap_tokens, start + 1)
+    return chunks
+
+
+def iter_pdf_chunks(pdf_path, max_tokens=CHUNK_MAX_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS):
+    """逐頁串流產生 chunk，不需先把整份文件的區塊讀進記憶體"""
+    with fitz.open(pdf_path) as doc:
+        for page_num, page in enumerate(doc):
+            yield from chunk_page(iter_page_blocks(page), page_num, max_tokens, overlap_tokens)
+
+
+def chunk_pdf(pdf_path, max_tokens=CHUNK_MAX_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS):
+    """回傳與 pdf_text_chunker.split_text_blocks 相同格式的 chunk 清單"""
+    return list(iter_pdf_chunks(pdf_path, max_tokens, overlap_tokens))
+
+
+if __name__ == "__main__":
+    pdf_path = "./RAG_raw_data/1603.01417v1.pdf"
+    for chunk in chunk_pdf(pdf_path):
+        print(f"Page: {chunk['page']}, x: {chunk['x1']:.0f}, y: {chunk['y1']:.0f}, Text: {chunk['text']}\n")
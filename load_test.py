@@ -0,0 +1,76 @@
+import os
+import json
+import time
+import random
+import asyncio
+import argparse
+from collections import Counter
+import httpx
+import numpy as np
+
+# 對 query_server 進行併發壓測，問題取自 QASPER 抽樣資料
+QASPER_SAMPLED_DIR = os.path.join("validation_Data", "working Data", "allenai-qasper", "sampled")
+
+
+def load_questions():
+    questions = []
+    for question_type in ("extractive", "free_form", "yes_no"):
+        file_path = os.path.join(QASPER_SAMPLED_DIR, f"sampled_qasper_{question_type}.json")
+        with open(file_path, "r", encoding="utf-8") as f:
+            questions.extend(item["question"] for item in json.load(f))
+    return questions
+
+
+async def worker(client, url, questions, stream, remaining, latencies, statuses):
+    while remaining:
+        remaining.pop()
+        payload = {"question": random.choice(questions)}
+        start = time.monotonic()
+        try:
+            if stream:
+                async with client.stream("POST", url, json=payload) as response:
+                    async for _ in response.aiter_text():
+                        pass
+            else:
+                response = await client.post(url, json=payload)
+            statuses[response.status_code] += 1
+            if response.status_code == 200:
+                latencies.append(time.monotonic() - start)
+        except httpx.HTTPError as e:
+            statuses[type(e).__name__] += 1
+
+
+async def run(base_url, total, concurrency, stream):
+    questions = load_questions()
+    url = f"{base_url}/query/stream" if stream else f"{base_url}/query"
+    remaining = list(range(total))
+    latencies, statuses = [], Counter()
+
+    start = time.monotonic()
+    async with httpx.AsyncClient(timeout=None) as client:
+        await asyncio.gather(*[
+            worker(client, url, questions, stream, remaining, latencies, statuses)
+            for _ in range(concurrency)
+        ])
+        elapsed = time.monotonic() - start
+        metrics = (await client.get(f"{base_url}/metrics")).json()
+
+    print(f"[INFO] 總請求 {total}，併發 {concurrency}，耗時 {elapsed:.2f}s，吞吐 {total / elapsed:.2f} req/s")
+    print(f"[INFO] 狀態碼分佈：{dict(statuses)}")
+    if latencies:
+        arr = np.asarray(latencies)
+        print(
+            f"[INFO] 成功延遲 p50={np.percentile(arr, 50):.3f}s "
+            f"p95={np.percentile(arr, 95):.3f}s p99={np.percentile(arr, 99):.3f}s"
+        )
+    print(f"[INFO] 服務端指標：{json.dumps(metrics, ensure_ascii=False)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="query_server 壓力測試")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--stream", action="store_true", help="改用 /query/stream 串流端點")
+    args = parser.parse_args()
+    asyncio.run(run(args.url, args.requests, args.concurrency, args.stream))
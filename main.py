@@ -2,18 +2,24 @@ import json
 from vector_db import init_chroma_client, init_collections, check_collection_data, fetch_collection_data, save_to_excel
 from process_files import process_pdf_changes
 from rag_pipeline import rag_query_pipeline
-from azure_tool import evaluating_RAG_with_ragas
+from ragas_eval import evaluate_incremental
 import os
+import image_payload
+from retrieval_cache import retrieval_cache
+from context_budget import context_stats, CONTEXT_TOKEN_BUDGET
+from scoped_retrieval import resolve_paper_files, document_indexes
 
 # 選擇： extractive / free_form / yes_no
 QUESTION_TYPE = "extractive"  
 # 是否使用圖像處理演算法
 WITH_IMAGE_ALGO = True             
+# 是否依題目的 paper_id 只在該篇論文中檢索
+SCOPE_TO_PAPER = True
 
 
 def load_qasper_data(question_type):
     """
-    根據 question_type 讀取對應的 Qasper 資料並解析成問題與標準答案。
+    根據 question_type 讀取對應的 Qasper 資料並解析成問題、標準答案與所屬論文的 paper_id。
     """
     base_dir = os.path.join("validation_Data", "working Data", "allenai-qasper")
     file_name = f"sampled_qasper_{question_type}.json"
@@ -24,6 +30,7 @@ def load_qasper_data(question_type):
 
     questions = []
     ground_truths = []
+    paper_ids = []
 
     for item in data:
         question = item["question"]
@@ -46,10 +53,11 @@ def load_qasper_data(question_type):
                      
         questions.append(question)
         ground_truths.append(ground_truth)
+        paper_ids.append(item.get("paper_id"))
 
-    return questions, ground_truths
+    return questions, ground_truths, paper_ids
 
-def main(question_type, with_image_algo=True):
+def main(question_type, with_image_algo=True, scope_to_paper=SCOPE_TO_PAPER):
     # 1. 初始化 ChromaDB 與向量集合
     client = init_chroma_client()
     text_collection, image_collection = init_collections(client)
@@ -62,39 +70,59 @@ def main(question_type, with_image_algo=True):
     deleted_files, changed_files = process_pdf_changes(text_collection, image_collection, ignore_image_processing=not with_image_algo)
     
     # 3. 讀取測試問題與標準答案，執行 RAG 查詢與評測
-    test_questions, ground_truths = load_qasper_data(question_type)
+    test_questions, ground_truths, paper_ids = load_qasper_data(question_type)
 
     answers, text_contexts = [], []
-    for query in test_questions:
-        response = rag_query_pipeline(
+    for query, paper_id in zip(test_questions, paper_ids):
+        # paper_id 對應到 RAG_FILE_PATH 中的 PDF（例如 1910.03042v1.pdf），找不到時不限定範圍
+        paper_files = resolve_paper_files(paper_id) if scope_to_paper else []
+        if scope_to_paper and not paper_files:
+            print(f"[WARN] 找不到 paper_id {paper_id} 對應的 PDF，改為全域檢索")
+        response, used_contexts = rag_query_pipeline(
             query,
             text_collection,
             image_collection,
             dataset_type=question_type if question_type == "yes_no" else None,
-            ignore_image_processing=not with_image_algo  
+            ignore_image_processing=not with_image_algo,
+            return_contexts=True,
+            file_name=paper_files or None,
+            # 評測每次都重新產生答案：快取的答案可能來自先前不同的提示詞、模型或上下文設定
+            use_cache=False,
         )
         answers.append(response)
-        
-        text_result = text_collection.query(query_texts=[query], n_results=4)
-        retrieved_text = text_result.get("documents", [])
-        retrieved_text = ["\n".join(doc) if isinstance(doc, list) else str(doc) for doc in retrieved_text]
-        text_contexts.append(retrieved_text)
+        # 以實際放入提示詞的上下文評測（不使用答案快取，每題都有實際檢索的上下文）
+        text_contexts.append(used_contexts)
     
     # 4. 評估 RAG 結果
-    score_text = evaluating_RAG_with_ragas(test_questions, answers, text_contexts, ground_truths)
-    df_text = score_text.to_pandas()
-
     # 根據 question_type 和演算法設定組合輸出檔名
     algo_tag = "with_algo" if with_image_algo else "baseline"
-    output_file = f"evaluation_results/score_{question_type}_{algo_tag}.csv"
-    df_text.to_csv(output_file, index=False, encoding='utf-8-sig')
+    # 不同的上下文 token 預算分開存檔，方便比較 RAGAS 分數後挑選預算
+    budget_tag = f"_ctx{CONTEXT_TOKEN_BUDGET}" if CONTEXT_TOKEN_BUDGET else ""
+    scope_tag = "_doc" if scope_to_paper else ""
+    output_file = f"evaluation_results/score_{question_type}_{algo_tag}{budget_tag}{scope_tag}.csv"
+    # 只評分內容有變動的題目，其餘沿用快取分數；每批完成就更新 CSV
+    evaluate_incremental(test_questions, answers, text_contexts, ground_truths, output_file=output_file)
     print(f"[INFO] 文字檢測分數已儲存為 {output_file}")
     
-    # 5. 儲存 Chunk 全部區塊資料庫內容，方便查看
+    # 5. 儲存 Chunk 區塊資料庫內容，方便查看（Excel 只存前 EXCEL_SAMPLE_LIMIT 筆樣本）
     # text_data = fetch_collection_data(text_collection)
     # image_data = fetch_collection_data(image_collection)
     # save_to_excel(text_data, image_data)
+    # 完整內容請用串流匯出（.csv / .jsonl / .parquet），記憶體用量固定
+    # from vector_db import export_collection
+    # export_collection(text_collection, "vector_database_text.parquet")
+    # export_collection(image_collection, "vector_database_image.parquet")
     
+    # 回報查詢階段送往 VLM 的圖片 bytes / token 與節省量
+    image_payload.payload_stats.report()
+    retrieval_cache.report()
+    context_stats.report()
+    document_indexes.report()
+    # 分片集合（VECTOR_SHARDS > 1）回報各分片筆數與查詢延遲
+    for collection in (text_collection, image_collection):
+        if hasattr(collection, "shard_stats"):
+            collection.report()
+
     print("[INFO] 所有流程處理完成！")
 
 if __name__ == "__main__":
@@ -0,0 +1,227 @@
+import os
+import gc
+import math
+import time
+import threading
+from contextlib import contextmanager
+import psutil
+import fitz  # PyMuPDF
+
+# 頁面渲染與圖片處理的記憶體預算，可透過環境變數調整
+# 單次渲染的像素上限（海報、A0 圖紙等大尺寸頁面會自動降低渲染倍率）
+RENDER_MAX_PIXELS = int(os.getenv("RENDER_MAX_PIXELS", str(12_000_000)))
+# 單次渲染的 pixmap bytes 上限（MB），與像素上限取較嚴格者
+RENDER_MAX_PIXMAP_MB = float(os.getenv("RENDER_MAX_PIXMAP_MB", "48"))
+# 行程記憶體上限（MB）；0 表示自動讀取 cgroup 的限制，讀不到就不做背壓
+INGEST_MEMORY_LIMIT_MB = int(os.getenv("INGEST_MEMORY_LIMIT_MB", "0"))
+# RSS 超過上限的此比例就暫停渲染，降到 INGEST_MEMORY_RESUME 以下才繼續
+INGEST_MEMORY_HIGH = float(os.getenv("INGEST_MEMORY_HIGH", "0.85"))
+INGEST_MEMORY_RESUME = float(os.getenv("INGEST_MEMORY_RESUME", "0.75"))
+# 單次暫停最多等待的秒數（逾時仍繼續，避免整個匯入卡死）與輪詢間隔
+INGEST_PAUSE_TIMEOUT = float(os.getenv("INGEST_PAUSE_TIMEOUT", "120"))
+INGEST_PAUSE_POLL = float(os.getenv("INGEST_PAUSE_POLL", "0.5"))
+# 暫停逾時後 RSS 仍未降下時，渲染的像素 / bytes 預算改乘上此比例，直到 RSS 低於 INGEST_MEMORY_RESUME
+INGEST_DEGRADED_BUDGET = float(os.getenv("INGEST_DEGRADED_BUDGET", "0.25"))
+
+CGROUP_LIMIT_FILES = [
+    "/sys/fs/cgroup/memory.max",                    # cgroup v2
+    "/sys/fs/cgroup/memory/memory.limit_in_bytes",  # cgroup v1
+]
+
+_process = psutil.Process()
+
+
+def current_rss():
+    return _process.memory_info().rss
+
+
+def detect_memory_limit():
+    """回傳記憶體上限（bytes）：優先使用 INGEST_MEMORY_LIMIT_MB，其次為容器的 cgroup 限制；0 表示不限制"""
+    if INGEST_MEMORY_LIMIT_MB > 0:
+        return INGEST_MEMORY_LIMIT_MB * 1024 * 1024
+    total = psutil.virtual_memory().total
+    for path in CGROUP_LIMIT_FILES:
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        # 未設定限制時 v2 為 "max"、v1 為極大值
+        if value.isdigit() and int(value) < total:
+            return int(value)
+    return 0
+
+
+def fit_zoom(rect, zoom, channels=3, max_pixels=RENDER_MAX_PIXELS, max_bytes=RENDER_MAX_PIXMAP_MB * 1024 * 1024):
+    """
+    在像素與 bytes 預算內的最大渲染倍率（不超過原本要求的 zoom）。
+    pixmap 大小為 寬 × 高 × 通道數，與倍率平方成正比，因此依面積比例開根號縮小。
+    """
+    budget = max_pixels if max_pixels > 0 else math.inf
+    if max_bytes > 0:
+        budget = min(budget, max_bytes / channels)
+    area = rect.width * rect.height * zoom * zoom
+    if area <= budget or area <= 0:
+        return zoom
+    return zoom * math.sqrt(budget / area)
+
+
+class DocumentMemory:
+    """單一文件處理期間的記憶體紀錄"""
+
+    def __init__(self, name, rss):
+        self.name = name
+        self.start_rss = rss
+        self.peak_rss = rss
+        self.end_rss = rss
+        self.renders = 0
+        self.downscaled = 0
+        self.peak_pixmap = 0
+        self.pauses = 0
+        self.paused_seconds = 0.0
+        self.seconds = 0.0
+
+
+class MemoryBudget:
+    """
+    頁面渲染的記憶體預算與背壓：
+      - render_matrix 依像素 / bytes 預算調整渲染倍率，超大頁面不再一次配置數百 MB 的 pixmap
+      - wait_for_headroom 在 RSS 接近上限時先釋放快取，仍不足就暫停，等其他工作釋放記憶體；
+        每份文件最多暫停一次，暫停逾時後改為降低渲染倍率（降級），RSS 低於 INGEST_MEMORY_RESUME 才恢復；
+        背壓只用在 track 內（匯入），查詢時的渲染（pdf_page_to_payload）只依預算調整倍率，不會讓查詢執行緒等待
+      - track 以文件為單位記錄 RSS 峰值、縮小渲染次數與暫停時間，report 輸出每份文件的記憶體報表
+    RSS 只在渲染與檢查點取樣，峰值為取樣到的最大值。
+    """
+
+    def __init__(self, limit_bytes=None):
+        self.limit_bytes = detect_memory_limit() if limit_bytes is None else limit_bytes
+        self.documents = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # 暫停逾時後進入降級狀態：不再暫停，改以較小的預算渲染
+        self.degraded = False
+
+    def _current(self):
+        return getattr(self._local, "document", None)
+
+    def sample(self):
+        rss = current_rss()
+        document = self._current()
+        if document is not None and rss > document.peak_rss:
+            document.peak_rss = rss
+        return rss
+
+    @contextmanager
+    def track(self, name):
+        """記錄 with 區塊內（同一執行緒）的渲染與 RSS，離開時加入報表"""
+        previous = self._current()
+        document = DocumentMemory(name, current_rss())
+        started = time.monotonic()
+        self._local.document = document
+        try:
+            yield document
+        finally:
+            document.end_rss = self.sample()
+            document.seconds = time.monotonic() - started
+            self._local.document = previous
+            with self._lock:
+                self.documents.append(document)
+
+    def render_matrix(self, rect, zoom, channels=3):
+        """回傳符合預算的 fitz.Matrix；匯入時記憶體吃緊會以較小的預算渲染，倍率被調降時計入目前文件的統計"""
+        document = self._current()
+        if document is not None and self.wait_for_headroom():
+            fitted = fit_zoom(rect, zoom, channels,
+                              max_pixels=RENDER_MAX_PIXELS * INGEST_DEGRADED_BUDGET,
+                              max_bytes=RENDER_MAX_PIXMAP_MB * 1024 * 1024 * INGEST_DEGRADED_BUDGET)
+        else:
+            fitted = fit_zoom(rect, zoom, channels)
+        if document is not None:
+            document.renders += 1
+            if fitted < zoom:
+                document.downscaled += 1
+        if fitted < zoom:
+            print(f"[INFO] 頁面過大（{rect.width:.0f}x{rect.height:.0f} pt），渲染倍率 {zoom:.2f} 調降為 {fitted:.2f}")
+        return fitz.Matrix(fitted, fitted)
+
+    def record_pixmap(self, pix):
+        """渲染完成、pixmap 仍存在時取樣，峰值才會包含 pixmap 本身"""
+        self.sample()
+        document = self._current()
+        if document is not None:
+            document.peak_pixmap = max(document.peak_pixmap, pix.stride * pix.height)
+
+    def relieve(self):
+        """釋放可回收的記憶體：Python 垃圾回收與 MuPDF 的內部快取"""
+        gc.collect()
+        fitz.TOOLS.store_shrink(100)
+
+    def _under_pressure(self, rss, resume):
+        """降級狀態的遲滯：RSS 低於 resume 才解除"""
+        if self.degraded and rss < resume:
+            self.degraded = False
+            print(f"[INFO] RSS 降至 {rss / 1024 / 1024:.0f}MB，恢復正常渲染倍率")
+        return self.degraded
+
+    def wait_for_headroom(self):
+        """
+        RSS 超過 INGEST_MEMORY_HIGH 時先釋放快取，仍不足才暫停；回傳 True 表示記憶體仍吃緊，呼叫端應降低渲染倍率。
+        同一 process 內 RSS 不會因為自己暫停而下降，因此每份文件最多暫停一次，
+        逾時後進入降級狀態，之後的渲染不再等待。只在 track 內（匯入文件時）生效，其他執行緒直接回傳 False。
+        """
+        document = self._current()
+        if self.limit_bytes <= 0 or document is None:
+            return False
+        high = self.limit_bytes * INGEST_MEMORY_HIGH
+        resume = self.limit_bytes * INGEST_MEMORY_RESUME
+        rss = self.sample()
+        if rss < high:
+            return self._under_pressure(rss, resume)
+        self.relieve()
+        rss = self.sample()
+        if rss < high:
+            return self._under_pressure(rss, resume)
+        if self.degraded or document.pauses:
+            return True
+
+        print(
+            f"[WARN] RSS {rss / 1024 / 1024:.0f}MB 接近上限 {self.limit_bytes / 1024 / 1024:.0f}MB，"
+            f"暫停渲染直到低於 {resume / 1024 / 1024:.0f}MB"
+        )
+        start = time.monotonic()
+        while rss >= resume and time.monotonic() - start < INGEST_PAUSE_TIMEOUT:
+            time.sleep(INGEST_PAUSE_POLL)
+            self.relieve()
+            rss = self.sample()
+        waited = time.monotonic() - start
+        document.pauses += 1
+        document.paused_seconds += waited
+        if rss >= resume:
+            self.degraded = True
+            print(
+                f"[WARN] 等待 {waited:.1f} 秒後 RSS 仍為 {rss / 1024 / 1024:.0f}MB，不再暫停，"
+                f"改以 {INGEST_DEGRADED_BUDGET:.0%} 的渲染預算繼續處理"
+            )
+            return True
+        print(f"[INFO] RSS 降至 {rss / 1024 / 1024:.0f}MB，暫停 {waited:.1f} 秒後繼續")
+        return False
+
+    def report(self, reset=True):
+        with self._lock:
+            documents, self.documents = self.documents, ([] if reset else self.documents)
+        if not documents:
+            return
+        print("[INFO] 每份文件的記憶體使用：")
+        print(f"{'文件':<40}{'峰值RSS(MB)':>12}{'增加(MB)':>10}{'最大pixmap(MB)':>15}{'渲染':>6}{'縮小':>6}{'暫停':>6}{'暫停(s)':>9}{'耗時(s)':>9}")
+        for d in documents:
+            print(
+                f"{d.name[:38]:<40}{d.peak_rss / 1024 / 1024:>12.0f}{(d.peak_rss - d.start_rss) / 1024 / 1024:>10.0f}"
+                f"{d.peak_pixmap / 1024 / 1024:>15.1f}{d.renders:>6}{d.downscaled:>6}{d.pauses:>6}"
+                f"{d.paused_seconds:>9.1f}{d.seconds:>9.1f}"
+            )
+        worst = max(documents, key=lambda d: d.peak_rss - d.start_rss)
+        print(f"[INFO] 記憶體增加最多的文件：{worst.name}（+{(worst.peak_rss - worst.start_rss) / 1024 / 1024:.0f}MB）")
+
+
+# 全域預算，pdf_chunker、image_payload 與 sync_pdfs 共用
+memory_budget = MemoryBudget()
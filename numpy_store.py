@@ -0,0 +1,579 @@
+import os
+import json
+import shutil
+import threading
+import numpy as np
+from filelock import FileLock
+
+# NumPy memmap 向量庫設定，可透過環境變數調整
+NUMPY_DB_PATH = os.getenv("NUMPY_DB_PATH", os.path.join(os.getcwd(), "numpy_db"))
+# 向量儲存精度：float16、int8（以 127 為刻度量化已正規化的向量）或 binary（每維 1 bit，見 search）
+NUMPY_STORE_DTYPE = os.getenv("NUMPY_STORE_DTYPE", "float16")
+# binary 儲存時，第一階段以 Hamming 距離取 k × 此倍數個候選，再以磁碟上的 float32 向量重新計分
+NUMPY_RESCORE_FACTOR = int(os.getenv("NUMPY_RESCORE_FACTOR", "10"))
+# 每次矩陣乘法處理的列數，控制搜尋時的暫存記憶體
+NUMPY_SEARCH_BLOCK_ROWS = int(os.getenv("NUMPY_SEARCH_BLOCK_ROWS", "65536"))
+# 墓碑比例超過此值時自動壓縮
+NUMPY_COMPACT_RATIO = float(os.getenv("NUMPY_COMPACT_RATIO", "0.3"))
+INITIAL_CAPACITY = 1024
+INT8_SCALE = 127.0
+BINARY = "binary"
+
+
+class DuplicateIDError(ValueError):
+    """同一批寫入中有重複的 id（與 ChromaDB 的 DuplicateIDError 相同行為）"""
+
+
+def match_where(metadata, where):
+    """支援 ChromaDB 常用的 where 語法：等值、$eq/$ne/$in/$nin/$gt/$gte/$lt/$lte、$and/$or"""
+    if not where:
+        return True
+    for key, condition in where.items():
+        if key == "$and":
+            if not all(match_where(metadata, sub) for sub in condition):
+                return False
+        elif key == "$or":
+            if not any(match_where(metadata, sub) for sub in condition):
+                return False
+        elif isinstance(condition, dict):
+            value = metadata.get(key)
+            for op, target in condition.items():
+                if op == "$eq" and not value == target:
+                    return False
+                if op == "$ne" and not value != target:
+                    return False
+                if op == "$in" and value not in target:
+                    return False
+                if op == "$nin" and value in target:
+                    return False
+                if op in ("$gt", "$gte", "$lt", "$lte"):
+                    if value is None:
+                        return False
+                    if op == "$gt" and not value > target:
+                        return False
+                    if op == "$gte" and not value >= target:
+                        return False
+                    if op == "$lt" and not value < target:
+                        return False
+                    if op == "$lte" and not value <= target:
+                        return False
+        elif metadata.get(key) != condition:
+            return False
+    return True
+
+
+def pack_bits(vectors):
+    """以正負號量化成 bit，每列補齊到 64 bit 的倍數後以 uint64 表示（1024 維 → 16 個 uint64 = 128 bytes）"""
+    packed = np.packbits(np.asarray(vectors) > 0, axis=1)
+    padding = -packed.shape[1] % 8
+    if padding:
+        packed = np.pad(packed, ((0, 0), (0, padding)))
+    return np.ascontiguousarray(packed).view(np.uint64)
+
+
+_M1 = np.uint64(0x5555555555555555)
+_M2 = np.uint64(0x3333333333333333)
+_M4 = np.uint64(0x0F0F0F0F0F0F0F0F)
+_H01 = np.uint64(0x0101010101010101)
+
+
+def popcount64(x):
+    """每個 uint64 中 1 的個數（SWAR 位元運算；NumPy 2 以上可直接用 np.bitwise_count）"""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(x)
+    x = x - ((x >> np.uint64(1)) & _M1)
+    x = (x & _M2) + ((x >> np.uint64(2)) & _M2)
+    x = (x + (x >> np.uint64(4))) & _M4
+    return (x * _H01) >> np.uint64(56)
+
+
+def hamming_distances(query_bits, block_bits):
+    """回傳 [查詢數, 列數] 的 Hamming 距離；逐查詢計算，暫存記憶體只與區塊大小有關"""
+    distances = np.empty((len(query_bits), len(block_bits)), dtype=np.int32)
+    for i, bits in enumerate(query_bits):
+        distances[i] = popcount64(block_bits ^ bits).sum(axis=1)
+    return distances
+
+
+def normalize_rows(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors[None, :]
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class NumpyCollection:
+    """
+    以 memory-mapped 矩陣做精確（暴力）搜尋的集合，介面與 ChromaDB Collection 相容
+    （add / upsert / get / delete / query / count），可直接替換 vector_db 與 rag_pipeline 使用的集合。
+      - 向量正規化後以 float16 或 int8 存在 vectors.bin，距離為 1 - cosine
+      - binary 時 vectors.bin 只存正負號 bit（float16 的 1/16），另以 rescore.bin 保存 float32 向量，
+        搜尋時先以 Hamming 距離挑候選，只讀取候選列的 float32 向量重新計分
+      - 文件與 metadata 以 append-only 的 records.jsonl 記錄，刪除只寫入墓碑
+      - 墓碑比例過高時重寫檔案（compact）
+      - 多個程序（query_server、ingest_watcher、rebuild_index）可同時開啟同一集合：
+        寫入時持有集合目錄下的檔案鎖，並先讀入其他程序新增的紀錄；讀取前發現檔案有變動時也會先同步
+    """
+
+    # 本身即為精確搜尋，限定文件範圍的查詢不需另建子索引（見 scoped_retrieval.py）
+    exact_search = True
+    # query 回傳的距離一律為 1 - cosine 相似度
+    distance_space = "cosine"
+
+    def __init__(self, path, name, metadata=None, embedding_function=None, dtype=NUMPY_STORE_DTYPE):
+        self.path = path
+        self.name = name
+        self.embedding_function = embedding_function
+        self._lock = threading.RLock()
+        os.makedirs(path, exist_ok=True)
+        self._file_lock = FileLock(os.path.join(path, "write.lock"))
+
+        self.vectors = None
+        self.rescore = None
+        self._synced_state = None
+        with self._file_lock:
+            if not os.path.exists(os.path.join(path, "info.json")):
+                self.info = {"name": name, "metadata": metadata or {}, "dtype": dtype, "dim": None, "capacity": 0}
+                self._save_info()
+            self._reset_rows()
+            self._sync()
+        if self.info["dtype"] != dtype:
+            print(f"[WARN] 集合 '{name}' 以 {self.info['dtype']} 儲存，與設定的 {dtype} 不同；變更儲存精度請重建索引")
+        # binary 的第一階段為近似搜尋，限定文件範圍的查詢改用 scoped_retrieval 的子索引
+        self.exact_search = self.info["dtype"] != BINARY
+
+    # ---------- 多程序同步 ----------
+    def _file_state(self):
+        """info.json 與 records.jsonl 的 (inode, mtime, size)，用來判斷其他程序是否寫入或壓縮過"""
+        state = []
+        for file_name in ("info.json", "records.jsonl"):
+            try:
+                st = os.stat(os.path.join(self.path, file_name))
+                state.append((st.st_ino, st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                state.append(None)
+        return tuple(state)
+
+    def _reset_rows(self):
+        self.ids, self.documents, self.metadatas = [], [], []
+        self.alive = np.zeros(0, dtype=bool)
+        self.id_to_row = {}
+        self._records_inode = None
+        self._records_offset = 0
+
+    def _sync(self):
+        """
+        讀入其他程序的變更（呼叫端需持有檔案鎖）：重新讀取 info.json（容量、維度可能已變），
+        records.jsonl 只讀上次之後新增的部分；檔案被換掉（其他程序壓縮過）時整份重讀並重新開啟向量檔。
+        """
+        state = self._file_state()
+        if state[0] is None:
+            # 集合已被其他程序刪除
+            self._reset_rows()
+            self.vectors = self.rescore = None
+            self._synced_state = state
+            return
+        with open(os.path.join(self.path, "info.json"), "r", encoding="utf-8") as f:
+            self.info = json.load(f)
+        self.metadata = self.info["metadata"]
+        records_inode = state[1][0] if state[1] is not None else None
+        reopen = records_inode != self._records_inode
+        if reopen:
+            self._reset_rows()
+            self._records_inode = records_inode
+        self._replay_records()
+        if self.info["dim"] and (reopen or self.vectors is None or len(self.vectors) != self.info["capacity"]):
+            self._open_vectors()
+        self._synced_state = state
+
+    def _refresh(self):
+        """讀取前呼叫：檔案沒有變動時只需兩次 stat，不必取得檔案鎖"""
+        if self._file_state() != self._synced_state:
+            with self._file_lock:
+                self._sync()
+
+    def _mark_synced(self):
+        """本程序寫入後，記下目前檔案狀態，避免下次讀取時重讀自己剛寫入的紀錄"""
+        records_path = os.path.join(self.path, "records.jsonl")
+        if os.path.exists(records_path):
+            self._records_inode = os.stat(records_path).st_ino
+            self._records_offset = os.path.getsize(records_path)
+        self._synced_state = self._file_state()
+
+    # ---------- 檔案處理 ----------
+    def _save_info(self):
+        with open(os.path.join(self.path, "info.json"), "w", encoding="utf-8") as f:
+            json.dump(self.info, f, ensure_ascii=False)
+
+    def _np_dtype(self):
+        return {"int8": np.int8, BINARY: np.uint64}.get(self.info["dtype"], np.float16)
+
+    def _row_width(self):
+        dim = self.info["dim"]
+        return (dim + 63) // 64 if self.info["dtype"] == BINARY else dim
+
+    @staticmethod
+    def _open_memmap(path, dtype, shape):
+        required = shape[0] * shape[1] * np.dtype(dtype).itemsize
+        with open(path, "ab") as f:
+            if f.tell() < required:
+                f.truncate(required)
+        return np.memmap(path, dtype=dtype, mode="r+", shape=shape)
+
+    def _open_vectors(self):
+        capacity = self.info["capacity"]
+        self.vectors = self._open_memmap(os.path.join(self.path, "vectors.bin"), self._np_dtype(), (capacity, self._row_width()))
+        if self.info["dtype"] == BINARY:
+            self.rescore = self._open_memmap(os.path.join(self.path, "rescore.bin"), np.float32, (capacity, self.info["dim"]))
+
+    def _ensure_capacity(self, rows_needed, dim):
+        if self.info["dim"] is None:
+            self.info["dim"] = dim
+        elif self.info["dim"] != dim:
+            raise ValueError(f"向量維度不符：集合為 {self.info['dim']}，傳入 {dim}")
+        if rows_needed <= self.info["capacity"] and self.vectors is not None:
+            return
+        capacity = max(INITIAL_CAPACITY, self.info["capacity"])
+        while capacity < rows_needed:
+            capacity *= 2
+        if self.vectors is not None:
+            self.vectors.flush()
+            self.vectors = None
+        if self.rescore is not None:
+            self.rescore.flush()
+            self.rescore = None
+        self.info["capacity"] = capacity
+        self._save_info()
+        self._open_vectors()
+
+    def _replay_records(self):
+        """從上次讀到的位置繼續重播 records.jsonl；尚未寫完整的最後一行留到下次再讀"""
+        records_path = os.path.join(self.path, "records.jsonl")
+        if not os.path.exists(records_path):
+            return
+        with open(records_path, "rb") as f:
+            f.seek(self._records_offset)
+            data = f.read()
+        complete = data[:data.rfind(b"\n") + 1]
+        if not complete:
+            return
+        self._records_offset += len(complete)
+        alive = self.alive.tolist()
+        for line in complete.decode("utf-8").splitlines():
+            record = json.loads(line)
+            if record["op"] == "add":
+                row = len(self.ids)
+                self.ids.append(record["id"])
+                self.documents.append(record["document"])
+                self.metadatas.append(record["metadata"])
+                alive.append(True)
+                self.id_to_row[record["id"]] = row
+            else:
+                row = record["row"]
+                alive[row] = False
+                if self.id_to_row.get(self.ids[row]) == row:
+                    del self.id_to_row[self.ids[row]]
+        self.alive = np.asarray(alive, dtype=bool)
+
+    def _append_records(self, records):
+        with open(os.path.join(self.path, "records.jsonl"), "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def _quantize(self, vectors):
+        if self.info["dtype"] == BINARY:
+            return pack_bits(vectors)
+        if self.info["dtype"] == "int8":
+            return np.clip(np.round(vectors * INT8_SCALE), -127, 127).astype(np.int8)
+        return vectors.astype(np.float16)
+
+    def _embed(self, texts):
+        if self.embedding_function is None:
+            raise ValueError("未設定 embedding_function，請直接提供 embeddings")
+        return self.embedding_function(texts)
+
+    # ---------- 寫入 ----------
+    @staticmethod
+    def _check_unique(ids):
+        """同一批內的重複 id 會讓較早的列無法刪除卻仍出現在搜尋結果中，與 ChromaDB 一樣直接拒絕"""
+        seen, duplicated = set(), set()
+        for doc_id in ids:
+            (duplicated if doc_id in seen else seen).add(doc_id)
+        if duplicated:
+            raise DuplicateIDError(f"同一批寫入的 id 必須唯一，重複的 id：{sorted(duplicated)[:10]}")
+
+    def add(self, ids, documents=None, metadatas=None, embeddings=None):
+        self._check_unique(ids)
+        # 在取得檔案鎖之前算好向量，不讓 embedding 時間佔住其他程序的寫入
+        if embeddings is None:
+            embeddings = self._embed(documents)
+        with self._lock, self._file_lock:
+            self._sync()
+            duplicated = [i for i in ids if i in self.id_to_row]
+            if duplicated:
+                print(f"[WARN] '{self.name}' 已存在 {len(duplicated)} 筆相同 id，略過新增")
+            self._insert(ids, documents, metadatas, embeddings, skip=set(duplicated))
+            self._mark_synced()
+
+    def upsert(self, ids, documents=None, metadatas=None, embeddings=None):
+        self._check_unique(ids)
+        if embeddings is None:
+            embeddings = self._embed(documents)
+        with self._lock, self._file_lock:
+            self._sync()
+            existing = [i for i in ids if i in self.id_to_row]
+            if existing:
+                self.delete(ids=existing)
+            self._insert(ids, documents, metadatas, embeddings, skip=set())
+            self._mark_synced()
+
+    def _insert(self, ids, documents, metadatas, embeddings, skip):
+        """呼叫端需持有檔案鎖並已 _sync，列號才不會與其他程序的寫入重疊"""
+        keep = [k for k, doc_id in enumerate(ids) if doc_id not in skip]
+        if not keep:
+            return
+        ids = [ids[k] for k in keep]
+        documents = [documents[k] for k in keep] if documents is not None else [None] * len(ids)
+        metadatas = [metadatas[k] for k in keep] if metadatas is not None else [{}] * len(ids)
+        vectors = normalize_rows([embeddings[k] for k in keep])
+
+        start = len(self.ids)
+        self._ensure_capacity(start + len(ids), vectors.shape[1])
+        self.vectors[start:start + len(ids)] = self._quantize(vectors)
+        self.vectors.flush()
+        if self.rescore is not None:
+            self.rescore[start:start + len(ids)] = vectors
+            self.rescore.flush()
+
+        self._append_records(
+            {"op": "add", "id": doc_id, "document": doc, "metadata": meta}
+            for doc_id, doc, meta in zip(ids, documents, metadatas)
+        )
+        for offset, doc_id in enumerate(ids):
+            self.id_to_row[doc_id] = start + offset
+        self.ids.extend(ids)
+        self.documents.extend(documents)
+        self.metadatas.extend(metadatas)
+        self.alive = np.concatenate([self.alive, np.ones(len(ids), dtype=bool)])
+
+    def delete(self, ids=None, where=None):
+        with self._lock, self._file_lock:
+            self._sync()
+            rows = self._select_rows(ids, where)
+            if len(rows) == 0:
+                return
+            self._append_records({"op": "del", "row": int(row)} for row in rows)
+            for row in rows:
+                self.alive[row] = False
+                del self.id_to_row[self.ids[row]]
+            self._mark_synced()
+            dead = len(self.ids) - int(self.alive.sum())
+            if len(self.ids) and dead / len(self.ids) > NUMPY_COMPACT_RATIO:
+                self.compact()
+
+    def compact(self):
+        """只保留存活的列，重寫向量檔與紀錄檔，釋放墓碑佔用的空間"""
+        with self._lock, self._file_lock:
+            self._sync()
+            rows = np.flatnonzero(self.alive)
+            print(f"[INFO] 壓縮 '{self.name}'：保留 {len(rows)} / {len(self.ids)} 筆")
+            vectors = np.array(self.vectors[rows]) if self.vectors is not None and len(rows) else None
+            rescore = np.array(self.rescore[rows]) if self.rescore is not None and len(rows) else None
+            self.ids = [self.ids[r] for r in rows]
+            self.documents = [self.documents[r] for r in rows]
+            self.metadatas = [self.metadatas[r] for r in rows]
+            self.alive = np.ones(len(rows), dtype=bool)
+            self.id_to_row = {doc_id: row for row, doc_id in enumerate(self.ids)}
+
+            records_path = os.path.join(self.path, "records.jsonl")
+            tmp_path = records_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for doc_id, doc, meta in zip(self.ids, self.documents, self.metadatas):
+                    f.write(json.dumps({"op": "add", "id": doc_id, "document": doc, "metadata": meta}, ensure_ascii=False) + "\n")
+            os.replace(tmp_path, records_path)
+
+            if self.vectors is not None:
+                self.vectors = None
+                self.rescore = None
+                for file_name in ("vectors.bin", "rescore.bin"):
+                    if os.path.exists(os.path.join(self.path, file_name)):
+                        os.remove(os.path.join(self.path, file_name))
+                self.info["capacity"] = 0
+                if vectors is not None:
+                    self._ensure_capacity(len(rows), self.info["dim"])
+                    self.vectors[:len(rows)] = vectors
+                    self.vectors.flush()
+                    if rescore is not None:
+                        self.rescore[:len(rows)] = rescore
+                        self.rescore.flush()
+                else:
+                    self._save_info()
+            self._mark_synced()
+
+    # ---------- 讀取 ----------
+    def count(self):
+        with self._lock:
+            self._refresh()
+            return int(self.alive.sum())
+
+    def _select_rows(self, ids=None, where=None):
+        if ids is not None:
+            rows = list(dict.fromkeys(self.id_to_row[i] for i in ids if i in self.id_to_row))
+        else:
+            rows = np.flatnonzero(self.alive).tolist()
+        if where:
+            rows = [r for r in rows if match_where(self.metadatas[r], where)]
+        return np.asarray(rows, dtype=np.int64)
+
+    def _decode(self, rows):
+        if self.info["dtype"] == BINARY:
+            return np.asarray(self.rescore[rows], dtype=np.float32)
+        vectors = np.asarray(self.vectors[rows], dtype=np.float32)
+        return vectors / INT8_SCALE if self.info["dtype"] == "int8" else vectors
+
+    def get(self, ids=None, where=None, limit=None, offset=None, include=("documents", "metadatas")):
+        with self._lock:
+            self._refresh()
+            rows = self._select_rows(ids, where)
+            rows = rows[(offset or 0):]
+            if limit is not None:
+                rows = rows[:limit]
+            result = {"ids": [self.ids[r] for r in rows]}
+            if "documents" in include:
+                result["documents"] = [self.documents[r] for r in rows]
+            if "metadatas" in include:
+                result["metadatas"] = [self.metadatas[r] for r in rows]
+            if "embeddings" in include:
+                result["embeddings"] = self._decode(rows) if len(rows) else np.zeros((0, self.info["dim"] or 0), dtype=np.float32)
+            return result
+
+    def search(self, query_vectors, n_results=1, where=None):
+        """
+        多查詢批次精確搜尋：以區塊矩陣乘法掃過 memmap，逐區塊合併 top-k。
+        回傳 (rows, scores)，形狀皆為 [查詢數, k]，分數為 cosine 相似度。
+        """
+        queries = normalize_rows(query_vectors)
+        with self._lock:
+            self._refresh()
+            total_rows = len(self.ids)
+            if self.vectors is None or total_rows == 0:
+                return np.zeros((len(queries), 0), dtype=np.int64), np.zeros((len(queries), 0), dtype=np.float32)
+            mask = self.alive.copy()
+            if where:
+                mask &= np.fromiter((match_where(m, where) for m in self.metadatas), dtype=bool, count=total_rows)
+            k = min(n_results, int(mask.sum()))
+            best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+            best_scores = np.zeros((len(queries), 0), dtype=np.float32)
+            if k == 0:
+                return best_rows, best_scores
+            if self.info["dtype"] == BINARY:
+                return self._search_binary(queries, mask, k)
+
+            for start in range(0, total_rows, NUMPY_SEARCH_BLOCK_ROWS):
+                end = min(start + NUMPY_SEARCH_BLOCK_ROWS, total_rows)
+                block_mask = mask[start:end]
+                if not block_mask.any():
+                    continue
+                block = np.asarray(self.vectors[start:end], dtype=np.float32)
+                scores = queries @ block.T
+                if self.info["dtype"] == "int8":
+                    scores /= INT8_SCALE
+                scores[:, ~block_mask] = -np.inf
+                block_k = min(k, end - start)
+                top = np.argpartition(-scores, block_k - 1, axis=1)[:, :block_k]
+                best_rows = np.concatenate([best_rows, top + start], axis=1)
+                best_scores = np.concatenate([best_scores, np.take_along_axis(scores, top, axis=1)], axis=1)
+                if best_rows.shape[1] > k:
+                    keep = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+                    best_rows = np.take_along_axis(best_rows, keep, axis=1)
+                    best_scores = np.take_along_axis(best_scores, keep, axis=1)
+
+            order = np.argsort(-best_scores, axis=1)
+            return np.take_along_axis(best_rows, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+    def _search_binary(self, queries, mask, k):
+        """
+        兩階段搜尋：先以 Hamming 距離掃過 bit 矩陣取 k × NUMPY_RESCORE_FACTOR 個候選，
+        再從 rescore.bin 讀取候選列的 float32 向量計算 cosine，取前 k 筆。
+        """
+        total_rows = len(self.ids)
+        candidates = min(int(mask.sum()), k * max(1, NUMPY_RESCORE_FACTOR))
+        query_bits = pack_bits(queries)
+        # 被過濾掉的列給一個比任何 Hamming 距離都大的值
+        excluded = self._row_width() * 64 + 1
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+        best_distances = np.zeros((len(queries), 0), dtype=np.int32)
+        for start in range(0, total_rows, NUMPY_SEARCH_BLOCK_ROWS):
+            end = min(start + NUMPY_SEARCH_BLOCK_ROWS, total_rows)
+            block_mask = mask[start:end]
+            if not block_mask.any():
+                continue
+            distances = hamming_distances(query_bits, np.asarray(self.vectors[start:end]))
+            distances[:, ~block_mask] = excluded
+            block_c = min(candidates, end - start)
+            top = np.argpartition(distances, block_c - 1, axis=1)[:, :block_c]
+            best_rows = np.concatenate([best_rows, top + start], axis=1)
+            best_distances = np.concatenate([best_distances, np.take_along_axis(distances, top, axis=1)], axis=1)
+            if best_rows.shape[1] > candidates:
+                keep = np.argpartition(best_distances, candidates - 1, axis=1)[:, :candidates]
+                best_rows = np.take_along_axis(best_rows, keep, axis=1)
+                best_distances = np.take_along_axis(best_distances, keep, axis=1)
+
+        result_rows, result_scores = [], []
+        for query, rows in zip(queries, best_rows):
+            # 依列號排序後讀取，memmap 的磁碟存取較連續
+            rows = np.sort(rows[mask[rows]])
+            scores = np.asarray(self.rescore[rows], dtype=np.float32) @ query
+            top = np.argsort(-scores)[:k]
+            result_rows.append(rows[top])
+            result_scores.append(scores[top])
+        return np.stack(result_rows), np.stack(result_scores)
+
+    def query(self, query_texts=None, query_embeddings=None, n_results=10, where=None,
+              include=("documents", "metadatas", "distances")):
+        if query_embeddings is None:
+            query_embeddings = self._embed(query_texts)
+        rows, scores = self.search(query_embeddings, n_results=n_results, where=where)
+        result = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+        for row_list, score_list in zip(rows, scores):
+            valid = [(r, s) for r, s in zip(row_list, score_list) if np.isfinite(s)]
+            result["ids"].append([self.ids[r] for r, _ in valid])
+            result["documents"].append([self.documents[r] for r, _ in valid])
+            result["metadatas"].append([self.metadatas[r] for r, _ in valid])
+            result["distances"].append([float(1 - s) for _, s in valid])
+        return {key: value for key, value in result.items() if key == "ids" or key in include}
+
+
+class NumpyClient:
+    """與 chromadb.PersistentClient 相同用法的最小介面，讓 init_collections 可直接切換後端"""
+
+    def __init__(self, path=NUMPY_DB_PATH, dtype=NUMPY_STORE_DTYPE):
+        self.path = path
+        self.dtype = dtype
+        self._collections = {}
+        os.makedirs(path, exist_ok=True)
+
+    def get_or_create_collection(self, name, metadata=None, embedding_function=None):
+        if name not in self._collections:
+            self._collections[name] = NumpyCollection(
+                os.path.join(self.path, name), name, metadata, embedding_function, dtype=self.dtype
+            )
+        self._collections[name].embedding_function = embedding_function
+        return self._collections[name]
+
+    def get_collection(self, name, embedding_function=None):
+        if name not in self._collections and not os.path.exists(os.path.join(self.path, name, "info.json")):
+            raise ValueError(f"集合 '{name}' 不存在")
+        return self.get_or_create_collection(name, embedding_function=embedding_function)
+
+    def delete_collection(self, name):
+        self._collections.pop(name, None)
+        shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+
+    def list_collections(self):
+        return sorted(os.listdir(self.path))
+
+    def get_max_batch_size(self):
+        return 100000
@@ -1,21 +1,37 @@
 import os
 import fitz  # PyMuPDF
 import io
+import hashlib
 import math
 from PIL import Image
 import pytesseract
-import pdf_text_chunker
+import layout_chunker
 import image_processor
+import image_payload
+import description_cache
+from memory_budget import memory_budget
+from profiler import stage
 
 # 設定 Tesseract OCR 執行檔路徑
 pytesseract.pytesseract.tesseract_cmd = r"C:/Program Files/Tesseract-OCR/tesseract.exe"
 
+# 頁面視覺分類時，像素寬高都至少這麼大的嵌入圖片才視為實際圖片
+FIGURE_MIN_PIXELS = int(os.getenv("FIGURE_MIN_PIXELS", "16"))
+
 def is_valid_image(img):
-    img = img.convert("RGB")
-    colors = img.getcolors(maxcolors=img.size[0] * img.size[1])
-    if colors is None:
-        return True
-    return len(colors) != 1
+    """
+    單色圖片視為無效。以各通道的極值判斷，
+    不必先轉成 RGB 再列出所有顏色（大圖會多出一整張複本與同樣大小的顏色表）。
+    """
+    if img.mode not in ("1", "L", "P", "RGB", "RGBA", "LA"):
+        img = img.convert("RGB")
+    extrema = img.getextrema()
+    if not isinstance(extrema[0], tuple):
+        extrema = (extrema,)
+    # 與先前轉成 RGB 的判斷一致：不看 alpha 通道
+    if img.mode in ("RGBA", "LA"):
+        extrema = extrema[:-1]
+    return any(low != high for low, high in extrema)
 
 def boxes_distance(bbox1, bbox2):
     x1, y1, x2, y2 = bbox1
@@ -47,20 +63,97 @@ def merge_overlapping_boxes(boxes, threshold=0):
         boxes = new_boxes
     return boxes
 
-def pdf_page_to_image(pdf_path, page_number):
-    doc = fitz.open(pdf_path)
-    page = doc.load_page(page_number)
-    pix = page.get_pixmap(matrix=fitz.Matrix(3, 3))
-    img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+def pdf_page_to_image(pdf_path, page_number, zoom=3):
+    """以 zoom 倍率渲染頁面為 PIL 圖片；大尺寸頁面依記憶體預算自動降低倍率"""
+    with fitz.open(pdf_path) as doc:
+        page = doc.load_page(page_number)
+        pix = page.get_pixmap(matrix=memory_budget.render_matrix(page.rect, zoom), alpha=False)
+        memory_budget.record_pixmap(pix)
+        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+        del pix
     return img
 
-def process_pdf_with_ocr(pdf_path, chunk_size=512, merge_threshold=20, padding=10, ignore_image_processing=False):
+def pdf_page_to_payload(pdf_path, page_number):
+    """
+    依照 image_payload 的策略（尺寸上限、編碼格式、品質）渲染頁面，
+    直接由 pixmap 編碼，不經過 PIL。回傳 (image_bytes, mime_type, detail)。
+    """
+    with fitz.open(pdf_path) as doc:
+        page = doc.load_page(page_number)
+        return image_payload.render_page_payload(page)
+
+def rect_area(rect):
+    x0, y0, x1, y1 = rect
+    return max(0.0, x1 - x0) * max(0.0, y1 - y0)
+
+def page_visual_stats(page):
+    """
+    以 PyMuPDF 的輕量資訊統計頁面的視覺內容（不需渲染）：
+    圖片數與覆蓋率、最大一張實際圖片的覆蓋率、向量繪圖數與覆蓋率、文字區塊覆蓋率。
+    """
+    page_area = rect_area(page.rect) or 1.0
+    image_infos = page.get_image_info()
+    drawings = page.get_drawings()
+    text_blocks = [b for b in page.get_text("blocks") if b[6] == 0]
+    image_areas = [rect_area(info["bbox"]) for info in image_infos]
+    # 1x1 之類被拉伸的填色圖（分隔線、底色）不算實際圖片
+    figure_areas = [rect_area(info["bbox"]) for info in image_infos
+                    if min(info["width"], info["height"]) >= FIGURE_MIN_PIXELS]
+    return {
+        "images": len(image_infos),
+        "image_coverage": min(1.0, sum(image_areas) / page_area),
+        "largest_image_coverage": min(1.0, max(figure_areas, default=0.0) / page_area),
+        "drawings": len(drawings),
+        "drawing_coverage": min(1.0, sum(rect_area(d["rect"]) for d in drawings) / page_area),
+        "text_coverage": min(1.0, sum(rect_area(b[:4]) for b in text_blocks) / page_area),
+    }
+
+def page_visual_score(stats):
+    """
+    視覺內容分數（0~1）：圖片與繪圖覆蓋率為主，繪圖數量多（圖表、流程圖）另外加分；
+    幾乎整頁都是文字時降低分數，避免頁首線、表格框線讓純文字頁被送去描述。
+    """
+    score = stats["image_coverage"] + stats["drawing_coverage"] + min(stats["drawings"], 100) / 1000
+    if stats["images"] == 0 and stats["text_coverage"] > 0.6:
+        score *= 0.5
+    return min(1.0, score)
+
+def page_content_digest(page):
+    """
+    頁面內容的 hash（不需渲染）：頁面大小與旋轉、內容串流，以及頁面引用的圖片與 Form XObject 的原始串流。
+    與渲染倍率、編碼格式無關，IMAGE_* 設定或記憶體降級改變時，內容不變的頁面 hash 不變。
+    各串流先各自 hash 再排序，PDF 重新存檔造成 xref 編號改變也不受影響。
+    """
+    doc = page.parent
+    xrefs = {info[0] for info in page.get_images(full=True)} | {info[0] for info in page.get_xobjects()}
+    stream_digests = sorted(hashlib.sha256(doc.xref_stream_raw(xref) or b"").hexdigest() for xref in xrefs)
+    hasher = hashlib.sha256(f"{tuple(page.rect)}:{page.rotation}".encode("utf-8"))
+    hasher.update(page.read_contents())
+    for digest in stream_digests:
+        hasher.update(digest.encode("ascii"))
+    return hasher.hexdigest()
+
+def page_content_digests(pdf_path):
+    """回傳 {page_index: 頁面內容 hash}，供 plan_pdf_chunks 產生圖片 chunk id"""
+    with fitz.open(pdf_path) as doc:
+        return {page_index: page_content_digest(page) for page_index, page in enumerate(doc)}
+
+def score_pdf_pages(pdf_path):
+    """回傳 {page_index: (score, stats)}，供 process_pdf_changes 判斷哪些頁面需要送 VLM 描述"""
+    scores = {}
+    with fitz.open(pdf_path) as doc:
+        for page_index, page in enumerate(doc):
+            stats = page_visual_stats(page)
+            scores[page_index] = (page_visual_score(stats), stats)
+    return scores
+
+def process_pdf_with_ocr(pdf_path, chunk_tokens=layout_chunker.CHUNK_MAX_TOKENS, merge_threshold=20, padding=10, ignore_image_processing=False):
     print(f"\n[INFO] 開始處理 PDF: {pdf_path}")
     pdf_basename = os.path.splitext(os.path.basename(pdf_path))[0]
 
-    # 文字區塊處理
-    text_blocks = pdf_text_chunker.extract_text_blocks(pdf_path)
-    split_texts = pdf_text_chunker.split_text_blocks(text_blocks, chunk_size=chunk_size)
+    # 文字區塊處理：依閱讀順序逐頁擷取，以 token 數切塊
+    with stage("layout_chunk"):
+        split_texts = layout_chunker.chunk_pdf(pdf_path, max_tokens=chunk_tokens)
     
     if ignore_image_processing:
         print("[INFO] 已啟用 ignore_image_processing，將略過所有圖片處理。")
@@ -76,6 +169,7 @@ def process_pdf_with_ocr(pdf_path, chunk_size=512, merge_threshold=20, padding=1
     for page_index in range(len(pdf_file)):
         print(f"[INFO] 處理第 {page_index + 1} 頁...")
         page = pdf_file.load_page(page_index)
+        page_digest = None
         image_list = page.get_images(full=True)
         image_info_list = page.get_image_info(hashes=False, xrefs=True)
 
@@ -83,14 +177,16 @@ def process_pdf_with_ocr(pdf_path, chunk_size=512, merge_threshold=20, padding=1
         if image_list:
             for img_idx, img_info in enumerate(image_list):
                 xref = img_info[0]
-                base_image = pdf_file.extract_image(xref)
-                image_bytes = base_image["image"]
-                img_ind = Image.open(io.BytesIO(image_bytes))
-                if not is_valid_image(img_ind):
-                    print(f"[INFO] 單色圖片跳過: {pdf_basename}_page{page_index+1}_img{img_idx+1}.png")
-                    continue
-                output_path_ind = os.path.join(output_folder_individual, f"{pdf_basename}_page{page_index+1}_img{img_idx+1}.png")
-                img_ind.save(output_path_ind)
+                with stage("image_extract"):
+                    base_image = pdf_file.extract_image(xref)
+                    # 每張圖片只保留一份解碼結果，存檔後立即釋放，避免整頁的圖片同時留在記憶體
+                    with Image.open(io.BytesIO(base_image.pop("image"))) as img_ind:
+                        if not is_valid_image(img_ind):
+                            print(f"[INFO] 單色圖片跳過: {pdf_basename}_page{page_index+1}_img{img_idx+1}.png")
+                            continue
+                        output_path_ind = os.path.join(output_folder_individual, f"{pdf_basename}_page{page_index+1}_img{img_idx+1}.png")
+                        img_ind.save(output_path_ind)
+                memory_budget.sample()
                 valid_image_info_list.append(image_info_list[img_idx])
 
         if not valid_image_info_list:
@@ -106,27 +202,34 @@ def process_pdf_with_ocr(pdf_path, chunk_size=512, merge_threshold=20, padding=1
                 bbox[2] + padding, bbox[3] + padding
             )
             clip_rect = fitz.Rect(padded_bbox)
-            pix = page.get_pixmap(clip=clip_rect)
-            if pix.width == 0 or pix.height == 0:
-                continue
-            img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-
-            buffer = io.BytesIO()
-            img.save(buffer, format="PNG")
-            image_bytes = buffer.getvalue()
-
-            description = image_processor.describe_image_with_azure(image_bytes=image_bytes)
+            with stage("render_crop"):
+                pix = page.get_pixmap(matrix=memory_budget.render_matrix(clip_rect, 1), clip=clip_rect, alpha=False)
+                if pix.width == 0 or pix.height == 0:
+                    continue
+                memory_budget.record_pixmap(pix)
+                # 直接由 pixmap 編碼成 PNG，描述、CLIP 計分與存檔共用同一份 bytes，不再經過 PIL 複本
+                image_bytes = pix.tobytes("png")
+                del pix
+
+            with stage("vlm_describe"):
+                # 以頁面內容 hash 加上裁切範圍快取描述（不受記憶體降級時的渲染倍率影響），
+                # 未改變的圖片每次得到相同描述，合併後的 chunk id 才會穩定
+                page_digest = page_digest or page_content_digest(page)
+                description = description_cache.describe_image(
+                    image_bytes, content_key=f"crop:{page_digest}:{tuple(round(v, 2) for v in clip_rect)}"
+                )
             print(f"[DEBUG] Azure 圖片描述：{description}")
             
-            # 這裡使用 CLIP 模型找最相符文字區塊
+            # 這裡使用 CLIP 模型找最相符文字區塊：同頁所有區塊一次批次計分
             max_score = -1.0
             best_index = None
-            for index, split in enumerate(split_texts):
-                if split["page"] == page_index:
-                    score = image_processor.get_clip_cosine_score(image_bytes, split["text"])
-                    if score > max_score:
-                        max_score = score
-                        best_index = index
+            page_indices = [index for index, split in enumerate(split_texts) if split["page"] == page_index]
+            with stage("clip_score"):
+                scores = image_processor.get_clip_cosine_scores(image_bytes, [split_texts[i]["text"] for i in page_indices])
+            for index, score in zip(page_indices, scores):
+                if score > max_score:
+                    max_score = score
+                    best_index = index
 
             if best_index is not None:
                 print(f"[DEBUG] 對應到的文字區塊 index={best_index}")
@@ -135,7 +238,8 @@ def process_pdf_with_ocr(pdf_path, chunk_size=512, merge_threshold=20, padding=1
                 print(f"[INFO] 合併到區塊 index={best_index} 分數={max_score:.4f}")
 
             output_path_merged = os.path.join(output_folder_merged, f"{pdf_basename}_page{page_index+1}_box{idx+1}.png")
-            img.save(output_path_merged)
+            with open(output_path_merged, "wb") as f:
+                f.write(image_bytes)
             print(f"[INFO] 儲存合併後圖片：{output_path_merged}")
 
     print(f"[INFO] 完成處理，共 {len(split_texts)} 區塊")
@@ -1,7 +1,8 @@
 import os
 import shutil
+import hashlib
+from collections import Counter
 from pathlib import Path
-from io import BytesIO
 import comtypes.client
 import win32com.client
 from docx2pdf import convert as docx_to_pdf
@@ -9,14 +10,32 @@ from pptx import Presentation
 
 import file_hashes
 import pdf_chunker
-import pdf_text_chunker
-import image_processor
-from vector_db import add_documents_to_collection, delete_documents_from_collection
+import layout_chunker
+import image_payload
+import description_cache
+from memory_budget import memory_budget
+from profiler import profile_session, stage
+from vector_db import (
+    upsert_documents_to_collection,
+    delete_documents_from_collection,
+    delete_ids_from_collection,
+    get_file_chunk_ids,
+)
+from answer_cache import answer_cache
+from dedup_index import get_dedup_index, DEDUP_ENABLED
+from retrieval_cache import bump_generation
+from hierarchical_index import update_summaries, HIERARCHICAL_INDEX_ENABLED
 
 # 載入環境變數
 RAG_FILE_PATH = os.getenv("RAG_FILE_PATH")        # 轉換後 PDF 要存放的資料夾
 RAG_RAW_FILE_PATH = os.getenv("RAG_RAW_FILE_PATH")  # 原始檔案（pdf/doc/docx/pptx）的資料夾
 
+# 頁面視覺分類：分數低於門檻的純文字頁不送 VLM 描述
+VISUAL_TRIAGE_ENABLED = os.getenv("VISUAL_TRIAGE_ENABLED", "true").lower() == "true"
+VISUAL_TRIAGE_THRESHOLD = float(os.getenv("VISUAL_TRIAGE_THRESHOLD", "0.05"))
+# 含有單張面積達頁面此比例的嵌入圖片時一律描述，不看分數（小圖示、logo 以下的圖片不算）
+VISUAL_TRIAGE_MIN_IMAGE_AREA = float(os.getenv("VISUAL_TRIAGE_MIN_IMAGE_AREA", "0.005"))
+
 # 確保處理後的資料夾存在
 os.makedirs(RAG_FILE_PATH, exist_ok=True)
 
@@ -157,16 +176,48 @@ def convert_to_pdf(input_path: str) -> str:
         return None
 
 
-def process_files():
+def content_chunk_id(file_type, page_num, kind, content, seen):
+    """
+    以內容 hash 加上頁碼錨點產生 chunk id，例如 report_page3_txt_1a2b3c4d5e6f7a8b。
+    同一頁出現完全相同內容時，依出現順序加上 _2、_3 後綴，避免 id 重複。
+    插入或修改某段文字只會改變該段的 id，其餘 chunk 的 id 不受影響。
+    """
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    base = f"{file_type}_page{page_num}_{kind}_{hashlib.sha1(content).hexdigest()[:16]}"
+    seen[base] += 1
+    return base if seen[base] == 1 else f"{base}_{seen[base]}"
+
+
+def stored_text_chunk_ids(text_collection, file_name, dedup):
+    """向量庫中該檔案的 chunk id，加上去重索引中記為重複（未寫入向量庫）的 id"""
+    ids = get_file_chunk_ids(text_collection, file_name)
+    if dedup is not None:
+        ids |= dedup.reference_ids_for_file(file_name)
+    return ids
+
+
+def remove_text_chunks(text_collection, chunk_ids, dedup):
+    if dedup is not None:
+        dedup.remove(text_collection, chunk_ids)
+    else:
+        delete_ids_from_collection(text_collection, chunk_ids)
+
+
+def process_files(raw_paths=None):
     """
     增量式地轉換與刪除：
-      - 先呼叫 file_hashes.check_for_changes，拿到 raw 資料夾中「修改或新增」以及「刪除」的檔案清單。
+      - 先呼叫 file_hashes.check_for_changes，拿到 raw 資料夾中「修改或新增」以及「刪除」的檔案清單；
+        若有指定 raw_paths（例如檔案監控事件），只檢查這些檔案，不掃描整個資料夾。
       - 針對修改/新增的檔案，呼叫 convert_to_pdf，回傳轉換後的 PDF 路徑（若成功）。    
       - 針對刪除的檔案，刪除對應的輸出 PDF，並回傳被刪除的 PDF 路徑。
     回傳 tuple： (converted_pdf_paths, deleted_pdf_paths)
     """
     # 1. 取得 raw 資料夾中「新增/修改」與「刪除」的檔名（full path）
-    changed_raw_paths, deleted_raw_paths = file_hashes.check_for_changes(RAG_RAW_FILE_PATH)
+    if raw_paths is None:
+        changed_raw_paths, deleted_raw_paths = file_hashes.check_for_changes(RAG_RAW_FILE_PATH)
+    else:
+        changed_raw_paths, deleted_raw_paths = file_hashes.check_paths_for_changes(raw_paths)
 
     converted_pdfs = []
     deleted_pdfs = []
@@ -191,46 +242,53 @@ def process_files():
     return converted_pdfs, deleted_pdfs
 
 
-def process_pdf_changes(text_collection: str, image_collection: str, ignore_image_processing: bool = False):
-    """
-    呼叫 process_files 取得「新增/修改的 PDF 路徑」與「已刪除的 PDF 路徑」，
-    並將它們同步到向量資料庫：
-      1. 先把所有被刪除或修改 (changed) 的 PDF IDs 從 text_collection 與 image_collection 刪除。
-      2. 針對每個修改/新增的 PDF，做文字分塊與圖片描述，然後新增到向量庫。
-    """
-    changed_pdfs, deleted_pdfs = process_files()
-
-    # 統一把 deleted + changed 當作要刪除的 document IDs（因為如果同一份檔案被修改，先刪除舊版本）
-    # 這邊約定：ID 用 PDF 檔名（不含資料夾）
-    deleted_doc_ids = [os.path.basename(p).rsplit(".", 1)[0] for p in deleted_pdfs + changed_pdfs]
-    delete_documents_from_collection(text_collection, deleted_doc_ids)
-    delete_documents_from_collection(image_collection, deleted_doc_ids)
+def chunk_pdf_for_index(pdf_path, ignore_image_processing=False):
+    """嘗試用 OCR 做文字分塊，若失敗改純文字"""
+    try:
+        return pdf_chunker.process_pdf_with_ocr(
+            pdf_path,
+            merge_threshold=80,
+            padding=40,
+            ignore_image_processing=ignore_image_processing,
+        )
+    except Exception as e:
+        print(f"[WARN] OCR 處理失敗，改用純文字分塊: {e}")
+        return layout_chunker.chunk_pdf(pdf_path)
 
-    # 處理每一個修改/新增的 PDF
-    for pdf_path in changed_pdfs:
-        pdf_name = os.path.basename(pdf_path)
-        file_type = Path(pdf_name).stem  # 當作 ID prefix
 
-        # 1) 嘗試用 OCR 做文字分塊，若失敗改純文字
-        try:
-            pdf_chunks = pdf_chunker.process_pdf_with_ocr(
-                pdf_path,
-                merge_threshold=80,
-                padding=40,
-                ignore_image_processing=ignore_image_processing,
-            )
-        except Exception as e:
-            print(f"[WARN] OCR 處理失敗，改用純文字分塊: {e}")
-            text_blocks = pdf_text_chunker.extract_text_blocks(pdf_path)
-            pdf_chunks = pdf_text_chunker.split_text_blocks(text_blocks, chunk_size=512)
-
-        text_doc_ids, text_documents, text_metadatas = [], [], []
-        image_doc_ids, image_documents, image_metadatas = [], [], []
-        processed_pages = set()
-
-        for idx, chunk in enumerate(pdf_chunks):
-            page_num = chunk["page"]
-            text_id = f"{file_type}_page{page_num}_txt{idx}"
+def plan_pdf_chunks(pdf_path, ignore_image_processing=False, known_text_ids=frozenset(), known_image_ids=frozenset()):
+    """
+    將一份 PDF 分塊並產生內容 hash id，回傳待寫入的內容：
+      - text / image：不在 known_*_ids 中的 chunk（ids, documents, metadatas）
+      - text_ids / image_ids：這份 PDF 目前應有的所有 chunk id
+    known_image_ids 中已有的頁面不再呼叫 VLM 描述。
+    """
+    pdf_name = os.path.basename(pdf_path)
+    file_type = Path(pdf_name).stem  # 當作 ID prefix
+    with stage("chunk"):
+        pdf_chunks = chunk_pdf_for_index(pdf_path, ignore_image_processing)
+
+    text_doc_ids, text_documents, text_metadatas = [], [], []
+    image_doc_ids, image_documents, image_metadatas = [], [], []
+    current_text_ids, current_image_ids = set(), set()
+    text_seen, image_seen = Counter(), Counter()
+    processed_pages = set()
+    skipped_pages = set()
+    reused_pages = set()
+    visual_scores, page_digests = {}, {}
+    if not ignore_image_processing:
+        if VISUAL_TRIAGE_ENABLED:
+            with stage("visual_triage"):
+                visual_scores = pdf_chunker.score_pdf_pages(pdf_path)
+        with stage("page_digest"):
+            page_digests = pdf_chunker.page_content_digests(pdf_path)
+
+    for chunk in pdf_chunks:
+        page_num = chunk["page"]
+        text_id = content_chunk_id(file_type, page_num, "txt", chunk["text"], text_seen)
+        current_text_ids.add(text_id)
+        # 內容未變的 chunk 已在向量庫中，不必重新 Embedding
+        if text_id not in known_text_ids:
             text_doc_ids.append(text_id)
             text_documents.append(chunk["text"])
             text_metadatas.append({
@@ -240,35 +298,160 @@ def process_pdf_changes(text_collection: str, image_collection: str, ignore_imag
                 "file_name": pdf_name
             })
 
-            # 如果不需要 image 處理或這頁已處理過，就跳過
-            if ignore_image_processing or page_num in processed_pages:
-                continue
-            processed_pages.add(page_num)
-
-            # 從 PDF 這頁擷取圖片、轉成 bytes，丟給 Azure 產生描述
-            img = pdf_chunker.pdf_page_to_image(pdf_path, page_num)
-            buf = BytesIO()
-            img.save(buf, format="PNG")
-            image_bytes = buf.getvalue()
-            image_desc = image_processor.describe_image_with_azure(image_bytes=image_bytes) or ""
-
-            image_id = f"{file_type}_page{page_num}_img"
-            image_doc_ids.append(image_id)
-            image_documents.append(image_desc)
-            image_metadatas.append({
-                "content_type": "image",
-                "page": page_num,
-                "file_type": file_type,
-                "file_name": pdf_name
-            })
+        # 如果不需要 image 處理或這頁已處理過，就跳過
+        if ignore_image_processing or page_num in processed_pages:
+            continue
+        processed_pages.add(page_num)
+
+        # 沒有實際圖片、視覺內容分數又過低（純文字頁）就不渲染也不呼叫 VLM；
+        # 有嵌入圖片的頁面即使圖片小、覆蓋率低也可能是重要的圖表，一律描述
+        score, stats = visual_scores.get(page_num, (1.0, None))
+        has_figure = stats is not None and stats["largest_image_coverage"] >= VISUAL_TRIAGE_MIN_IMAGE_AREA
+        if not has_figure and score < VISUAL_TRIAGE_THRESHOLD:
+            skipped_pages.add(page_num)
+            continue
+
+        # 以頁面內容 hash（不需渲染，與 IMAGE_* 設定、記憶體降級無關）當作圖片 id，
+        # 頁面內容沒變就沿用既有描述，不渲染也不呼叫 VLM
+        page_digest = page_digests[page_num]
+        image_id = content_chunk_id(file_type, page_num, "img", page_digest, image_seen)
+        current_image_ids.add(image_id)
+        if image_id in known_image_ids:
+            reused_pages.add(page_num)
+            continue
+
+        # 依 payload 策略直接從 pixmap 編碼成 bytes，只有需要描述的頁面才渲染
+        with stage("render_payload"):
+            image_bytes, mime_type, detail = pdf_chunker.pdf_page_to_payload(pdf_path, page_num)
+        with stage("vlm_describe"):
+            image_desc = description_cache.describe_image(image_bytes, mime_type, detail,
+                                                          content_key=f"page:{page_digest}") or ""
+
+        image_doc_ids.append(image_id)
+        image_documents.append(image_desc)
+        image_metadatas.append({
+            "content_type": "image",
+            "page": page_num,
+            "file_type": file_type,
+            "file_name": pdf_name
+        })
+
+    if not ignore_image_processing:
+        print(
+            f"[INFO] {pdf_name} 頁面視覺分類：描述 {len(processed_pages) - len(skipped_pages) - len(reused_pages)} 頁，"
+            f"沿用 {len(reused_pages)} 頁，略過 {len(skipped_pages)} 頁（門檻 {VISUAL_TRIAGE_THRESHOLD}）"
+        )
+
+    return {
+        "text": (text_doc_ids, text_documents, text_metadatas),
+        "image": (image_doc_ids, image_documents, image_metadatas),
+        "text_ids": current_text_ids,
+        "image_ids": current_image_ids,
+    }
+
+
+def process_pdf_changes(text_collection: str, image_collection: str, ignore_image_processing: bool = False, raw_paths=None):
+    """
+    呼叫 process_files 取得「新增/修改的 PDF 路徑」與「已刪除的 PDF 路徑」（raw_paths 可限定只檢查哪些原始檔），
+    並將它們同步到向量資料庫：
+      1. 被刪除的 PDF：從 text_collection 與 image_collection 刪除該檔案的所有資料。
+      2. 新增/修改的 PDF：重新分塊後以內容 hash 產生 chunk id，與向量庫中該檔案既有的 id 比對，
+         只對新增或內容改變的 chunk 做 Embedding（與圖片描述）並 upsert，已不存在的 chunk 才刪除。
+    """
+    changed_pdfs, deleted_pdfs = process_files(raw_paths)
+    sync_pdfs(text_collection, image_collection, changed_pdfs, deleted_pdfs, ignore_image_processing)
+    return deleted_pdfs, changed_pdfs
+
 
-        # 最後把所有新產出的 text / image documents 加到向量庫
+def sync_pdfs(text_collection, image_collection, changed_pdfs, deleted_pdfs, ignore_image_processing=False, dedup_path=None):
+    """將指定的新增/修改與刪除的 PDF 以 chunk 差異同步到集合；dedup_path 可指定去重索引檔（預設依目前世代）"""
+    # PROFILE=run 剖析整次匯入，PROFILE=document 則每份文件各自一個剖析結果
+    with profile_session("run", "ingest"):
+        _sync_pdfs(text_collection, image_collection, changed_pdfs, deleted_pdfs, ignore_image_processing, dedup_path)
+
+
+def _sync_pdfs(text_collection, image_collection, changed_pdfs, deleted_pdfs, ignore_image_processing, dedup_path):
+    dedup = get_dedup_index(dedup_path) if DEDUP_ENABLED else None
+    embeddings_avoided = 0
+
+    with stage("chroma_delete"):
+        for pdf_path in deleted_pdfs:
+            pdf_name = os.path.basename(pdf_path)
+            remove_text_chunks(text_collection, stored_text_chunk_ids(text_collection, pdf_name, dedup), dedup)
+        delete_documents_from_collection(image_collection, deleted_pdfs)
+    # 來源檔案被修改或刪除時，引用到它的快取答案一併失效：開始前先失效一次，不再回傳舊內容的答案；
+    # 匯入期間的查詢可能看到只更新一半的集合並寫入新答案，全部寫完後再失效一次
+    affected_files = [os.path.basename(p) for p in list(deleted_pdfs) + list(changed_pdfs)]
+    answer_cache.invalidate_files(affected_files)
+
+    # 處理每一個修改/新增的 PDF
+    for pdf_path in changed_pdfs:
+        with profile_session("document", os.path.basename(pdf_path)):
+            embeddings_avoided += sync_one_pdf(text_collection, image_collection, pdf_path, dedup, ignore_image_processing)
+
+    if dedup is not None:
+        print(f"[INFO] 本次匯入因去重省下 {embeddings_avoided} 次 Embedding")
+        dedup.report(text_collection)
+
+    # 以更新後的 chunk 向量重算文件 / 頁面摘要向量，供階層式檢索的第一階段使用
+    if HIERARCHICAL_INDEX_ENABLED:
+        with stage("summaries"):
+            update_summaries(
+                text_collection,
+                [os.path.basename(p) for p in changed_pdfs],
+                [os.path.basename(p) for p in deleted_pdfs],
+            )
+    answer_cache.invalidate_files(affected_files)
+
+    # 回報本次送往 VLM 的圖片 bytes / token 與節省量，之後歸零讓查詢階段另外統計
+    image_payload.payload_stats.report()
+    image_payload.payload_stats.reset()
+    memory_budget.report()
+
+
+def sync_one_pdf(text_collection, image_collection, pdf_path, dedup, ignore_image_processing=False):
+    """同步一份新增/修改的 PDF，回傳因去重省下的 Embedding 次數"""
+    pdf_name = os.path.basename(pdf_path)
+
+    # 向量庫中這個檔案目前已有的 chunk id
+    with stage("chroma_get"):
+        stored_text_ids = stored_text_chunk_ids(text_collection, pdf_name, dedup)
+        stored_image_ids = get_file_chunk_ids(image_collection, pdf_name)
+    # 記錄這份文件處理期間的 RSS 峰值；接近記憶體上限時先暫停，等其他工作釋放記憶體
+    with memory_budget.track(pdf_name):
+        memory_budget.wait_for_headroom()
+        plan = plan_pdf_chunks(pdf_path, ignore_image_processing, stored_text_ids, stored_image_ids)
+    text_doc_ids, text_documents, text_metadatas = plan["text"]
+    image_doc_ids, image_documents, image_metadatas = plan["image"]
+
+    # 只寫入新增/改變的 chunk，只刪除已不存在的 chunk（含舊版以位置編號的 id）
+    removed_text_ids = stored_text_ids - plan["text_ids"]
+    removed_image_ids = stored_image_ids - plan["image_ids"]
+    print(
+        f"[INFO] {pdf_name} 文字 chunk：新增 {len(text_doc_ids)}，刪除 {len(removed_text_ids)}，"
+        f"未變 {len(plan['text_ids']) - len(text_doc_ids)}"
+    )
+    with stage("chroma_delete"):
+        remove_text_chunks(text_collection, removed_text_ids, dedup)
+        delete_ids_from_collection(image_collection, removed_image_ids)
+    # 近似重複的 chunk 只記 back-reference，不寫入向量庫也不計算 Embedding
+    duplicates = 0
+    if dedup is not None and text_documents:
+        with stage("dedup"):
+            text_doc_ids, text_documents, text_metadatas, duplicates = dedup.filter_new_chunks(
+                text_doc_ids, text_documents, text_metadatas
+            )
+        print(f"[INFO] {pdf_name} 近似重複 chunk：{duplicates} 筆改記為 back-reference")
+        if duplicates:
+            # back-reference 會出現在限定此文件的檢索結果中，讓快取的結果與子索引失效
+            bump_generation(text_collection)
+    # upsert 內含 Embedding 計算與 ChromaDB 寫入
+    with stage("embed_upsert"):
         if text_documents:
-            add_documents_to_collection(text_collection, text_documents, text_doc_ids, text_metadatas)
+            upsert_documents_to_collection(text_collection, text_documents, text_doc_ids, text_metadatas)
         if image_documents and not ignore_image_processing:
-            add_documents_to_collection(image_collection, image_documents, image_doc_ids, image_metadatas)
-
-    return deleted_pdfs, changed_pdfs
+            upsert_documents_to_collection(image_collection, image_documents, image_doc_ids, image_metadatas)
+    return duplicates
 
 
 if __name__ == "__main__":
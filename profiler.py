@@ -0,0 +1,235 @@
+import os
+import re
+import sys
+import json
+import time
+import threading
+from collections import Counter, defaultdict
+from contextlib import nullcontext
+
+# 取樣式效能剖析設定，可透過環境變數或 CLI 的 --profile 調整（未啟用時不啟動任何取樣執行緒）
+# 剖析範圍，可用逗號組合：run（整次匯入）、document（單份文件）、query（單次查詢）；空字串為關閉
+PROFILE = os.getenv("PROFILE", "")
+# 只剖析名稱（文件檔名或問題文字）包含此字串的 document / query，空字串表示全部
+PROFILE_TARGET = os.getenv("PROFILE_TARGET", "")
+# 取樣間隔（毫秒）
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+# 每個剖析結果寫入 PROFILE_DIR 下的獨立目錄
+PROFILE_DIR = os.getenv("PROFILE_DIR", "./profiles")
+# 每個階段列出的熱點函式數
+PROFILE_TOP_N = int(os.getenv("PROFILE_TOP_N", "20"))
+
+PROFILE_KINDS = ("run", "document", "query")
+# 不在任何 stage 區塊內的取樣
+DEFAULT_STAGE = "other"
+
+_kinds = set()
+_target = ""
+# 目前有剖析中的 session 才需要記錄各執行緒所在的階段
+_active_sessions = 0
+_sessions_lock = threading.Lock()
+# thread id -> 目前所在的階段堆疊
+_thread_stages = defaultdict(list)
+# 正在被剖析的 thread id（同一執行緒內的巢狀 session 不重複剖析）
+_profiled_threads = set()
+_NULL = nullcontext()
+
+
+def configure(kinds=PROFILE, target=PROFILE_TARGET):
+    """設定剖析範圍；kinds 可為逗號分隔字串或清單，CLI 的 --profile 也透過這裡設定"""
+    global _kinds, _target
+    if isinstance(kinds, str):
+        kinds = [kind.strip() for kind in kinds.split(",") if kind.strip()]
+    unknown = set(kinds) - set(PROFILE_KINDS)
+    if unknown:
+        raise ValueError(f"不支援的剖析範圍：{', '.join(sorted(unknown))}（可用 {', '.join(PROFILE_KINDS)}）")
+    _kinds = set(kinds)
+    _target = target or ""
+    if _kinds:
+        print(f"[INFO] 已啟用效能剖析：{', '.join(sorted(_kinds))}，取樣間隔 {PROFILE_INTERVAL_MS}ms，輸出至 {PROFILE_DIR}")
+
+
+def add_profile_arguments(parser):
+    parser.add_argument("--profile", default=None, help="啟用效能剖析：run、document、query（可用逗號組合），覆蓋 PROFILE")
+    parser.add_argument("--profile-target", default=None, help="只剖析名稱包含此字串的文件或查詢，覆蓋 PROFILE_TARGET")
+
+
+def configure_from_args(args):
+    if args.profile is not None or args.profile_target is not None:
+        configure(args.profile if args.profile is not None else PROFILE,
+                  args.profile_target if args.profile_target is not None else PROFILE_TARGET)
+
+
+def stage(name):
+    """
+    標記管線階段（例如 chunk、vlm_describe、clip_score、embed_upsert），取樣會依所在階段分組。
+    沒有剖析中的 session 時回傳共用的 nullcontext，不做任何記錄。
+    """
+    if not _active_sessions:
+        return _NULL
+    return _Stage(name)
+
+
+class _Stage:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.stack = _thread_stages[threading.get_ident()]
+        self.stack.append(self.name)
+
+    def __exit__(self, *exc):
+        # session 可能在階段中途結束並清掉堆疊
+        if self.stack:
+            self.stack.pop()
+        return False
+
+
+def profile_session(kind, name="", force=False):
+    """
+    剖析一個範圍（run / document / query）：kind 已啟用且名稱符合 PROFILE_TARGET 時，
+    以背景執行緒定期取樣目前執行緒（以及位於 stage 區塊內的其他執行緒）的呼叫堆疊，結束時寫出結果；force=True 時不看設定（例如單次查詢要求剖析）。
+    同一執行緒已在剖析中時（例如整次匯入內的單份文件）不另外開 session。
+    """
+    if not force and (kind not in _kinds or (kind != "run" and _target and _target not in name)):
+        return _NULL
+    if threading.get_ident() in _profiled_threads:
+        return _NULL
+    return _Session(kind, name)
+
+
+class _Session:
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+        self.stacks = Counter()
+        # samples 為所有執行緒的堆疊取樣總數，ticks 為取樣次數
+        self.samples = 0
+        self.ticks = 0
+        self.threads = set()
+        self._stop = threading.Event()
+
+    def __enter__(self):
+        global _active_sessions
+        self.thread_id = threading.get_ident()
+        with _sessions_lock:
+            _profiled_threads.add(self.thread_id)
+            _active_sessions += 1
+        self.started = time.monotonic()
+        self._sampler = threading.Thread(target=self._sample_loop, daemon=True)
+        self._sampler.start()
+        return self
+
+    def __exit__(self, *exc):
+        global _active_sessions
+        self._stop.set()
+        self._sampler.join()
+        self.seconds = time.monotonic() - self.started
+        with _sessions_lock:
+            _profiled_threads.discard(self.thread_id)
+            _thread_stages.pop(self.thread_id, None)
+            _active_sessions -= 1
+        try:
+            self.write()
+        except Exception as e:
+            print(f"[WARN] 寫出效能剖析結果失敗：{e}")
+        return False
+
+    def _sample_loop(self):
+        """
+        每次取樣開啟 session 的執行緒，以及其他正在 stage 區塊內的執行緒（例如匯入用的執行緒池）；
+        其他 session 自己的執行緒不計入。未標記 stage 的背景執行緒不會被取樣。
+        """
+        interval = PROFILE_INTERVAL_MS / 1000
+        while not self._stop.wait(interval):
+            frames_by_thread = sys._current_frames()
+            thread_names = None
+            self.ticks += 1
+            for thread_id, stages in _thread_stages.copy().items():
+                # 堆疊可能同時被該執行緒修改，先取快照
+                stages = tuple(stages)
+                if thread_id == self.thread_id or not stages or thread_id in _profiled_threads:
+                    continue
+                if thread_names is None:
+                    thread_names = {t.ident: t.name for t in threading.enumerate()}
+                self._record(frames_by_thread.get(thread_id), stages, f"thread:{thread_names.get(thread_id, thread_id)}")
+            self._record(frames_by_thread.get(self.thread_id), tuple(_thread_stages.get(self.thread_id, ())))
+
+    def _record(self, frame, stages, thread_label=None):
+        if frame is None:
+            return
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            frames.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        current = stages[-1] if stages else DEFAULT_STAGE
+        # 以階段當作最外層 frame，flamegraph 會先依階段分開；其他執行緒的堆疊再多一層執行緒名稱
+        prefix = (current,) if thread_label is None else (current, thread_label)
+        self.stacks[prefix + tuple(reversed(frames))] += 1
+        self.samples += 1
+        if thread_label is not None:
+            self.threads.add(thread_label)
+
+    def stage_tables(self):
+        """每個階段的取樣數，以及各函式的 self（堆疊最內層）與 inclusive（出現在堆疊中）取樣數"""
+        tables = defaultdict(lambda: {"samples": 0, "self": Counter(), "inclusive": Counter()})
+        for stack, count in self.stacks.items():
+            table = tables[stack[0]]
+            table["samples"] += count
+            table["self"][stack[-1]] += count
+            for function in set(f for f in stack[1:] if not f.startswith("thread:")):
+                table["inclusive"][function] += count
+        return tables
+
+    def write(self):
+        slug = re.sub(r"[^\w.-]+", "_", self.name)[:60].strip("_")
+        run_dir = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}_{self.kind}" + (f"_{slug}" if slug else ""))
+        suffix = 1
+        while os.path.exists(run_dir + (f"_{suffix}" if suffix > 1 else "")):
+            suffix += 1
+        run_dir += f"_{suffix}" if suffix > 1 else ""
+        os.makedirs(run_dir)
+
+        # flamegraph.pl / speedscope 可直接讀取的 collapsed stack 格式
+        with open(os.path.join(run_dir, "stacks.collapsed"), "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{';'.join(stack)} {count}\n")
+
+        tables = self.stage_tables()
+        ordered = sorted(tables.items(), key=lambda item: -item[1]["samples"])
+        interval_ms = PROFILE_INTERVAL_MS
+        lines = [
+            f"範圍：{self.kind} {self.name}".rstrip(),
+            f"耗時 {self.seconds:.2f}s，取樣 {self.ticks} 次（間隔 {interval_ms}ms），堆疊 {self.samples} 筆",
+            f"取樣範圍：開啟 session 的執行緒，以及位於 stage 區塊內的其他執行緒 {len(self.threads)} 個"
+            "（秒數為各執行緒合計；未標記 stage 的背景執行緒不在結果中，同時進行的 session 會重複計入這些執行緒）",
+            "",
+        ]
+        for stage_name, table in ordered:
+            share = table["samples"] / self.samples * 100 if self.samples else 0.0
+            lines.append(f"== {stage_name}：{table['samples']} 次（{share:.1f}%，約 {table['samples'] * interval_ms / 1000:.2f}s）")
+            lines.append(f"{'self':>8}{'inclusive':>11}  函式")
+            for function, count in table["self"].most_common(PROFILE_TOP_N):
+                lines.append(f"{count:>8}{table['inclusive'][function]:>11}  {function}")
+            lines.append("")
+        with open(os.path.join(run_dir, "top_functions.txt"), "w", encoding="utf-8") as f:
+            f.write("\n".join(lines))
+
+        with open(os.path.join(run_dir, "summary.json"), "w", encoding="utf-8") as f:
+            json.dump({
+                "kind": self.kind,
+                "name": self.name,
+                "seconds": self.seconds,
+                "samples": self.samples,
+                "ticks": self.ticks,
+                "threads": sorted(self.threads),
+                "interval_ms": interval_ms,
+                "stages": {stage_name: table["samples"] for stage_name, table in ordered},
+            }, f, ensure_ascii=False, indent=2)
+
+        breakdown = "、".join(f"{name} {table['samples'] / self.samples * 100:.0f}%" for name, table in ordered[:5]) if self.samples else "無取樣"
+        print(f"[INFO] 效能剖析（{self.kind} {self.name}）：{self.seconds:.1f}s，{breakdown}；結果寫入 {run_dir}")
+
+
+configure()
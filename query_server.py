@@ -0,0 +1,375 @@
+import os
+import time
+import asyncio
+import threading
+import concurrent.futures
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Optional, Union, List
+
+import uvicorn
+import numpy as np
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse, JSONResponse
+from pydantic import BaseModel
+from starlette.background import BackgroundTask
+
+from vector_db import init_chroma_client, init_collections, get_query_batcher
+from collection_alias import aliases_mtime, current_generation
+from rag_pipeline import rag_query_pipeline, prepare_rag_prompt
+from azure_tool import stream_with_openai
+from answer_cache import answer_cache, make_scope, ANSWER_CACHE_ENABLED
+from retrieval_cache import retrieval_cache
+from context_budget import context_stats
+from scoped_retrieval import document_filter, document_indexes
+from hierarchical_index import RETRIEVAL_MODE
+from profiler import profile_session
+
+# 查詢服務設定，可透過環境變數調整
+# 同時執行的查詢數（也是查詢執行緒池大小）
+QUERY_MAX_CONCURRENCY = int(os.getenv("QUERY_MAX_CONCURRENCY", "4"))
+# 等待中的查詢上限，超過時直接回 503（admission control）
+QUERY_MAX_QUEUE = int(os.getenv("QUERY_MAX_QUEUE", "32"))
+# 每個查詢的逾時秒數（包含排隊時間）
+QUERY_TIMEOUT_SECONDS = float(os.getenv("QUERY_TIMEOUT_SECONDS", "60"))
+QUERY_SERVER_HOST = os.getenv("QUERY_SERVER_HOST", "0.0.0.0")
+QUERY_SERVER_PORT = int(os.getenv("QUERY_SERVER_PORT", "8000"))
+# 是否在服務內同時監控 RAG_RAW_FILE_PATH 並自動匯入
+QUERY_SERVER_WATCH = os.getenv("QUERY_SERVER_WATCH", "false").lower() == "true"
+# 監控觸發的匯入是否略過圖片處理（等同 ingest_watcher.py --ignore-image-processing）
+QUERY_SERVER_WATCH_IGNORE_IMAGES = os.getenv("QUERY_SERVER_WATCH_IGNORE_IMAGES", "false").lower() == "true"
+
+
+class ServerState:
+    """服務啟動後共用的狀態：向量集合、執行緒池、排隊計數與指標"""
+
+    def __init__(self):
+        self.client = None
+        self.alias_mtime = None
+        self.generation = None
+        self.text_collection = None
+        self.image_collection = None
+        self.query_executor = None
+        self.ingest_executor = None
+        self.semaphore = None
+        self.loop = None
+        self.waiting = 0
+        self.in_flight = 0
+        self.requests_total = 0
+        self.rejected_total = 0
+        self.timeouts_total = 0
+        self.errors_total = 0
+        self.latencies = deque(maxlen=2000)
+        self.ingest_lock = threading.Lock()
+        self.ingest_status = {"running": False, "last_started": None, "last_finished": None, "last_error": None}
+        self.started_at = time.time()
+
+    def release_slot(self):
+        """查詢真正結束（含逾時後仍在執行的執行緒）才釋放名額，避免執行緒池被超額佔用"""
+        self.in_flight -= 1
+        self.semaphore.release()
+
+    def refresh_collections(self, force=False):
+        """別名檔（rebuild_index.py 切換 / 回滾）有變動時改用新世代的集合；已在執行中的查詢沿用原本的集合物件"""
+        mtime = aliases_mtime()
+        if not force and mtime == self.alias_mtime:
+            return
+        generation = current_generation()
+        self.text_collection, self.image_collection = init_collections(self.client, generation)
+        self.alias_mtime = mtime
+        if self.generation is not None and generation != self.generation:
+            # 舊世代的答案不一定適用於新集合
+            answer_cache.clear()
+            print(f"[INFO] 集合世代切換：{self.generation or '(legacy)'} → {generation or '(legacy)'}")
+        self.generation = generation
+
+
+state = ServerState()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # 只在啟動時初始化一次 ChromaDB、Embedding 與模型（CLIP 於 import rag_pipeline 時已載入）
+    state.client = init_chroma_client()
+    state.refresh_collections(force=True)
+    state.query_executor = concurrent.futures.ThreadPoolExecutor(max_workers=QUERY_MAX_CONCURRENCY, thread_name_prefix="query")
+    state.ingest_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="ingest")
+    state.semaphore = asyncio.Semaphore(QUERY_MAX_CONCURRENCY)
+    state.loop = asyncio.get_running_loop()
+    watcher = None
+    if QUERY_SERVER_WATCH:
+        # 延遲 import：只有啟用監控時才需要 watchfiles
+        from ingest_watcher import IngestWatcher
+        watcher = IngestWatcher(_watch_ingestion)
+        # 啟動時先做一次完整掃描，補上停機期間的變更
+        watcher.request_full_scan()
+        watcher.start()
+    print(f"[INFO] 查詢服務啟動完成，併發上限 {QUERY_MAX_CONCURRENCY}，排隊上限 {QUERY_MAX_QUEUE}")
+    yield
+    if watcher:
+        watcher.stop()
+    state.query_executor.shutdown(wait=False, cancel_futures=True)
+    state.ingest_executor.shutdown(wait=False, cancel_futures=True)
+
+
+app = FastAPI(title="Multimodal-RAG Query Service", lifespan=lifespan)
+
+
+class QueryRequest(BaseModel):
+    question: str
+    dataset_type: Optional[str] = None
+    ignore_image_processing: bool = False
+    timeout: Optional[float] = None
+    # 限定只在指定文件中檢索（單一檔名或檔名清單）
+    file_name: Optional[Union[str, List[str]]] = None
+    file_type: Optional[Union[str, List[str]]] = None
+    # 文字檢索模式：flat 或 hierarchical，未指定時使用 RETRIEVAL_MODE
+    retrieval_mode: Optional[str] = None
+    # 剖析這次查詢，結果寫入 PROFILE_DIR（不需重啟服務或設定 PROFILE=query）
+    profile: bool = False
+
+
+class IngestRequest(BaseModel):
+    ignore_image_processing: bool = False
+
+
+async def acquire_slot(deadline):
+    """排隊取得執行名額；佇列已滿回 503，排隊超過期限回 504"""
+    if state.waiting >= QUERY_MAX_QUEUE:
+        state.rejected_total += 1
+        raise HTTPException(status_code=503, detail="查詢佇列已滿，請稍後再試", headers={"Retry-After": "1"})
+    state.waiting += 1
+    try:
+        await asyncio.wait_for(state.semaphore.acquire(), timeout=max(0.0, deadline - time.monotonic()))
+    except asyncio.TimeoutError:
+        state.timeouts_total += 1
+        raise HTTPException(status_code=504, detail="排隊等待逾時")
+    finally:
+        state.waiting -= 1
+    state.in_flight += 1
+
+
+def submit_query(fn, *args, **kwargs):
+    """送到查詢執行緒池，完成時（無論是否已逾時）才釋放名額"""
+    future = state.query_executor.submit(fn, *args, **kwargs)
+    future.add_done_callback(lambda _: state.loop.call_soon_threadsafe(state.release_slot))
+    return future
+
+
+def record_latency(start_time):
+    state.latencies.append(time.monotonic() - start_time)
+
+
+@app.post("/query")
+async def query(req: QueryRequest):
+    state.requests_total += 1
+    start_time = time.monotonic()
+    deadline = start_time + (req.timeout or QUERY_TIMEOUT_SECONDS)
+    await acquire_slot(deadline)
+    state.refresh_collections()
+
+    future = submit_query(
+        rag_query_pipeline,
+        req.question,
+        state.text_collection,
+        state.image_collection,
+        dataset_type=req.dataset_type,
+        ignore_image_processing=req.ignore_image_processing,
+        file_name=req.file_name,
+        file_type=req.file_type,
+        retrieval_mode=req.retrieval_mode or RETRIEVAL_MODE,
+        profile=req.profile,
+    )
+    try:
+        answer = await asyncio.wait_for(asyncio.wrap_future(future), timeout=max(0.0, deadline - time.monotonic()))
+    except asyncio.TimeoutError:
+        state.timeouts_total += 1
+        raise HTTPException(status_code=504, detail="查詢逾時")
+    except Exception as e:
+        state.errors_total += 1
+        print(f"[ERROR] 查詢失敗：{e}")
+        raise HTTPException(status_code=500, detail="查詢失敗")
+
+    record_latency(start_time)
+    return {"answer": answer, "latency": time.monotonic() - start_time}
+
+
+@app.post("/query/stream")
+async def query_stream(req: QueryRequest):
+    """先完成檢索與提示詞組合，再以串流方式逐段回傳生成的答案"""
+    state.requests_total += 1
+    start_time = time.monotonic()
+    deadline = start_time + (req.timeout or QUERY_TIMEOUT_SECONDS)
+    await acquire_slot(deadline)
+    state.refresh_collections()
+
+    where = document_filter(req.file_name, req.file_type)
+    retrieval_mode = req.retrieval_mode or RETRIEVAL_MODE
+    scope = make_scope(req.dataset_type, req.ignore_image_processing, document_scope=where, retrieval_mode=retrieval_mode)
+    # 串流期間同樣佔用名額，直到產生器結束才釋放
+    future = state.query_executor.submit(
+        _prepare_or_cached, req.question, scope, req.dataset_type, req.ignore_image_processing, where, retrieval_mode, req.profile
+    )
+    try:
+        cached_answer, prepared = await asyncio.wait_for(
+            asyncio.wrap_future(future), timeout=max(0.0, deadline - time.monotonic())
+        )
+    except asyncio.TimeoutError:
+        state.timeouts_total += 1
+        future.add_done_callback(lambda _: state.loop.call_soon_threadsafe(state.release_slot))
+        raise HTTPException(status_code=504, detail="查詢逾時")
+    except Exception as e:
+        state.errors_total += 1
+        state.release_slot()
+        print(f"[ERROR] 查詢失敗：{e}")
+        raise HTTPException(status_code=500, detail="查詢失敗")
+
+    released = []
+
+    def release_once():
+        # 產生器結束與 background task 都會呼叫，只釋放一次（在 event loop 執行緒執行）
+        if not released:
+            released.append(True)
+            state.release_slot()
+
+    async def release_in_background():
+        release_once()
+
+    def generate():
+        try:
+            if cached_answer is not None:
+                yield cached_answer
+                return
+            augmented_prompt, selected_image, source_files = prepared
+            image_kwargs = {}
+            if selected_image:
+                image_bytes, mime_type, detail = selected_image
+                image_kwargs = {"image_bytes": image_bytes, "mime_type": mime_type, "detail": detail}
+            parts = []
+            for piece in stream_with_openai(augmented_prompt, **image_kwargs):
+                if time.monotonic() > deadline:
+                    state.timeouts_total += 1
+                    print("[WARN] 串流回答超過逾時，提前結束")
+                    return
+                parts.append(piece)
+                yield piece
+            if ANSWER_CACHE_ENABLED:
+                answer_cache.store(req.question, scope, "".join(parts), source_files)
+        finally:
+            record_latency(start_time)
+            state.loop.call_soon_threadsafe(release_once)
+
+    # 用戶端在串流開始前斷線時產生器不會執行 finally，由 background task 兜底釋放名額
+    return StreamingResponse(generate(), media_type="text/plain; charset=utf-8", background=BackgroundTask(release_in_background))
+
+
+def _prepare_or_cached(question, scope, dataset_type, ignore_image_processing, where=None, retrieval_mode=RETRIEVAL_MODE, profile=False):
+    """在查詢執行緒中先查答案快取，未命中才進行檢索與提示詞組合；剖析範圍不含之後的串流生成"""
+    with profile_session("query", question, force=profile):
+        if ANSWER_CACHE_ENABLED:
+            cached_answer = answer_cache.lookup(question, scope)
+            if cached_answer is not None:
+                return cached_answer, None
+        prepared = prepare_rag_prompt(
+            question,
+            state.text_collection,
+            state.image_collection,
+            dataset_type,
+            ignore_image_processing=ignore_image_processing,
+            where=where,
+            retrieval_mode=retrieval_mode,
+        )
+        return None, prepared
+
+
+def _run_ingestion(ignore_image_processing, raw_paths=None):
+    # 延遲 import：process_files 會載入 Office 轉檔相關套件，只有真正匯入時才需要
+    from process_files import process_pdf_changes
+
+    state.ingest_status.update({"running": True, "last_started": time.time(), "last_error": None})
+    try:
+        state.refresh_collections()
+        deleted, changed = process_pdf_changes(
+            state.text_collection, state.image_collection,
+            ignore_image_processing=ignore_image_processing, raw_paths=raw_paths
+        )
+        state.ingest_status.update({"changed": len(changed), "deleted": len(deleted)})
+    except Exception as e:
+        state.ingest_status["last_error"] = str(e)
+        print(f"[ERROR] 背景匯入失敗：{e}")
+    finally:
+        state.ingest_status.update({"running": False, "last_finished": time.time()})
+        state.ingest_lock.release()
+
+
+def _watch_ingestion(raw_paths):
+    """檔案監控觸發的匯入，與 /ingest 共用同一把鎖，避免同時寫入向量庫"""
+    state.ingest_lock.acquire()
+    _run_ingestion(QUERY_SERVER_WATCH_IGNORE_IMAGES, raw_paths)
+
+
+@app.post("/ingest", status_code=202)
+async def ingest(req: IngestRequest):
+    """在獨立執行緒背景執行 process_pdf_changes，不佔用查詢名額"""
+    if not state.ingest_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="已有匯入作業執行中")
+    state.ingest_executor.submit(_run_ingestion, req.ignore_image_processing)
+    return {"status": "started"}
+
+
+@app.get("/ingest/status")
+async def ingest_status():
+    return state.ingest_status
+
+
+@app.get("/health")
+async def health():
+    try:
+        state.refresh_collections()
+        text_count = state.text_collection.count()
+        image_count = state.image_collection.count()
+    except Exception as e:
+        return JSONResponse(status_code=503, content={"status": "error", "detail": str(e)})
+    return {
+        "status": "ok",
+        "generation": state.generation,
+        "text_count": text_count,
+        "image_count": image_count,
+        "ingesting": state.ingest_status["running"],
+    }
+
+
+@app.get("/metrics")
+async def metrics():
+    latencies = np.asarray(state.latencies) if state.latencies else np.zeros(1)
+    return {
+        "uptime_seconds": time.time() - state.started_at,
+        "requests_total": state.requests_total,
+        "rejected_total": state.rejected_total,
+        "timeouts_total": state.timeouts_total,
+        "errors_total": state.errors_total,
+        "in_flight": state.in_flight,
+        "queued": state.waiting,
+        "latency_p50": float(np.percentile(latencies, 50)),
+        "latency_p95": float(np.percentile(latencies, 95)),
+        "latency_p99": float(np.percentile(latencies, 99)),
+        "embedding_batches": get_query_batcher().batches,
+        "embedding_texts": get_query_batcher().texts,
+        "answer_cache": {
+            "exact_hits": answer_cache.exact_hits,
+            "semantic_hits": answer_cache.semantic_hits,
+            "misses": answer_cache.misses,
+        },
+        "retrieval_cache": retrieval_cache.stats(),
+        "context_tokens": context_stats.stats(),
+        "scoped_retrieval": document_indexes.stats(),
+        "shards": {
+            collection.name: collection.shard_stats()
+            for collection in (state.text_collection, state.image_collection)
+            if hasattr(collection, "shard_stats")
+        },
+    }
+
+
+if __name__ == "__main__":
+    uvicorn.run(app, host=QUERY_SERVER_HOST, port=QUERY_SERVER_PORT)
@@ -1,29 +1,34 @@
 import os
 import re
 import json
-import uuid
+import time
+import concurrent.futures
 from azure_tool import generate_with_openai
 import pdf_chunker
+from answer_cache import answer_cache, make_scope, ANSWER_CACHE_ENABLED
+import rewrite_cache
+from vector_db import embed_queries, collection_embedding_dim
+from context_budget import assemble_context
+from retrieval_cache import retrieval_cache, make_key as make_retrieval_key, RETRIEVAL_CACHE_ENABLED
+from scoped_retrieval import search_collection, document_filter
+from hierarchical_index import hierarchical_search, summary_collection_name, RETRIEVAL_MODE
+from profiler import profile_session, stage
 
 # 從環境變數取得檔案路徑
 RAG_FILE_PATH = os.getenv('RAG_FILE_PATH')
+# 查詢改寫的延遲預算（秒），未設定時維持同步等待改寫結果
+REWRITE_DEADLINE_SECONDS = float(os.getenv("REWRITE_DEADLINE_SECONDS")) if os.getenv("REWRITE_DEADLINE_SECONDS") else None
+
+# 延遲預算模式下執行查詢改寫的背景執行緒
+_rewrite_executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
 
 
 import json
 import os
 from azure_tool import generate_with_openai
 
-
-def generate_alternatives_and_keywords(query):
-    """
-    使用 Azure OpenAI 同時生成三個檢索查詢變體與三個對應關鍵字
-    回傳格式：
-        queries: ["查詢版本1", "查詢版本2", "查詢版本3"],
-        keywords: ["關鍵字1", "關鍵字2", "關鍵字3"]
-    如果呼叫失敗、被 Content Filter 擋掉或解析 JSON 失敗，則回傳 ([], [])。
-    """
-    # 系統提示：定義 Assistant 行為和固定 JSON 輸出格式
-    system_prompt = """
+# 查詢改寫的系統提示：定義 Assistant 行為和固定 JSON 輸出格式（內容變更時快取版本會自動更新）
+REWRITE_SYSTEM_PROMPT = """
         你是一個 AI 助手，負責根據用戶輸入的問題，同時完成兩件事：
         1. 生成三個不同版本的檢索查詢（alternative queries）
         2. 從原始問題中抽取三個最能代表核心意圖或主題的關鍵字（keywords）
@@ -42,6 +47,23 @@ def generate_alternatives_and_keywords(query):
         ]
         }
     """
+
+
+def generate_alternatives_and_keywords(query):
+    """
+    使用 Azure OpenAI 同時生成三個檢索查詢變體與三個對應關鍵字
+    回傳格式：
+        queries: ["查詢版本1", "查詢版本2", "查詢版本3"],
+        keywords: ["關鍵字1", "關鍵字2", "關鍵字3"]
+    如果呼叫失敗、被 Content Filter 擋掉或解析 JSON 失敗，則回傳 ([], [])。
+    成功的結果會依（問題 hash, 提示詞版本）寫入持久化 LRU 快取，並設有 TTL。
+    """
+    version = rewrite_cache.prompt_version(REWRITE_SYSTEM_PROMPT)
+    cached = rewrite_cache.get_rewrite(query, version)
+    if cached is not None:
+        print("[INFO] 查詢改寫快取命中，略過 LLM 呼叫")
+        return cached
+
     # 使用者提示：僅放原始問題
     user_prompt = f"原始問題: \"{query}\""
 
@@ -49,7 +71,7 @@ def generate_alternatives_and_keywords(query):
         # 呼叫 Azure OpenAI，先傳 system，再傳 user
         result = generate_with_openai(
             text_prompt=user_prompt,
-            system_prompt=system_prompt
+            system_prompt=REWRITE_SYSTEM_PROMPT
         )
     except Exception as e:
         # 連 API 都出錯（網路、Key 或其他），直接回傳空
@@ -78,74 +100,164 @@ def generate_alternatives_and_keywords(query):
         print(f"[WARN] JSON 結構不符預期: {data}")
         return [], []
 
-    # 最後回傳
+    # 寫入快取後回傳
+    rewrite_cache.set_rewrite(query, version, queries, keywords)
     return queries, keywords
 
 
 
-def query_chromadb(collection, query_text, n_results=1):
-    return collection.query(query_texts=[query_text], n_results=n_results)
+def query_chromadb(collection, query_text, n_results=1, where=None):
+    """
+    查詢單一文字；相同 (集合, 文字, n_results, 過濾條件) 在集合內容未變動前直接回傳快取結果，
+    省下 Embedding 與 HNSW 搜尋。where 限定文件範圍時改用文件子索引做精確搜尋。
+    """
+    key = make_retrieval_key(collection.name, query_text, n_results, where)
+    if RETRIEVAL_CACHE_ENABLED:
+        cached = retrieval_cache.get(key)
+        if cached is not None:
+            return cached
+    generation = retrieval_cache.key_generation(key)
+    # 先透過微批次取得查詢向量，再以 query_embeddings 查詢 ChromaDB
+    with stage("embed_query"):
+        query_embeddings = embed_queries([query_text], dim=collection_embedding_dim(collection))
+    with stage("vector_search"):
+        result = search_collection(collection, query_embeddings, n_results, where)
+    if RETRIEVAL_CACHE_ENABLED:
+        retrieval_cache.put(key, result, generation)
+    return result
 
 
-def rag_query_pipeline(query_text, text_collection, image_collection, dataset_type, ignore_image_processing=False):
+def query_chromadb_many(collection, query_texts, n_results=1, where=None, mode="flat"):
     """
-    RAG 查詢流程：
+    多個查詢文字：快取命中的直接取用，其餘合併成一次多查詢送出，
+    回傳與 query_texts 對應的單一查詢結果清單（格式同 query_chromadb）。
+    mode="hierarchical" 且未限定文件範圍時，先以文件 / 頁面摘要向量選出候選頁面，再只搜尋其中的 chunk。
+    """
+    results = [None] * len(query_texts)
+    hierarchical = mode == "hierarchical" and not where
+    # 階層式檢索的結果也取決於摘要集合，摘要更新後同樣要失效
+    depends_on = (summary_collection_name(collection),) if hierarchical else ()
+    keys = [make_retrieval_key(collection.name, text, n_results, where, mode=mode, depends_on=depends_on) for text in query_texts]
+    if RETRIEVAL_CACHE_ENABLED:
+        results = [retrieval_cache.get(key) for key in keys]
+    pending = [i for i, result in enumerate(results) if result is None]
+    if not pending:
+        return results
+
+    generation = retrieval_cache.key_generation(keys[pending[0]])
+    with stage("embed_query"):
+        query_embeddings = embed_queries([query_texts[i] for i in pending], dim=collection_embedding_dim(collection))
+    with stage("vector_search"):
+        if hierarchical:
+            batch_result = hierarchical_search(collection, query_embeddings, n_results)
+        else:
+            batch_result = search_collection(collection, query_embeddings, n_results, where)
+    for row, i in enumerate(pending):
+        results[i] = {
+            key: [batch_result[key][row]] if batch_result.get(key) else []
+            for key in ("ids", "documents", "metadatas", "distances")
+        }
+        if RETRIEVAL_CACHE_ENABLED:
+            retrieval_cache.put(keys[i], results[i], generation)
+    return results
+
+
+def collect_text_contexts(text_collection, queries, candidates, where=None, mode="flat"):
+    """
+    對每個查詢取 top-1 文字區塊，依 id 合併到 candidates（id -> 候選 chunk）：
+    重複命中的 chunk 累計 hits 並保留最近的距離，供 assemble_context 排序。
+    where 可限定只在特定文件中檢索；mode 為 flat 或 hierarchical（見 hierarchical_index.py）。
+    """
+    if not queries:
+        return
+    # 快取未命中的查詢向量一次送出計算，再以單次多查詢向 ChromaDB 取回各自的 top-1
+    for text_result in query_chromadb_many(text_collection, queries, n_results=1, where=where, mode=mode):
+        text_ids = text_result.get("ids") or [[]]
+        if not text_ids[0]:
+            continue
+        current_id = text_ids[0][0]
+        distance = (text_result.get("distances") or [[None]])[0][0]
+        if current_id in candidates:
+            candidate = candidates[current_id]
+            candidate["hits"] += 1
+            if distance is not None and (candidate["distance"] is None or distance < candidate["distance"]):
+                candidate["distance"] = distance
+            print(f"[DEBUG] 文件 id {current_id} 已存在，跳過重複內容")
+            continue
+        metadata = ((text_result.get("metadatas") or [[None]])[0] or [None])[0] or {}
+        candidates[current_id] = {
+            "id": current_id,
+            "text": str(text_result["documents"][0][0]),
+            "distance": distance,
+            "hits": 1,
+            "metadata": metadata,
+        }
+
+
+def prepare_rag_prompt(query_text, text_collection, image_collection, dataset_type, ignore_image_processing=False, rewrite_deadline=REWRITE_DEADLINE_SECONDS, contexts_out=None, where=None, retrieval_mode=RETRIEVAL_MODE):
+    """
+    RAG 查詢的檢索階段（不呼叫最終生成）：
     1. 使用 generate_alternatives_and_keywords 取得三個查詢變體與三個關鍵字；
+       若設定 rewrite_deadline（秒），改寫在背景執行並先檢索原始問題，逾時則不等待改寫結果；
     2. 對文字集合（text_collection）分別使用三個查詢變體與三個關鍵字進行檢索；
     3. 若未忽略圖片，僅對原始 query_text 執行圖片檢索；
-    4. 合併文字上下文，（若有）並將圖片路徑傳入 OpenAI 生成最終答案。
+    4. 以 assemble_context 依分數、去重與 token 預算挑選文字上下文，組成提示詞。
+    回傳 (augmented_prompt, selected_image, source_files)，selected_image 為 (bytes, mime_type, detail) 或 None；
+    若傳入 contexts_out（list），會附加實際放入提示詞的文字區塊，供評測使用；
+    where（見 scoped_retrieval.document_filter）會套用到文字與圖片檢索，只在指定文件中搜尋；
+    retrieval_mode 決定文字檢索為 flat 或 hierarchical（粗到細）。
     """
-    # 生成查詢變體與關鍵字
-    alternative_queries, keywords = generate_alternatives_and_keywords(query_text)
-    if len(alternative_queries) != 3:
-        print("[INFO] 生成的查詢變體不足 3 個，僅使用原始查詢進行檢索。")
-        alternative_queries = [query_text]
-
-    print(f"[INFO] 抽取到的關鍵字列表: {keywords}")
-
-    # 聚合文字上下文
-    aggregated_texts = []
-    seen_text_ids = set()
-    all_queries = alternative_queries + keywords
-    for q in all_queries:
-        text_result = query_chromadb(text_collection, q)
-        text_docs = text_result.get("documents", [])
-        text_ids = text_result.get("ids", [])
-        if text_docs and text_ids:
-            current_id = text_ids[0]
-            if isinstance(current_id, list):
-                current_id = tuple(current_id)
-            if current_id not in seen_text_ids:
-                context = (
-                    " ".join(text_docs[0])
-                    if isinstance(text_docs[0], list)
-                    else str(text_docs[0])
-                )
-                aggregated_texts.append(context)
-                seen_text_ids.add(current_id)
-            else:
-                print(f"[DEBUG] 文件 id {current_id} 已存在，跳過重複內容")
+    # 聚合文字上下文候選
+    candidates = {}
+    source_files = set()
+
+    if rewrite_deadline is None:
+        # 生成查詢變體與關鍵字
+        with stage("rewrite"):
+            alternative_queries, keywords = generate_alternatives_and_keywords(query_text)
+        if len(alternative_queries) != 3:
+            print("[INFO] 生成的查詢變體不足 3 個，僅使用原始查詢進行檢索。")
+            alternative_queries = [query_text]
+        print(f"[INFO] 抽取到的關鍵字列表: {keywords}")
+        collect_text_contexts(text_collection, alternative_queries + keywords, candidates, where, retrieval_mode)
+    else:
+        # 延遲預算模式：查詢改寫在背景執行，原始問題先行檢索
+        start_time = time.monotonic()
+        rewrite_future = _rewrite_executor.submit(generate_alternatives_and_keywords, query_text)
+        collect_text_contexts(text_collection, [query_text], candidates, where, retrieval_mode)
+        remaining = max(0.0, rewrite_deadline - (time.monotonic() - start_time))
+        try:
+            with stage("rewrite_wait"):
+                alternative_queries, keywords = rewrite_future.result(timeout=remaining)
+        except concurrent.futures.TimeoutError:
+            # 背景呼叫仍會完成並寫入改寫快取，下次同樣問題即可直接使用
+            print(f"[INFO] 查詢改寫超過 {rewrite_deadline} 秒預算，僅使用原始查詢的檢索結果。")
+            alternative_queries, keywords = [], []
+        print(f"[INFO] 抽取到的關鍵字列表: {keywords}")
+        collect_text_contexts(text_collection, list(alternative_queries) + list(keywords), candidates, where, retrieval_mode)
 
     # 僅對原始查詢執行圖片檢索
-    selected_image_path = None
+    selected_image = None
     if not ignore_image_processing:
-        image_result = query_chromadb(image_collection, query_text)
+        image_result = query_chromadb(image_collection, query_text, where=where)
         image_metadata = image_result.get("metadatas", [])
         if image_metadata and image_metadata[0]:
             image_meta = image_metadata[0][0]
             file_name = image_meta.get("file_name")
             page_num = image_meta.get("page")
             print(f"[INFO] 找到圖片資訊: {file_name} - 第 {page_num} 頁 (原始查詢)")
+            source_files.add(file_name)
             full_pdf_path = os.path.join(RAG_FILE_PATH, file_name)
-            image = pdf_chunker.pdf_page_to_image(full_pdf_path, page_num)
-            hash_name = str(uuid.uuid4())
-            image_path = f"./pdf_page_images/output_page_{hash_name}.png"
-            os.makedirs(os.path.dirname(image_path), exist_ok=True)
-            image.save(image_path)
-            selected_image_path = image_path
-
-    # 組合文字上下文與問題
-    merged_text_context = "\n".join(aggregated_texts)
+            # 依 payload 策略直接編碼頁面，不再寫出 PNG 暫存檔
+            with stage("render_payload"):
+                selected_image = pdf_chunker.pdf_page_to_payload(full_pdf_path, page_num)
+
+    # 依 token 預算挑選文字上下文，只有放入提示詞的 chunk 才算作答案來源
+    with stage("assemble_context"):
+        selected, merged_text_context = assemble_context(list(candidates.values()), [query_text] + list(keywords))
+    source_files.update(c["metadata"].get("file_name") for c in selected if c["metadata"].get("file_name"))
+    if contexts_out is not None:
+        contexts_out.extend(c["text"] for c in selected)
     if dataset_type == "yes_no":
         # 若為 yes/no 類型，提示詞需限制答案格式，避免模型回傳其他內容
         augmented_prompt = (
@@ -164,9 +276,55 @@ def rag_query_pipeline(query_text, text_collection, image_collection, dataset_ty
     print("######## 增強後的提示詞 ########")
     print(augmented_prompt)
 
-    # 呼叫 OpenAI 生成最終回答，若有圖片則傳入路徑
-    response = generate_with_openai(
-        text_prompt=augmented_prompt,
-        image_path=selected_image_path
-    )
-    return response
+    return augmented_prompt, selected_image, source_files
+
+
+def rag_query_pipeline(query_text, text_collection, image_collection, dataset_type, ignore_image_processing=False, use_cache=ANSWER_CACHE_ENABLED, rewrite_deadline=REWRITE_DEADLINE_SECONDS, return_contexts=False, file_name=None, file_type=None, retrieval_mode=RETRIEVAL_MODE, profile=False):
+    """
+    RAG 查詢流程：
+    0. 若啟用答案快取，先以正規化問題與語意相似度查詢快取，命中則直接回傳；
+    1. 透過 prepare_rag_prompt 進行查詢改寫、文字與圖片檢索並組成提示詞；
+    2. 呼叫 OpenAI 生成最終答案（若有圖片一併傳入），並寫回快取。
+    return_contexts=True 時回傳 (answer, contexts)，contexts 為實際放入提示詞的文字區塊；
+    答案來自快取時沒有檢索，contexts 為 None。
+    file_name / file_type（單一值或清單）可限定只在指定文件中檢索；retrieval_mode 為 flat 或 hierarchical。
+    profile=True 時剖析這次查詢（不需設定 PROFILE=query，見 profiler.py）。
+    """
+    with profile_session("query", query_text, force=profile):
+        where = document_filter(file_name, file_type)
+        cache_scope = make_scope(dataset_type, ignore_image_processing, document_scope=where, retrieval_mode=retrieval_mode)
+        if use_cache:
+            with stage("answer_cache"):
+                cached_answer = answer_cache.lookup(query_text, cache_scope)
+            if cached_answer is not None:
+                return (cached_answer, None) if return_contexts else cached_answer
+
+        contexts = []
+        augmented_prompt, selected_image, source_files = prepare_rag_prompt(
+            query_text,
+            text_collection,
+            image_collection,
+            dataset_type,
+            ignore_image_processing=ignore_image_processing,
+            rewrite_deadline=rewrite_deadline,
+            contexts_out=contexts,
+            where=where,
+            retrieval_mode=retrieval_mode,
+        )
+
+        # 呼叫 OpenAI 生成最終回答，若有圖片則直接傳入編碼後的 bytes
+        with stage("generate"):
+            if selected_image:
+                image_bytes, mime_type, detail = selected_image
+                response = generate_with_openai(
+                    text_prompt=augmented_prompt,
+                    image_bytes=image_bytes,
+                    mime_type=mime_type,
+                    detail=detail
+                )
+            else:
+                response = generate_with_openai(text_prompt=augmented_prompt)
+
+        if use_cache:
+            answer_cache.store(query_text, cache_scope, response, source_files)
+        return (response, contexts) if return_contexts else response
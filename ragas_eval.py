@@ -0,0 +1,129 @@
+import os
+import json
+import math
+import hashlib
+import pandas as pd
+import ragas
+from diskcache import Cache
+
+from azure_tool import evaluating_RAG_with_ragas, RAGAS_METRICS, RAGAS_JUDGE_MODEL, RAGAS_EMBEDDING_MODEL
+
+# RAGAS 評分快取設定，可透過環境變數調整
+RAGAS_CACHE_ENABLED = os.getenv("RAGAS_CACHE_ENABLED", "true").lower() == "true"
+RAGAS_CACHE_DIR = os.getenv("RAGAS_CACHE_DIR", "./cache/ragas")
+# 磁碟容量上限（bytes），超過時以 LRU 淘汰
+RAGAS_CACHE_SIZE_LIMIT = int(os.getenv("RAGAS_CACHE_SIZE_LIMIT", str(256 * 1024 * 1024)))
+# 同時送往評審模型的請求數上限
+RAGAS_MAX_WORKERS = int(os.getenv("RAGAS_MAX_WORKERS", "8"))
+# 每批評測的題數；每批完成就寫入快取與 CSV，中斷後重跑只會補評尚未完成的批次
+RAGAS_EVAL_BATCH_SIZE = int(os.getenv("RAGAS_EVAL_BATCH_SIZE", "20"))
+
+# 與先前 result.to_pandas() 輸出的 CSV 欄位一致
+SAMPLE_COLUMNS = ["user_input", "retrieved_contexts", "response", "reference"]
+
+_cache = None
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        os.makedirs(RAGAS_CACHE_DIR, exist_ok=True)
+        _cache = Cache(RAGAS_CACHE_DIR, eviction_policy="least-recently-used", size_limit=RAGAS_CACHE_SIZE_LIMIT)
+    return _cache
+
+
+def score_key(question, answer, contexts, ground_truth, metric_name):
+    """
+    以 (問題, 答案, 上下文, 標準答案, 指標, 評審模型) 的 hash 當作 key；
+    Embedding 模型與 ragas 版本也會影響分數，一併納入。
+    """
+    payload = json.dumps(
+        [question, answer, list(contexts), ground_truth, metric_name,
+         RAGAS_JUDGE_MODEL, RAGAS_EMBEDDING_MODEL, ragas.__version__],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def is_valid_score(value):
+    return isinstance(value, (int, float)) and not math.isnan(value)
+
+
+def build_frame(questions, answers, contexts, ground_truths, scores, metric_names):
+    frame = pd.DataFrame({
+        "user_input": questions,
+        "retrieved_contexts": contexts,
+        "response": answers,
+        "reference": ground_truths,
+    })
+    for name in metric_names:
+        frame[name] = [row.get(name, float("nan")) for row in scores]
+    return frame[SAMPLE_COLUMNS + metric_names]
+
+
+def evaluate_incremental(questions, answers, contexts, ground_truths, output_file=None, metrics=None):
+    """
+    增量式 RAGAS 評測：
+      - 每題每個指標的分數依內容 hash 快取，內容完全相同的題目（例如只切換圖片演算法）不再呼叫評審模型
+      - 只把缺少分數的題目依「缺哪些指標」分組，分批送入 ragas.evaluate，並以 RAGAS_MAX_WORKERS 限制併發
+      - 每批完成就更新 output_file，中斷後重跑會從快取接續
+    回傳與先前 result.to_pandas() 欄位相同的 DataFrame；評分失敗（NaN）的項目不快取，下次會重試。
+    """
+    metrics = metrics or RAGAS_METRICS
+    metric_names = [metric.name for metric in metrics]
+    cache = get_cache() if RAGAS_CACHE_ENABLED else None
+
+    scores = [{} for _ in questions]
+    keys = []
+    pending = {}
+    for index, sample in enumerate(zip(questions, answers, contexts, ground_truths)):
+        sample_keys = {name: score_key(*sample, name) for name in metric_names}
+        keys.append(sample_keys)
+        missing = []
+        for name in metric_names:
+            value = cache.get(sample_keys[name]) if cache is not None else None
+            if value is None:
+                missing.append(name)
+            else:
+                scores[index][name] = value
+        if missing:
+            pending.setdefault(tuple(missing), []).append(index)
+
+    to_score = sum(len(indexes) for indexes in pending.values())
+    cached_scores = sum(len(row) for row in scores)
+    print(
+        f"[INFO] RAGAS 評測：{len(questions)} 題中 {len(questions) - to_score} 題全部命中快取，"
+        f"需評分 {to_score} 題（快取分數 {cached_scores} / {len(questions) * len(metric_names)}）"
+    )
+
+    def write_progress():
+        frame = build_frame(questions, answers, contexts, ground_truths, scores, metric_names)
+        if output_file:
+            frame.to_csv(output_file, index=False, encoding="utf-8-sig")
+        return frame
+
+    frame = write_progress()
+    judged = 0
+    for missing, indexes in pending.items():
+        missing_metrics = [metric for metric in metrics if metric.name in missing]
+        for start in range(0, len(indexes), RAGAS_EVAL_BATCH_SIZE):
+            batch = indexes[start:start + RAGAS_EVAL_BATCH_SIZE]
+            result = evaluating_RAG_with_ragas(
+                [questions[i] for i in batch],
+                [answers[i] for i in batch],
+                [contexts[i] for i in batch],
+                [ground_truths[i] for i in batch],
+                metrics=missing_metrics,
+                max_workers=RAGAS_MAX_WORKERS,
+            )
+            for index, row in zip(batch, result.scores):
+                for name in missing:
+                    value = row.get(name)
+                    scores[index][name] = value if value is not None else float("nan")
+                    if cache is not None and is_valid_score(value):
+                        cache.set(keys[index][name], float(value))
+            judged += len(batch) * len(missing)
+            frame = write_progress()
+            print(f"[INFO] RAGAS 評測進度：已評分 {judged} 項（{', '.join(missing)}）")
+
+    return frame
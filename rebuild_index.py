@@ -0,0 +1,307 @@
+import os
+import glob
+import time
+import argparse
+import random
+import numpy as np
+
+from vector_db import (
+    init_chroma_client,
+    init_collections,
+    get_file_chunk_ids,
+    truncate_embeddings,
+    collection_embedding_dim,
+    TEXT_COLLECTION_NAME,
+    IMAGE_COLLECTION_NAME,
+    EMBEDDING_DIM,
+)
+from collection_alias import load_aliases, current_generation, new_generation, versioned_name, swap_alias
+from dedup_index import get_dedup_index, dedup_index_path, remove_dedup_index, DEDUP_ENABLED
+from process_files import plan_pdf_chunks, sync_pdfs, RAG_FILE_PATH
+from hierarchical_index import rebuild_all_summaries, forget_summary_collection, SUMMARY_COLLECTION_NAME, HIERARCHICAL_INDEX_ENABLED
+from answer_cache import answer_cache
+import image_payload
+from memory_budget import memory_budget
+from profiler import profile_session, stage, add_profile_arguments, configure_from_args
+
+# 藍綠重建設定，可透過環境變數調整
+# 新世代集合的 hnsw:sync_threshold，0 表示沿用一般集合的設定（預設）。
+# 調大可讓大批寫入少做幾次索引落盤，但 ChromaDB 建立集合後無法再修改，切換後線上世代會一直沿用：
+# 之後的增量匯入要累積更多筆才落盤，程序異常結束後重新載入時需重播的寫入也更多
+REBUILD_SYNC_THRESHOLD = int(os.getenv("REBUILD_SYNC_THRESHOLD", "0"))
+# 每批寫入新集合的筆數（會再受 client.get_max_batch_size() 限制）
+REBUILD_BATCH_SIZE = int(os.getenv("REBUILD_BATCH_SIZE", "5000"))
+# 驗證：新世代筆數比目前世代少超過此比例就不切換（可用 --force 略過）
+REBUILD_MAX_SHRINK = float(os.getenv("REBUILD_MAX_SHRINK", "0.2"))
+# 驗證：抽樣以向量查回自己的比例下限
+REBUILD_VALIDATE_SAMPLES = int(os.getenv("REBUILD_VALIDATE_SAMPLES", "50"))
+REBUILD_MIN_SELF_RECALL = float(os.getenv("REBUILD_MIN_SELF_RECALL", "0.9"))
+
+
+class BulkWriter:
+    """
+    累積到一大批才寫入集合：已有向量的資料（從目前世代複製）直接帶 embeddings 寫入，
+    其餘交給集合的 embedding function 一次算完整批。
+    """
+
+    def __init__(self, collection, batch_size):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.pending = {True: ([], [], [], []), False: ([], [], [], [])}
+        self.written = 0
+        self.embedded = 0
+
+    def add(self, ids, documents, metadatas, embeddings=None):
+        has_embeddings = embeddings is not None
+        buffer = self.pending[has_embeddings]
+        buffer[0].extend(ids)
+        buffer[1].extend(documents)
+        buffer[2].extend(metadatas)
+        if has_embeddings:
+            buffer[3].extend(embeddings)
+        if len(buffer[0]) >= self.batch_size:
+            self._flush(has_embeddings)
+
+    def _flush(self, has_embeddings):
+        ids, documents, metadatas, embeddings = self.pending[has_embeddings]
+        for start in range(0, len(ids), self.batch_size):
+            end = start + self.batch_size
+            # 沒有沿用向量的批次會在 add 內計算 Embedding
+            with stage("bulk_write" if has_embeddings else "embed_write"):
+                self.collection.add(
+                    ids=ids[start:end],
+                    documents=documents[start:end],
+                    metadatas=metadatas[start:end],
+                    embeddings=embeddings[start:end] if has_embeddings else None,
+                )
+        self.written += len(ids)
+        if not has_embeddings:
+            self.embedded += len(ids)
+        self.pending[has_embeddings] = ([], [], [], [])
+
+    def flush(self):
+        for has_embeddings in (True, False):
+            if self.pending[has_embeddings][0]:
+                self._flush(has_embeddings)
+
+
+def copy_existing(source, ids, include=("embeddings",)):
+    """從目前世代取回已存在的 chunk；回傳 {id: {...}}，內容 hash id 相同代表內容相同，向量可直接沿用"""
+    if not ids:
+        return {}
+    with stage("copy_existing"):
+        stored = source.get(ids=list(ids), include=list(include))
+    # 目前世代的向量維度較大時（例如改用較小的 EMBEDDING_DIM），截斷後即可沿用，不必重新 Embedding
+    if "embeddings" in include:
+        stored["embeddings"] = truncate_embeddings(stored["embeddings"])
+    found = {}
+    for index, chunk_id in enumerate(stored["ids"]):
+        found[chunk_id] = {key: stored[key][index] for key in include}
+    return found
+
+
+def load_pdf(pdf_path, old_text, old_image, text_writer, image_writer, dedup, ignore_image_processing, reembed):
+    pdf_name = os.path.basename(pdf_path)
+    # 圖片描述依頁面內容 hash 沿用目前世代，不再重新呼叫 VLM
+    old_image_ids = get_file_chunk_ids(old_image, pdf_name)
+    with memory_budget.track(pdf_name):
+        memory_budget.wait_for_headroom()
+        plan = plan_pdf_chunks(pdf_path, ignore_image_processing, known_image_ids=old_image_ids)
+
+    text_ids, text_documents, text_metadatas = plan["text"]
+    duplicates = 0
+    if dedup is not None and text_documents:
+        text_ids, text_documents, text_metadatas, duplicates = dedup.filter_new_chunks(
+            text_ids, text_documents, text_metadatas
+        )
+    reused = {} if reembed else copy_existing(old_text, text_ids)
+    fresh = [i for i, chunk_id in enumerate(text_ids) if chunk_id not in reused]
+    copied = [i for i, chunk_id in enumerate(text_ids) if chunk_id in reused]
+    if copied:
+        text_writer.add(
+            [text_ids[i] for i in copied],
+            [text_documents[i] for i in copied],
+            [text_metadatas[i] for i in copied],
+            [reused[text_ids[i]]["embeddings"] for i in copied],
+        )
+    if fresh:
+        text_writer.add([text_ids[i] for i in fresh], [text_documents[i] for i in fresh], [text_metadatas[i] for i in fresh])
+
+    if not ignore_image_processing:
+        image_ids, image_documents, image_metadatas = plan["image"]
+        if image_ids:
+            image_writer.add(image_ids, image_documents, image_metadatas)
+        # 圖片描述一律沿用；reembed 時只重新計算描述的向量
+        include = ("documents", "metadatas") if reembed else ("documents", "metadatas", "embeddings")
+        reused_images = copy_existing(old_image, plan["image_ids"] - set(image_ids), include)
+        if reused_images:
+            image_writer.add(
+                list(reused_images),
+                [item["documents"] for item in reused_images.values()],
+                [item["metadatas"] for item in reused_images.values()],
+                None if reembed else [item["embeddings"] for item in reused_images.values()],
+            )
+
+    print(
+        f"[INFO] {pdf_name}：文字 chunk {len(plan['text_ids'])}（沿用向量 {len(copied)}，重複 {duplicates}），"
+        f"圖片 {len(plan['image_ids'])}"
+    )
+
+
+def validate_generation(text_collection, image_collection, old_text, old_image, force=False):
+    """切換前的檢查：新集合不可為空、筆數沒有異常縮水、抽樣向量能查回自己"""
+    text_count, image_count = text_collection.count(), image_collection.count()
+    old_count = old_text.count() + old_image.count()
+    print(f"[INFO] 新世代：文字 {text_count} 筆、圖片 {image_count} 筆（目前世代共 {old_count} 筆）")
+    if text_count == 0:
+        return False, "新世代的文字集合為空"
+    shrink = 1 - (text_count + image_count) / old_count if old_count else 0.0
+    if shrink > REBUILD_MAX_SHRINK and not force:
+        return False, f"筆數比目前世代少 {shrink:.1%}（上限 {REBUILD_MAX_SHRINK:.0%}），確認無誤請加 --force"
+
+    sample_ids = random.sample(text_collection.get(include=[])["ids"], min(REBUILD_VALIDATE_SAMPLES, text_count))
+    sample = text_collection.get(ids=sample_ids, include=["embeddings"])
+    result = text_collection.query(query_embeddings=np.asarray(sample["embeddings"]), n_results=1, include=[])
+    self_recall = np.mean([hits[:1] == [chunk_id] for chunk_id, hits in zip(sample["ids"], result["ids"])])
+    print(f"[INFO] 抽樣 {len(sample_ids)} 筆自我檢索命中率 {self_recall:.1%}")
+    if self_recall < REBUILD_MIN_SELF_RECALL:
+        return False, f"自我檢索命中率 {self_recall:.1%} 低於 {REBUILD_MIN_SELF_RECALL:.0%}"
+    return True, None
+
+
+def generation_exists(client, generation):
+    names = {getattr(collection, "name", collection) for collection in client.list_collections()}
+    return versioned_name(TEXT_COLLECTION_NAME, generation) in names
+
+
+def drop_generation(client, generation):
+    """刪除某一世代的集合與去重索引；呼叫端需確認不是別名指向的世代"""
+    for base_name in (TEXT_COLLECTION_NAME, IMAGE_COLLECTION_NAME, SUMMARY_COLLECTION_NAME):
+        name = versioned_name(base_name, generation)
+        try:
+            client.delete_collection(name)
+            forget_summary_collection(name)
+            print(f"[INFO] 已刪除舊世代集合 '{name}'")
+        except Exception as e:
+            print(f"[WARN] 刪除集合 '{name}' 失敗：{e}")
+    remove_dedup_index(dedup_index_path(generation))
+
+
+def rebuild(ignore_image_processing=False, reembed=False, force=False):
+    """
+    藍綠重建：
+      1. 建立新的版本化集合，從 RAG_FILE_PATH 的 PDF 大批寫入；
+         內容未變的 chunk 沿用目前世代的向量與圖片描述
+      2. 補上重建期間被修改或刪除的 PDF
+      3. 驗證通過後原子性地切換別名；目前世代保留為回滾目標，更早的世代則刪除
+    線上查詢全程只讀目前世代，不受重建影響。
+    """
+    client = init_chroma_client()
+    old_generation = current_generation()
+    previous_generation = load_aliases()["previous"]
+    old_text, old_image = init_collections(client, old_generation)
+    # 目前世代的向量比新設定短（截斷得更小）時無法沿用，改為全部重新 Embedding
+    old_dim = collection_embedding_dim(old_text)
+    if not reembed and old_dim and (not EMBEDDING_DIM or EMBEDDING_DIM > old_dim):
+        print(f"[INFO] 目前世代截斷為 {old_dim} 維，新設定為 {EMBEDDING_DIM or '完整'} 維，將全部重新 Embedding")
+        reembed = True
+    generation = new_generation()
+    extra_metadata = {"hnsw:sync_threshold": REBUILD_SYNC_THRESHOLD} if REBUILD_SYNC_THRESHOLD > 0 else None
+    text_collection, image_collection = init_collections(client, generation, extra_metadata=extra_metadata)
+    batch_size = min(REBUILD_BATCH_SIZE, client.get_max_batch_size())
+    text_writer = BulkWriter(text_collection, batch_size)
+    image_writer = BulkWriter(image_collection, batch_size)
+    dedup = get_dedup_index(dedup_index_path(generation)) if DEDUP_ENABLED else None
+    print(f"[INFO] 開始重建世代 {generation}（目前 {old_generation or '(legacy)'}），每批 {batch_size} 筆")
+
+    started_at = time.time()
+    pdf_paths = sorted(glob.glob(os.path.join(RAG_FILE_PATH, "*.pdf")))
+    with profile_session("run", "rebuild"):
+        for pdf_path in pdf_paths:
+            try:
+                with profile_session("document", os.path.basename(pdf_path)):
+                    load_pdf(pdf_path, old_text, old_image, text_writer, image_writer, dedup, ignore_image_processing, reembed)
+            except Exception as e:
+                print(f"[ERROR] 重建時處理 {pdf_path} 失敗：{e}")
+        text_writer.flush()
+        image_writer.flush()
+    print(
+        f"[INFO] 大批寫入完成：{len(pdf_paths)} 個 PDF，{text_writer.written + image_writer.written} 筆，"
+        f"重新 Embedding {text_writer.embedded + image_writer.embedded} 筆，耗時 {time.time() - started_at:.1f}s"
+    )
+    image_payload.payload_stats.report()
+    image_payload.payload_stats.reset()
+    memory_budget.report()
+
+    if HIERARCHICAL_INDEX_ENABLED:
+        rebuild_all_summaries(text_collection)
+
+    # 重建期間線上匯入仍寫入目前世代，這裡把之後才修改或刪除的 PDF 補進新世代
+    changed = [p for p in glob.glob(os.path.join(RAG_FILE_PATH, "*.pdf")) if os.path.getmtime(p) >= started_at]
+    deleted = [p for p in pdf_paths if not os.path.exists(p)]
+    if changed or deleted:
+        print(f"[INFO] 補上重建期間的變更：修改/新增 {len(changed)}，刪除 {len(deleted)}")
+        sync_pdfs(text_collection, image_collection, changed, deleted, ignore_image_processing, dedup_path=dedup.path if dedup else None)
+
+    ok, reason = validate_generation(text_collection, image_collection, old_text, old_image, force)
+    if not ok:
+        print(f"[ERROR] 驗證未通過，不切換別名：{reason}")
+        drop_generation(client, generation)
+        return None
+
+    swap_alias(generation)
+    answer_cache.clear()
+    print(f"[INFO] 別名已切換到 {generation}，回滾請執行 python rebuild_index.py rollback")
+    if previous_generation is not None and previous_generation not in (old_generation, generation):
+        drop_generation(client, previous_generation)
+    return generation
+
+
+def rollback():
+    """切回上一個世代；回滾後原本的世代成為 previous，可再回滾回去"""
+    aliases = load_aliases()
+    previous = aliases["previous"]
+    if previous is None:
+        print("[ERROR] 沒有可回滾的世代")
+        return None
+    client = init_chroma_client()
+    if not generation_exists(client, previous):
+        print(f"[ERROR] 世代 {previous or '(legacy)'} 的集合已不存在，無法回滾")
+        return None
+    swap_alias(previous)
+    answer_cache.clear()
+    print(f"[INFO] 已回滾：{aliases['current'] or '(legacy)'} → {previous or '(legacy)'}")
+    return previous
+
+
+def status():
+    aliases = load_aliases()
+    client = init_chroma_client()
+    print(f"[INFO] 目前世代：{aliases['current'] or '(legacy)'}")
+    print(f"[INFO] 回滾目標：{'無' if aliases['previous'] is None else aliases['previous'] or '(legacy)'}")
+    for generation in [aliases["current"], aliases["previous"]]:
+        if generation is None or not generation_exists(client, generation):
+            continue
+        text_collection, image_collection = init_collections(client, generation)
+        print(f"[INFO]   {generation or '(legacy)'}：文字 {text_collection.count()} 筆、圖片 {image_collection.count()} 筆")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="向量集合藍綠重建 / 回滾")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    rebuild_parser = subparsers.add_parser("rebuild", help="重建到新世代，驗證通過後切換")
+    rebuild_parser.add_argument("--ignore-image-processing", action="store_true")
+    rebuild_parser.add_argument("--reembed", action="store_true", help="不沿用目前世代的向量，全部重新 Embedding")
+    rebuild_parser.add_argument("--force", action="store_true", help="略過筆數縮水檢查")
+    add_profile_arguments(rebuild_parser)
+    subparsers.add_parser("rollback", help="切回上一個世代")
+    subparsers.add_parser("status", help="顯示目前與回滾目標世代")
+    args = parser.parse_args()
+
+    if args.command == "rebuild":
+        configure_from_args(args)
+        rebuild(args.ignore_image_processing, args.reembed, args.force)
+    elif args.command == "rollback":
+        rollback()
+    else:
+        status()
@@ -0,0 +1,126 @@
+import os
+import re
+import json
+import time
+import uuid
+import threading
+from collections import OrderedDict
+
+# 檢索結果快取設定，可透過環境變數調整
+RETRIEVAL_CACHE_ENABLED = os.getenv("RETRIEVAL_CACHE_ENABLED", "true").lower() == "true"
+# 快取筆數上限，超過時淘汰最久未使用的項目
+RETRIEVAL_CACHE_MAX_ENTRIES = int(os.getenv("RETRIEVAL_CACHE_MAX_ENTRIES", "4096"))
+# 每個集合的世代標記檔目錄；獨立執行的 ingest_watcher / process_files / rebuild_index 寫入後，
+# 查詢服務讀到新的標記就會讓舊結果失效
+RETRIEVAL_GENERATION_DIR = os.getenv("RETRIEVAL_GENERATION_DIR", "./cache/generations")
+
+
+def make_key(collection_name, query_text, n_results, where=None, where_document=None, mode="flat", depends_on=()):
+    """depends_on 為結果也取決於的其他集合（例如階層式檢索的摘要集合），這些集合有寫入時結果同樣失效"""
+    filters = json.dumps(where, sort_keys=True, ensure_ascii=False) if where else ""
+    doc_filters = json.dumps(where_document, sort_keys=True, ensure_ascii=False) if where_document else ""
+    return (collection_name, query_text, n_results, filters, doc_filters, mode, tuple(depends_on))
+
+
+class RetrievalCache:
+    """
+    ChromaDB 查詢結果的 LRU 快取：
+      - key 為 (集合名稱, 查詢文字, n_results, 過濾條件, 模式, 相依集合)，以 OrderedDict 做 O(1) 查詢與淘汰
+      - 每筆快取記下寫入當時的集合世代（generation，含相依集合）；新增或刪除資料時寫入新的世代標記，
+        舊世代的結果在下次查到時視為過期並移除，不需要掃描整個快取
+      - 世代標記存於 RETRIEVAL_GENERATION_DIR 下每個集合一個檔案，寫入端在其他 process 時也能讓快取失效；
+        標記為隨機字串而非計數器，多個 process 同時寫入也不會寫回相同的值
+    回傳的結果與快取共用同一物件，呼叫端不應修改。
+    """
+
+    def __init__(self, max_entries=RETRIEVAL_CACHE_MAX_ENTRIES, generation_dir=RETRIEVAL_GENERATION_DIR):
+        self.max_entries = max_entries
+        self.generation_dir = generation_dir
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+
+    def _marker_path(self, collection_name):
+        return os.path.join(self.generation_dir, re.sub(r"[^\w.-]", "_", collection_name))
+
+    def generation(self, collection_name):
+        """目前的世代標記；集合從未寫入過時為空字串"""
+        try:
+            with open(self._marker_path(collection_name), "r", encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            return ""
+
+    def key_generation(self, key):
+        """快取項目對應的世代：查詢的集合加上 depends_on 各集合的世代標記"""
+        return tuple(self.generation(name) for name in (key[0],) + key[-1])
+
+    def bump(self, collection_name):
+        """集合內容變動時呼叫，讓該集合所有已快取的結果失效（包含其他 process 的快取）"""
+        os.makedirs(self.generation_dir, exist_ok=True)
+        path = self._marker_path(collection_name)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(f"{time.time_ns()}-{uuid.uuid4().hex}")
+        os.replace(tmp_path, path)
+
+    def get(self, key):
+        current = self.key_generation(key)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            generation, result = entry
+            if generation != current:
+                del self._entries[key]
+                self.stale += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return result
+
+    def put(self, key, result, generation):
+        """generation 為查詢送出前讀到的世代，查詢期間若有寫入，結果就不會被當成新資料"""
+        if generation != self.key_generation(key):
+            return
+        with self._lock:
+            self._entries[key] = (generation, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def report(self):
+        stats = self.stats()
+        if stats["hits"] + stats["misses"]:
+            print(
+                f"[INFO] 檢索快取：命中 {stats['hits']} 次、未命中 {stats['misses']} 次"
+                f"（命中率 {stats['hit_rate']:.1%}，過期 {stats['stale']}，淘汰 {stats['evictions']}，目前 {stats['entries']} 筆）"
+            )
+
+
+retrieval_cache = RetrievalCache()
+
+
+def bump_generation(collection):
+    retrieval_cache.bump(collection.name)
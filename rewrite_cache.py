@@ -0,0 +1,51 @@
+import os
+import hashlib
+from diskcache import Cache
+from answer_cache import normalize_question
+
+# 查詢改寫快取設定，可透過環境變數調整
+REWRITE_CACHE_ENABLED = os.getenv("REWRITE_CACHE_ENABLED", "true").lower() == "true"
+REWRITE_CACHE_DIR = os.getenv("REWRITE_CACHE_DIR", "./cache/rewrite")
+# 快取存活時間（秒），預設 7 天
+REWRITE_CACHE_TTL = int(os.getenv("REWRITE_CACHE_TTL", str(7 * 24 * 3600)))
+# 磁碟容量上限（bytes），超過時以 LRU 淘汰
+REWRITE_CACHE_SIZE_LIMIT = int(os.getenv("REWRITE_CACHE_SIZE_LIMIT", str(64 * 1024 * 1024)))
+
+_cache = None
+
+
+def get_cache():
+    """延遲建立 diskcache，使用 least-recently-used 淘汰策略"""
+    global _cache
+    if _cache is None:
+        os.makedirs(REWRITE_CACHE_DIR, exist_ok=True)
+        _cache = Cache(
+            REWRITE_CACHE_DIR,
+            eviction_policy="least-recently-used",
+            size_limit=REWRITE_CACHE_SIZE_LIMIT,
+        )
+    return _cache
+
+
+def prompt_version(system_prompt):
+    """以系統提示詞內容計算版本號，提示詞一改舊快取自然失效"""
+    return hashlib.sha256(system_prompt.encode("utf-8")).hexdigest()[:12]
+
+
+def make_key(question, version):
+    question_hash = hashlib.sha256(normalize_question(question).encode("utf-8")).hexdigest()
+    return f"{version}:{question_hash}"
+
+
+def get_rewrite(question, version):
+    """回傳快取的 (queries, keywords)，找不到或已過期時回傳 None"""
+    if not REWRITE_CACHE_ENABLED:
+        return None
+    return get_cache().get(make_key(question, version))
+
+
+def set_rewrite(question, version, queries, keywords):
+    """只快取成功的改寫結果，失敗（空清單）下次仍會重試"""
+    if not REWRITE_CACHE_ENABLED or not queries:
+        return
+    get_cache().set(make_key(question, version), (queries, keywords), expire=REWRITE_CACHE_TTL)
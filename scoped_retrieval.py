@@ -0,0 +1,214 @@
+import os
+import re
+import json
+import threading
+from collections import OrderedDict
+import numpy as np
+
+from retrieval_cache import retrieval_cache
+from dedup_index import reference_chunks
+
+# 限定文件範圍檢索設定，可透過環境變數調整
+# 限定文件的查詢是否改用文件子索引做精確搜尋（關閉時直接把 where 交給向量庫）
+SCOPED_EXACT_ENABLED = os.getenv("SCOPED_EXACT_ENABLED", "true").lower() == "true"
+# 範圍內 chunk 數超過此值就不建子索引，改回向量庫的過濾查詢
+SCOPED_EXACT_MAX_CHUNKS = int(os.getenv("SCOPED_EXACT_MAX_CHUNKS", "5000"))
+# 最多保留幾個文件範圍的子索引（LRU）
+SCOPED_INDEX_MAX_ENTRIES = int(os.getenv("SCOPED_INDEX_MAX_ENTRIES", "64"))
+
+RAG_FILE_PATH = os.getenv("RAG_FILE_PATH")
+
+
+def document_filter(file_name=None, file_type=None):
+    """
+    組成限定文件範圍的 where 條件；file_name / file_type 可為單一值或清單，
+    兩者都未指定時回傳 None（不限定範圍）。
+    """
+    clauses = []
+    for key, value in (("file_name", file_name), ("file_type", file_type)):
+        if not value:
+            continue
+        if isinstance(value, (list, tuple, set)):
+            values = sorted(set(value))
+            clauses.append({key: values[0]} if len(values) == 1 else {key: {"$in": values}})
+        else:
+            clauses.append({key: value})
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+
+def resolve_paper_files(paper_id, pdf_dir=RAG_FILE_PATH):
+    """QASPER 的 paper_id（例如 1910.03042）對應到 RAG_FILE_PATH 中的 PDF 檔名（可能帶 v1、v2 版本後綴）"""
+    if not paper_id or not pdf_dir or not os.path.isdir(pdf_dir):
+        return []
+    pattern = re.compile(rf"{re.escape(paper_id)}(v\d+)?\.pdf", re.IGNORECASE)
+    return sorted(name for name in os.listdir(pdf_dir) if pattern.fullmatch(name))
+
+
+def distances_for_space(vectors, queries, space):
+    """與 ChromaDB 相同定義的距離：l2 為平方歐氏距離，cosine / ip 為 1 - 相似度"""
+    if space == "cosine":
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        return 1.0 - queries @ vectors.T
+    if space == "ip":
+        return 1.0 - queries @ vectors.T
+    return np.sum(queries ** 2, axis=1, keepdims=True) - 2 * queries @ vectors.T + np.sum(vectors ** 2, axis=1)
+
+
+class DocumentIndex:
+    """單一文件範圍內所有 chunk 的向量矩陣，查詢成本為 O(範圍內 chunk 數)"""
+
+    def __init__(self, ids, documents, metadatas, embeddings, space):
+        self.ids = ids
+        self.documents = documents
+        self.metadatas = metadatas
+        self.vectors = np.asarray(embeddings, dtype=np.float32)
+        self.space = space
+
+    def search(self, query_embeddings, n_results, rows=None):
+        """回傳與 collection.query 相同格式的結果；rows 可限定只搜尋部分列（例如特定頁面的 chunk）"""
+        result = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        rows = np.arange(len(self.ids)) if rows is None else np.asarray(rows, dtype=np.int64)
+        if not len(rows):
+            for _ in range(len(queries)):
+                for key in result:
+                    result[key].append([])
+            return result
+        distances = distances_for_space(self.vectors[rows], queries, self.space)
+        k = min(n_results, len(rows))
+        for row in distances:
+            top = np.argpartition(row, k - 1)[:k] if k < len(row) else np.arange(len(row))
+            top = top[np.argsort(row[top])]
+            result["distances"].append([float(row[i]) for i in top])
+            # top 為 rows 中的位置，換回子索引中的列號
+            top = rows[top]
+            result["ids"].append([self.ids[i] for i in top])
+            result["documents"].append([self.documents[i] for i in top])
+            result["metadatas"].append([self.metadatas[i] for i in top])
+        return result
+
+
+class DocumentIndexCache:
+    """
+    依 (集合名稱, where 條件) 快取文件子索引（LRU）。
+    每個子索引記下建立時的集合世代，集合有寫入後（retrieval_cache 的世代改變）自動重建。
+    範圍內因近似重複只記為 back-reference 的 chunk 也一併加入（見 dedup_index.reference_chunks）。
+    範圍過大的條件記為 None，之後直接改回向量庫的過濾查詢。
+    """
+
+    def __init__(self, max_entries=SCOPED_INDEX_MAX_ENTRIES, max_chunks=SCOPED_EXACT_MAX_CHUNKS):
+        self.max_entries = max_entries
+        self.max_chunks = max_chunks
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.builds = 0
+        self.exact_queries = 0
+        self.fallback_queries = 0
+
+    def peek(self, collection, where):
+        """只取已建立且仍是目前世代的子索引，不在快取中時回傳 None（不會讀取向量庫建立）"""
+        key = (collection.name, json.dumps(where, sort_keys=True, ensure_ascii=False))
+        generation = retrieval_cache.generation(collection.name)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == generation:
+                self._entries.move_to_end(key)
+                return entry[1]
+        return None
+
+    def get(self, collection, where):
+        key = (collection.name, json.dumps(where, sort_keys=True, ensure_ascii=False))
+        generation = retrieval_cache.generation(collection.name)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == generation:
+                self._entries.move_to_end(key)
+                return entry[1]
+
+        # 多取一筆即可判斷是否超過上限，不必先另外計數
+        stored = collection.get(where=where, limit=self.max_chunks + 1,
+                                include=["documents", "metadatas", "embeddings"])
+        references = reference_chunks(collection, where)
+        if len(stored["ids"]) + len(references["ids"]) > self.max_chunks:
+            index = None
+        else:
+            embeddings = list(stored["embeddings"]) if len(stored["ids"]) else []
+            index = DocumentIndex(list(stored["ids"]) + references["ids"],
+                                  list(stored["documents"]) + references["documents"],
+                                  list(stored["metadatas"]) + references["metadatas"],
+                                  embeddings + references["embeddings"], collection_space(collection))
+        with self._lock:
+            self.builds += 1
+            self._entries[key] = (generation, index)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return index
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "builds": self.builds,
+            "exact_queries": self.exact_queries,
+            "fallback_queries": self.fallback_queries,
+        }
+
+    def report(self):
+        if self.exact_queries or self.fallback_queries:
+            print(
+                f"[INFO] 限定文件檢索：子索引精確搜尋 {self.exact_queries} 次、向量庫過濾查詢 {self.fallback_queries} 次，"
+                f"建立子索引 {self.builds} 次（目前 {len(self._entries)} 個）"
+            )
+
+
+document_indexes = DocumentIndexCache()
+
+
+def collection_space(collection):
+    """距離定義需與 collection.query 一致才能合併結果；NumPy 後端不看 hnsw:space，以 distance_space 標示"""
+    if getattr(collection, "distance_space", None):
+        return collection.distance_space
+    return (getattr(collection, "metadata", None) or {}).get("hnsw:space", "l2")
+
+
+def query_with_references(collection, query_embeddings, n_results, where):
+    """
+    交給向量庫做 where 過濾查詢，再合併範圍內只存在去重索引中的重複 chunk，
+    依距離取前 n_results 筆；回傳與 collection.query 相同格式的結果。
+    """
+    result = collection.query(query_embeddings=query_embeddings, n_results=n_results, where=where)
+    references = reference_chunks(collection, where)
+    if not references["ids"]:
+        return result
+    extra = DocumentIndex(references["ids"], references["documents"], references["metadatas"],
+                          references["embeddings"], collection_space(collection)).search(query_embeddings, n_results)
+    merged = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+    keys = ("distances", "ids", "documents", "metadatas")
+    for i in range(len(extra["ids"])):
+        candidates = [tuple(part[key][i][rank] for key in keys)
+                      for part in (result, extra) for rank in range(len(part["ids"][i]))]
+        candidates.sort(key=lambda item: item[0])
+        for position, key in enumerate(keys):
+            merged[key].append([c[position] for c in candidates[:n_results]])
+    return merged
+
+
+def search_collection(collection, query_embeddings, n_results, where=None):
+    """
+    以查詢向量搜尋集合：有 where 時優先使用文件子索引做精確搜尋，
+    避免在整個 HNSW 圖上做過濾後的 ANN 搜尋；本身即為精確搜尋的後端直接查詢。
+    有 where 時結果也包含範圍內的近似重複 chunk（向量庫中只存 canonical 一份）。
+    """
+    if not where:
+        return collection.query(query_embeddings=query_embeddings, n_results=n_results)
+    if not SCOPED_EXACT_ENABLED or getattr(collection, "exact_search", False):
+        return query_with_references(collection, query_embeddings, n_results, where)
+    index = document_indexes.get(collection, where)
+    if index is None:
+        document_indexes.fallback_queries += 1
+        return query_with_references(collection, query_embeddings, n_results, where)
+    document_indexes.exact_queries += 1
+    return index.search(query_embeddings, n_results)
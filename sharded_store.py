@@ -0,0 +1,304 @@
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+import concurrent.futures
+from collections import deque
+import numpy as np
+
+# 向量集合分片設定，可透過環境變數調整
+# 每個邏輯集合拆成幾個分片；1 表示不分片（維持單一集合）
+VECTOR_SHARDS = int(os.getenv("VECTOR_SHARDS", "1"))
+# 分片存放的持久化目錄（逗號分隔），第 i 個分片放在第 i % len 個目錄；未設定時使用預設目錄
+VECTOR_SHARD_PATHS = [p.strip() for p in os.getenv("VECTOR_SHARD_PATHS", "").split(",") if p.strip()]
+# 分片依據的 metadata 欄位，例如 file_name（預設）、file_type 或匯入時另外寫入的 tenant
+VECTOR_SHARD_KEY = os.getenv("VECTOR_SHARD_KEY", "file_name")
+# 指定 {欄位值: 分片編號} 的路由表（例如某個租戶固定放在某分片），未列出的值以 hash 分配
+VECTOR_SHARD_ROUTES_FILE = os.getenv("VECTOR_SHARD_ROUTES_FILE", "shard_routes.json")
+# 每個分片集合平行查詢用的執行緒數；0 表示與分片數相同
+VECTOR_SHARD_WORKERS = int(os.getenv("VECTOR_SHARD_WORKERS", "0"))
+# 每個分片保留最近幾次查詢延遲，用來計算 p50 / p95
+SHARD_LATENCY_WINDOW = 2000
+
+SHARD_SUFFIX_PATTERN = re.compile(r"__shard\d+$")
+# 查詢結果中每個查詢各自一個清單、需要依距離合併的欄位
+QUERY_RESULT_KEYS = ("ids", "distances", "documents", "metadatas", "embeddings", "uris", "data")
+
+
+def load_shard_routes(path=VECTOR_SHARD_ROUTES_FILE):
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return {str(key): int(value) for key, value in json.load(f).items()}
+
+
+def shard_name(name, index):
+    return f"{name}__shard{index}"
+
+
+def _slice_result(result, start, end):
+    return {
+        key: (value[start:end] if key != "included" and value is not None else value)
+        for key, value in result.items()
+    }
+
+
+def _concat_results(parts, include):
+    merged = {"ids": []}
+    for key in include:
+        merged[key] = []
+    for part in parts:
+        merged["ids"].extend(part["ids"])
+        for key in include:
+            if part.get(key) is not None:
+                merged[key].extend(list(part[key]))
+    return merged
+
+
+class ShardedCollection:
+    """
+    由多個實體集合組成的邏輯集合，介面與 ChromaDB Collection 相容（add / upsert / get / delete / query / count），
+    vector_db、rag_pipeline、去重索引等呼叫端不需修改：
+      - 寫入依 metadata 的 VECTOR_SHARD_KEY 欄位路由到固定分片（路由表優先，其次為穩定 hash）
+      - 查詢時先算一次查詢向量，再平行送到各分片，依距離合併 top-k
+      - where 條件限定分片欄位時只查對應分片；只給 id 的 get / delete 則送到所有分片
+    """
+
+    def __init__(self, name, shards, embedding_function=None, metadata=None, shard_key=VECTOR_SHARD_KEY, routes=None):
+        self.name = name
+        self.shards = shards
+        self.metadata = metadata
+        self.embedding_function = embedding_function
+        self.shard_key = shard_key
+        self.routes = load_shard_routes() if routes is None else routes
+        self.exact_search = all(getattr(shard, "exact_search", False) for shard in shards)
+        self._latencies = [deque(maxlen=SHARD_LATENCY_WINDOW) for _ in shards]
+        self._queries = [0] * len(shards)
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=VECTOR_SHARD_WORKERS or len(shards), thread_name_prefix="shard"
+        )
+
+    def route(self, metadata):
+        value = (metadata or {}).get(self.shard_key)
+        if str(value) in self.routes:
+            return self.routes[str(value)] % len(self.shards)
+        # 不可用 Python 內建 hash（每個 process 的種子不同），改用 md5 取穩定的分配
+        return int(hashlib.md5(str(value).encode("utf-8")).hexdigest(), 16) % len(self.shards)
+
+    def shards_for_where(self, where):
+        """where 條件限定分片欄位（等值或 $in）時回傳對應分片編號，否則回傳全部分片"""
+        all_shards = list(range(len(self.shards)))
+        if not where:
+            return all_shards
+        clauses = where["$and"] if "$and" in where else [where]
+        for clause in clauses:
+            if self.shard_key not in clause:
+                continue
+            condition = clause[self.shard_key]
+            if isinstance(condition, dict):
+                if "$eq" in condition:
+                    values = [condition["$eq"]]
+                elif "$in" in condition:
+                    values = condition["$in"]
+                else:
+                    return all_shards
+            else:
+                values = [condition]
+            return sorted({self.route({self.shard_key: value}) for value in values})
+        return all_shards
+
+    def _fanout(self, fn, shard_indexes):
+        """在各分片平行執行 fn(index, shard)，回傳與 shard_indexes 對應的結果"""
+        if len(shard_indexes) == 1:
+            index = shard_indexes[0]
+            return [fn(index, self.shards[index])]
+        futures = [self._executor.submit(fn, index, self.shards[index]) for index in shard_indexes]
+        return [future.result() for future in futures]
+
+    def _group_by_shard(self, ids, documents, metadatas, embeddings):
+        groups = {}
+        for position, metadata in enumerate(metadatas):
+            groups.setdefault(self.route(metadata), []).append(position)
+        for index, positions in groups.items():
+            yield index, {
+                "ids": [ids[p] for p in positions],
+                "documents": [documents[p] for p in positions] if documents is not None else None,
+                "metadatas": [metadatas[p] for p in positions],
+                "embeddings": [embeddings[p] for p in positions] if embeddings is not None else None,
+            }
+
+    def _write(self, method, ids, documents, metadatas, embeddings):
+        if metadatas is None:
+            raise ValueError(f"分片集合 '{self.name}' 寫入時需要 metadata（依 '{self.shard_key}' 路由）")
+        groups = dict(self._group_by_shard(ids, documents, metadatas, embeddings))
+        self._fanout(lambda index, shard: getattr(shard, method)(**groups[index]), sorted(groups))
+
+    def add(self, ids, documents=None, metadatas=None, embeddings=None):
+        self._write("add", ids, documents, metadatas, embeddings)
+
+    def upsert(self, ids, documents=None, metadatas=None, embeddings=None):
+        self._write("upsert", ids, documents, metadatas, embeddings)
+
+    def delete(self, ids=None, where=None):
+        targets = self.shards_for_where(where) if ids is None else list(range(len(self.shards)))
+        self._fanout(lambda index, shard: shard.delete(ids=ids, where=where), targets)
+
+    def count(self):
+        return sum(self._fanout(lambda index, shard: shard.count(), list(range(len(self.shards)))))
+
+    def get(self, ids=None, where=None, limit=None, offset=None, include=("documents", "metadatas")):
+        include = list(include)
+        targets = self.shards_for_where(where)
+        if limit is None and not offset:
+            parts = self._fanout(lambda index, shard: shard.get(ids=ids, where=where, include=include), targets)
+            return _concat_results(parts, include)
+
+        # 分頁：依分片順序跳過 offset 筆，再取 limit 筆
+        parts, skip, remaining = [], offset or 0, limit
+        for index in targets:
+            if remaining is not None and remaining <= 0:
+                break
+            shard = self.shards[index]
+            if ids is None and where is None:
+                size = shard.count()
+                if skip >= size:
+                    skip -= size
+                    continue
+                part = shard.get(limit=remaining, offset=skip, include=include)
+            else:
+                part = shard.get(ids=ids, where=where, include=include)
+                if skip >= len(part["ids"]):
+                    skip -= len(part["ids"])
+                    continue
+                part = _slice_result(part, skip, None if remaining is None else skip + remaining)
+            skip = 0
+            parts.append(part)
+            if remaining is not None:
+                remaining -= len(part["ids"])
+        return _concat_results(parts, include)
+
+    def query(self, query_texts=None, query_embeddings=None, n_results=10, where=None,
+              include=("documents", "metadatas", "distances"), **kwargs):
+        # 查詢向量只算一次，各分片共用
+        if query_embeddings is None:
+            query_embeddings = self.embedding_function(query_texts)
+        include = list(include)
+        shard_include = include if "distances" in include else include + ["distances"]
+
+        def query_shard(index, shard):
+            start = time.monotonic()
+            result = shard.query(query_embeddings=query_embeddings, n_results=n_results, where=where,
+                                 include=shard_include, **kwargs)
+            elapsed = time.monotonic() - start
+            with self._lock:
+                self._latencies[index].append(elapsed)
+                self._queries[index] += 1
+            return result
+
+        parts = self._fanout(query_shard, self.shards_for_where(where))
+        keys = [key for key in QUERY_RESULT_KEYS if any(part.get(key) is not None for part in parts)]
+        merged = {key: [] for key in keys}
+        for query_index in range(len(query_embeddings)):
+            candidates = []
+            for part in parts:
+                for rank, distance in enumerate(part["distances"][query_index]):
+                    candidates.append((distance, part, rank))
+            candidates.sort(key=lambda item: item[0])
+            top = candidates[:n_results]
+            for key in keys:
+                merged[key].append([part[key][query_index][rank] for _, part, rank in top])
+        merged["included"] = shard_include
+        return merged
+
+    def shard_stats(self):
+        """每個分片的筆數與查詢延遲"""
+        counts = self._fanout(lambda index, shard: shard.count(), list(range(len(self.shards))))
+        stats = []
+        with self._lock:
+            for index, shard in enumerate(self.shards):
+                latencies = np.asarray(self._latencies[index]) * 1000 if self._latencies[index] else np.zeros(1)
+                stats.append({
+                    "shard": shard.name,
+                    "count": counts[index],
+                    "queries": self._queries[index],
+                    "p50_ms": float(np.percentile(latencies, 50)),
+                    "p95_ms": float(np.percentile(latencies, 95)),
+                })
+        return stats
+
+    def report(self):
+        stats = self.shard_stats()
+        total = sum(s["count"] for s in stats)
+        print(f"[INFO] 分片集合 '{self.name}'：{len(stats)} 個分片，共 {total} 筆（依 {self.shard_key} 路由）")
+        for s in stats:
+            share = s["count"] / total if total else 0.0
+            print(
+                f"[INFO]   {s['shard']}：{s['count']} 筆（{share:.1%}），查詢 {s['queries']} 次，"
+                f"p50 {s['p50_ms']:.1f}ms / p95 {s['p95_ms']:.1f}ms"
+            )
+
+
+class ShardedClient:
+    """
+    與 chromadb.PersistentClient 相同用法的最小介面：每個邏輯集合對應 num_shards 個實體集合
+    （名稱加上 __shard{i}），第 i 個分片放在 clients[i % len(clients)]，可分散到多個持久化目錄。
+    """
+
+    def __init__(self, clients, num_shards=VECTOR_SHARDS, shard_key=VECTOR_SHARD_KEY):
+        self.clients = clients
+        self.num_shards = num_shards
+        self.shard_key = shard_key
+        self.routes = load_shard_routes()
+        # 同一邏輯集合重複取得時沿用同一物件（共用執行緒池與延遲統計）
+        self._collections = {}
+
+    def _client_for(self, index):
+        return self.clients[index % len(self.clients)]
+
+    def get_or_create_collection(self, name, metadata=None, embedding_function=None):
+        if name in self._collections:
+            return self._collections[name]
+        shards = []
+        for index in range(self.num_shards):
+            shard_metadata = {**(metadata or {}), "num_shards": self.num_shards, "shard_key": self.shard_key}
+            shard = self._client_for(index).get_or_create_collection(
+                name=shard_name(name, index), metadata=shard_metadata, embedding_function=embedding_function
+            )
+            existing = getattr(shard, "metadata", None) or {}
+            if existing.get("num_shards", self.num_shards) != self.num_shards or existing.get("shard_key", self.shard_key) != self.shard_key:
+                print(
+                    f"[WARNING] 集合 '{name}' 建立時為 {existing.get('num_shards')} 個分片、依 {existing.get('shard_key')} 路由，"
+                    f"與目前設定不同，既有資料的路由將不一致，請重建索引"
+                )
+            shards.append(shard)
+        # 以分片實際保存的 metadata 為準（既有集合的 hnsw:space、截斷維度等可能與這次傳入的不同）
+        stored_metadata = getattr(shards[0], "metadata", None) or metadata
+        self._collections[name] = ShardedCollection(name, shards, embedding_function, stored_metadata, self.shard_key, self.routes)
+        return self._collections[name]
+
+    def get_collection(self, name, embedding_function=None):
+        if name in self._collections:
+            return self._collections[name]
+        shards = [
+            self._client_for(index).get_collection(shard_name(name, index), embedding_function=embedding_function)
+            for index in range(self.num_shards)
+        ]
+        return ShardedCollection(name, shards, embedding_function, getattr(shards[0], "metadata", None), self.shard_key, self.routes)
+
+    def delete_collection(self, name):
+        self._collections.pop(name, None)
+        for index in range(self.num_shards):
+            self._client_for(index).delete_collection(shard_name(name, index))
+
+    def list_collections(self):
+        names = set()
+        for client in self.clients:
+            for collection in client.list_collections():
+                names.add(SHARD_SUFFIX_PATTERN.sub("", getattr(collection, "name", collection)))
+        return sorted(names)
+
+    def get_max_batch_size(self):
+        return min(client.get_max_batch_size() for client in self.clients)
@@ -0,0 +1,87 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import uvicorn
+import numpy as np
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+# 壓測用的模型 stub：模擬 Azure OpenAI chat completions 與 Ollama embed API
+# 使用方式：
+#   python stub_model_server.py
+#   ENDPOINT_URL=http://localhost:9000/ OLLAMA_BASE_URL=http://localhost:9000 ANSWER_CACHE_ENABLED=false python query_server.py
+#   python load_test.py --requests 200 --concurrency 16
+STUB_HOST = os.getenv("STUB_HOST", "127.0.0.1")
+STUB_PORT = int(os.getenv("STUB_PORT", "9000"))
+# 模擬延遲（秒）
+STUB_LLM_LATENCY = float(os.getenv("STUB_LLM_LATENCY", "0.8"))
+STUB_EMBED_LATENCY = float(os.getenv("STUB_EMBED_LATENCY", "0.02"))
+# mxbai-embed-large 的向量維度
+STUB_EMBED_DIM = int(os.getenv("STUB_EMBED_DIM", "1024"))
+
+app = FastAPI(title="Model Stub")
+
+STUB_ANSWER = "這是一段由 stub 模型產生的測試回答，用於壓力測試查詢服務的延遲與吞吐量。"
+
+
+def fake_embedding(text):
+    """以文字 hash 當作亂數種子，產生固定且已正規化的向量"""
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(STUB_EMBED_DIM).astype(np.float32)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+def completion_text(messages):
+    """查詢改寫的請求回傳固定 JSON，其餘回傳固定答案"""
+    system = " ".join(m.get("content", "") for m in messages if m.get("role") == "system" and isinstance(m.get("content"), str))
+    if '"queries"' in system:
+        return json.dumps({
+            "queries": ["stub 查詢一", "stub 查詢二", "stub 查詢三"],
+            "keywords": ["stub", "測試", "關鍵字"],
+        }, ensure_ascii=False)
+    return STUB_ANSWER
+
+
+@app.post("/api/embed")
+async def ollama_embed(request: Request):
+    body = await request.json()
+    inputs = body.get("input", [])
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    await asyncio.sleep(STUB_EMBED_LATENCY)
+    return {"model": body.get("model"), "embeddings": [fake_embedding(t) for t in inputs]}
+
+
+@app.post("/openai/deployments/{deployment}/chat/completions")
+async def chat_completions(deployment: str, request: Request):
+    body = await request.json()
+    text = completion_text(body.get("messages", []))
+    created = int(time.time())
+
+    if body.get("stream"):
+        async def event_stream():
+            # 第一個 token 前等待一半延遲，其餘平均分配到每個片段
+            await asyncio.sleep(STUB_LLM_LATENCY / 2)
+            pieces = [text[i:i + 8] for i in range(0, len(text), 8)]
+            for piece in pieces:
+                await asyncio.sleep(STUB_LLM_LATENCY / 2 / max(len(pieces), 1))
+                chunk = {
+                    "id": "stub", "object": "chat.completion.chunk", "created": created, "model": deployment,
+                    "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}],
+                }
+                yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+            yield "data: [DONE]\n\n"
+        return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+    await asyncio.sleep(STUB_LLM_LATENCY)
+    return {
+        "id": "stub", "object": "chat.completion", "created": created, "model": deployment,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+    }
+
+
+if __name__ == "__main__":
+    uvicorn.run(app, host=STUB_HOST, port=STUB_PORT)
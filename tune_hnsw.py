@@ -0,0 +1,202 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import itertools
+import tempfile
+import numpy as np
+import hnswlib  # chroma-hnswlib，ChromaDB 本身使用的 HNSW 實作
+
+from vector_db import (
+    init_chroma_client,
+    init_collections,
+    get_embedding_function,
+    collection_embedding_dim,
+    load_hnsw_config,
+    HNSW_CONFIG_FILE,
+    EXPORT_PAGE_SIZE,
+)
+from bench_vector_store import recall_at_k
+
+# 以 QASPER 抽樣問題為查詢，在目前已匯入的語料上掃描 HNSW 參數組合，
+# 以精確搜尋作為 ground truth，量測 recall@k、查詢延遲、建置時間與索引大小（直接量測 HNSW 索引，不含 ChromaDB 的 API 開銷），
+# 選出達到目標 recall 且延遲最低的組合寫入 HNSW_CONFIG_FILE（init_collections 建立新集合時套用）
+QASPER_SAMPLED_DIR = os.path.join("validation_Data", "working Data", "allenai-qasper", "sampled")
+DEFAULT_M = [8, 16, 32, 48]
+DEFAULT_CONSTRUCTION_EF = [100, 200, 400]
+DEFAULT_SEARCH_EF = [10, 25, 50, 100, 200]
+
+
+def load_questions():
+    questions = []
+    for question_type in ("extractive", "free_form", "yes_no"):
+        file_path = os.path.join(QASPER_SAMPLED_DIR, f"sampled_qasper_{question_type}.json")
+        with open(file_path, "r", encoding="utf-8") as f:
+            questions.extend(item["question"] for item in json.load(f))
+    # 去除重複問題，保持原本順序
+    return list(dict.fromkeys(questions))
+
+
+def load_corpus(collection, page_size=EXPORT_PAGE_SIZE):
+    """分頁讀出集合中所有 id 與向量"""
+    ids, vectors, offset = [], [], 0
+    while True:
+        data = collection.get(limit=page_size, offset=offset, include=["embeddings"])
+        if not data["ids"]:
+            break
+        ids.extend(data["ids"])
+        vectors.append(np.asarray(data["embeddings"], dtype=np.float32))
+        offset += len(data["ids"])
+    if not ids:
+        raise RuntimeError(f"集合 '{collection.name}' 沒有資料，請先匯入文件")
+    return ids, np.vstack(vectors)
+
+
+def exact_search(corpus, queries, k, space):
+    """依集合的距離函數做暴力搜尋，回傳每個查詢的前 k 筆列索引"""
+    if space == "cosine":
+        corpus = corpus / np.linalg.norm(corpus, axis=1, keepdims=True)
+        queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+        scores = queries @ corpus.T
+    elif space == "ip":
+        scores = queries @ corpus.T
+    else:
+        # l2：||q - x||^2 = ||q||^2 - 2 q·x + ||x||^2，排序時可省略 ||q||^2
+        scores = 2 * queries @ corpus.T - np.sum(corpus ** 2, axis=1)
+    top = np.argpartition(-scores, min(k, scores.shape[1] - 1), axis=1)[:, :k]
+    order = np.take_along_axis(scores, top, axis=1).argsort(axis=1)[:, ::-1]
+    return np.take_along_axis(top, order, axis=1)
+
+
+def build_index(work_dir, corpus, space, m, construction_ef):
+    """
+    以 ChromaDB 使用的 hnswlib（chroma-hnswlib）建立索引，回傳 (index, 建置秒數, 索引大小 MB)。
+    M 與 construction_ef 在建置時固定；search_ef 是查詢時參數，同一個索引可直接掃過所有 search_ef。
+    """
+    index = hnswlib.Index(space=space, dim=corpus.shape[1])
+    index.init_index(max_elements=len(corpus), ef_construction=construction_ef, M=m)
+    # 與 ChromaDB 預設的 hnsw:num_threads 相同，以所有 CPU 平行建置
+    index.set_num_threads(os.cpu_count() or 1)
+    start = time.monotonic()
+    index.add_items(corpus, np.arange(len(corpus)))
+    build_seconds = time.monotonic() - start
+    path = os.path.join(work_dir, f"M{m}_c{construction_ef}.bin")
+    index.save_index(path)
+    index_mb = os.path.getsize(path) / 1024 / 1024
+    os.remove(path)
+    return index, build_seconds, index_mb
+
+
+def evaluate_search_ef(index, ids, queries, truth_ids, k, search_ef):
+    """在既有索引上以指定 search_ef 逐筆查詢，回傳 recall 與延遲"""
+    index.set_ef(max(search_ef, k))
+    # 查詢一次一筆、單執行緒，與線上查詢的情境相同
+    index.set_num_threads(1)
+    latencies, results = [], []
+    for q in queries:
+        start = time.monotonic()
+        labels, _ = index.knn_query(q, k=k)
+        latencies.append(time.monotonic() - start)
+        results.append([ids[i] for i in labels[0]])
+    lat = np.asarray(latencies) * 1000
+    return {
+        "recall": recall_at_k(results, truth_ids),
+        "p50_ms": float(np.percentile(lat, 50)),
+        "p95_ms": float(np.percentile(lat, 95)),
+    }
+
+
+def choose_setting(rows, target_recall):
+    """達到目標 recall 的組合中取 p95 延遲最低者（同延遲時取索引較小者）；都未達標則取 recall 最高者"""
+    passing = [row for row in rows if row["recall"] >= target_recall]
+    if passing:
+        return min(passing, key=lambda row: (row["p95_ms"], row["index_mb"]))
+    print(f"[WARNING] 沒有任何組合達到目標 recall {target_recall}，改用 recall 最高的組合")
+    return max(rows, key=lambda row: (row["recall"], -row["p95_ms"]))
+
+
+def write_config(row, space, k, target_recall, corpus_size, query_count, rows, path=HNSW_CONFIG_FILE):
+    config = {
+        "params": {
+            "hnsw:space": space,
+            "hnsw:M": row["hnsw:M"],
+            "hnsw:construction_ef": row["hnsw:construction_ef"],
+            "hnsw:search_ef": row["hnsw:search_ef"],
+        },
+        "tuned_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "k": k,
+        "target_recall": target_recall,
+        "corpus_size": corpus_size,
+        "queries": query_count,
+        "selected": row,
+        "results": rows,
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(config, f, ensure_ascii=False, indent=4)
+    print(f"[INFO] 已寫入 HNSW 參數至 {path}：M={row['hnsw:M']}, construction_ef={row['hnsw:construction_ef']}, search_ef={row['hnsw:search_ef']}")
+
+
+def main(m_values, construction_efs, search_efs, k, target_recall, max_queries, write):
+    client = init_chroma_client()
+    text_collection, _ = init_collections(client)
+    space = (text_collection.metadata or {}).get("hnsw:space", "l2")
+    ids, corpus = load_corpus(text_collection)
+
+    questions = load_questions()[:max_queries]
+    # 查詢向量截斷到集合建立時的維度，與語料向量一致
+    queries = np.asarray(get_embedding_function(collection_embedding_dim(text_collection))(questions), dtype=np.float32)
+    print(f"[INFO] 語料 {len(ids)} 筆，維度 {corpus.shape[1]}，距離 {space}，查詢 {len(queries)} 筆，k={k}")
+
+    truth = exact_search(corpus, queries, k, space)
+    truth_ids = [[ids[i] for i in row] for row in truth]
+
+    current = load_hnsw_config()
+    if current:
+        print(f"[INFO] 目前設定：{current}")
+
+    rows = []
+    work_dir = tempfile.mkdtemp(prefix="tune_hnsw_")
+    print(f"{'M':>4}{'c_ef':>6}{'s_ef':>6}{'recall@k':>10}{'p50(ms)':>10}{'p95(ms)':>10}{'build(s)':>10}{'index(MB)':>11}")
+    try:
+        # 每組 (M, construction_ef) 只建一次索引，再掃過所有 search_ef，延遲比較不受建置差異影響
+        for m, construction_ef in itertools.product(m_values, construction_efs):
+            index, build_seconds, index_mb = build_index(work_dir, corpus, space, m, construction_ef)
+            for search_ef in search_efs:
+                row = {
+                    "hnsw:M": m,
+                    "hnsw:construction_ef": construction_ef,
+                    "hnsw:search_ef": search_ef,
+                    **evaluate_search_ef(index, ids, queries, truth_ids, k, search_ef),
+                    "build_s": build_seconds,
+                    "index_mb": index_mb,
+                }
+                rows.append(row)
+                print(
+                    f"{m:>4}{construction_ef:>6}{search_ef:>6}{row['recall']:>10.4f}{row['p50_ms']:>10.2f}"
+                    f"{row['p95_ms']:>10.2f}{row['build_s']:>10.2f}{row['index_mb']:>11.1f}"
+                )
+            del index
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    best = choose_setting(rows, target_recall)
+    print(f"[INFO] 選定組合：M={best['hnsw:M']}, construction_ef={best['hnsw:construction_ef']}, "
+          f"search_ef={best['hnsw:search_ef']}（recall@{k}={best['recall']:.4f}, p95={best['p95_ms']:.2f}ms）")
+    if write:
+        write_config(best, space, k, target_recall, len(ids), len(queries), rows)
+        # HNSW 參數在集合建立時固定，既有集合需重建（例如匯出快照後刪除集合再匯入）才會套用
+        print("[INFO] 新參數只會套用在新建立的集合；既有集合請重建後生效")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="以 QASPER 問題自動調整 ChromaDB HNSW 參數")
+    parser.add_argument("--m", type=int, nargs="+", default=DEFAULT_M)
+    parser.add_argument("--construction-ef", type=int, nargs="+", default=DEFAULT_CONSTRUCTION_EF)
+    parser.add_argument("--search-ef", type=int, nargs="+", default=DEFAULT_SEARCH_EF)
+    parser.add_argument("--k", type=int, default=4, help="recall@k 的 k（main.py 取 4 筆上下文）")
+    parser.add_argument("--target-recall", type=float, default=0.95)
+    parser.add_argument("--max-queries", type=int, default=500)
+    parser.add_argument("--dry-run", action="store_true", help="只輸出結果，不寫入設定檔")
+    args = parser.parse_args()
+    main(args.m, args.construction_ef, args.search_ef, args.k, args.target_recall, args.max_queries, not args.dry_run)
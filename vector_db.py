@@ -1,86 +1,331 @@
 from langchain_ollama import OllamaEmbeddings
 import os
+import csv
 import json
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import numpy as np
 import chromadb
+from numpy_store import NumpyClient
+from sharded_store import ShardedClient, VECTOR_SHARDS, VECTOR_SHARD_PATHS
+from retrieval_cache import bump_generation
+from collection_alias import current_generation, versioned_name
 import re
+import time
+import queue
+import threading
+from concurrent.futures import Future
 
 # 從環境變數取得檔案路徑
 RAG_FILE_PATH = os.getenv('RAG_FILE_PATH')
+# Ollama 服務位址（壓測時可指向 stub 服務）
+OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
+EMBEDDING_MODEL = "mxbai-embed-large"
+# 向量表示方式（只在建立新集合時生效，變更後請以 rebuild_index.py 重建）：
+# 截斷維度（mxbai-embed-large 支援 Matryoshka 截斷，只保留前 N 維再正規化；0 表示保留完整 1024 維）
+EMBEDDING_DIM = int(os.getenv("EMBEDDING_DIM", "0"))
+# 量化方式：none 或 binary（每維 1 bit 做 Hamming 第一階段搜尋，再以 float32 向量重新計分；需 VECTOR_BACKEND=numpy）
+EMBEDDING_QUANTIZATION = os.getenv("EMBEDDING_QUANTIZATION", "none").lower()
+EMBEDDING_DIM_KEY = "embedding:dim"
+# 向量庫後端：chroma（預設，HNSW）或 numpy（memmap 精確搜尋，見 numpy_store.py）
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "chroma").lower()
+# 集合名稱
+TEXT_COLLECTION_NAME = "rag_text_collection"
+IMAGE_COLLECTION_NAME = "rag_image_collection"
+# 查詢向量的微批次設定：在時間窗內或達到批次上限時合併成一次 embed_documents 呼叫
+EMBED_BATCHING_ENABLED = os.getenv("EMBED_BATCHING_ENABLED", "true").lower() == "true"
+EMBED_BATCH_WINDOW_MS = float(os.getenv("EMBED_BATCH_WINDOW_MS", "5"))
+EMBED_BATCH_MAX_SIZE = int(os.getenv("EMBED_BATCH_MAX_SIZE", "64"))
+# 分頁匯出設定：每頁筆數，以及 Excel 樣本的筆數上限
+EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", "1000"))
+EXCEL_SAMPLE_LIMIT = int(os.getenv("EXCEL_SAMPLE_LIMIT", "5000"))
+EXPORT_COLUMNS = ["ID", "Content", "Metadata"]
+# HNSW 參數設定檔（由 tune_hnsw.py 產生），只在建立新集合時生效
+HNSW_CONFIG_FILE = os.getenv("HNSW_CONFIG_FILE", "hnsw_config.json")
+HNSW_PARAM_KEYS = ("hnsw:space", "hnsw:M", "hnsw:construction_ef", "hnsw:search_ef")
 
 class ChromaDBEmbeddingFunction:
-    """讓 ChromaDB 使用 Ollama 進行嵌入"""
-    def __init__(self, langchain_embeddings):
+    """讓 ChromaDB 使用 Ollama 進行嵌入；dim 為截斷維度（0 表示完整維度）"""
+    def __init__(self, langchain_embeddings, dim=EMBEDDING_DIM):
         self.langchain_embeddings = langchain_embeddings
+        self.dim = dim
 
     def __call__(self, input):
         if isinstance(input, str):
             input = [input]
-        return self.langchain_embeddings.embed_documents(input)
+        return truncate_embeddings(self.langchain_embeddings.embed_documents(input), self.dim)
 
 
+def truncate_embeddings(vectors, dim=EMBEDDING_DIM):
+    """Matryoshka 截斷：只保留前 dim 維並重新正規化；dim 為 0 或向量本身不超過 dim 時原樣回傳"""
+    if not dim or len(vectors) == 0 or len(vectors[0]) <= dim:
+        return vectors
+    truncated = np.asarray(vectors, dtype=np.float32)[:, :dim]
+    norms = np.linalg.norm(truncated, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (truncated / norms).tolist()
+
+
+class EmbeddingBatcher:
+    """
+    跨請求合併查詢向量的計算：
+    各執行緒送出的文字先進入佇列，背景執行緒在 window_ms 內（或累積到 max_batch_size）
+    收集後一次呼叫 embed_documents，再把結果分送回各自等待的 Future。
+    """
+    def __init__(self, embed_documents, max_batch_size=EMBED_BATCH_MAX_SIZE, window_ms=EMBED_BATCH_WINDOW_MS):
+        self.embed_documents = embed_documents
+        self.max_batch_size = max_batch_size
+        self.window = window_ms / 1000
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.texts = 0
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                self._thread.start()
+
+    def submit(self, texts):
+        """送出多段文字，回傳對應的 Future 清單"""
+        self._ensure_started()
+        futures = []
+        for text in texts:
+            future = Future()
+            self._queue.put((text, future))
+            futures.append(future)
+        return futures
+
+    def embed(self, text):
+        return self.submit([text])[0].result()
+
+    def embed_many(self, texts):
+        return [future.result() for future in self.submit(texts)]
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            # 同一批次內相同的文字只計算一次
+            unique_texts = list(dict.fromkeys(text for text, _ in batch))
+            try:
+                vectors = dict(zip(unique_texts, self.embed_documents(unique_texts)))
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            self.texts += len(batch)
+            for text, future in batch:
+                future.set_result(vectors[text])
+
+    def report(self):
+        if self.batches:
+            print(f"[INFO] 查詢向量微批次：{self.texts} 筆文字合併為 {self.batches} 次呼叫（平均 {self.texts / self.batches:.1f} 筆/批）")
+
+
+_query_batcher = None
+_query_batcher_lock = threading.Lock()
+
+
+def get_query_batcher():
+    """全域共用的查詢向量批次器（與集合使用相同的 Embedding 模型）"""
+    global _query_batcher
+    with _query_batcher_lock:
+        if _query_batcher is None:
+            # 批次器一律計算完整維度，再由 embed_queries 依各集合的截斷維度截斷
+            _query_batcher = EmbeddingBatcher(get_embedding_function(dim=0))
+    return _query_batcher
+
+
+def embed_queries(query_texts, dim=EMBEDDING_DIM):
+    """
+    取得查詢向量，啟用微批次時與其他同時進行的查詢合併計算。
+    dim 應為要查詢的集合的截斷維度（collection_embedding_dim），查詢向量才會與集合內向量一致。
+    """
+    if EMBED_BATCHING_ENABLED:
+        return truncate_embeddings(get_query_batcher().embed_many(query_texts), dim)
+    return get_embedding_function(dim)(query_texts)
+
+
+# Excel 不接受的控制字元（Unicode U+0000 到 U+001F 與 U+007F）
+ILLEGAL_CHARS_PATTERN = r"[\x00-\x1F\x7F]"
+
 # 清理 Excel 不接受的控制字元
 def clean_illegal_chars(val):
     if isinstance(val, str):
         # 移除非法控制字元（Unicode U+0000 到 U+001F 與 U+007F）
-        return re.sub(r"[\x00-\x1F\x7F]", "", val)
+        return re.sub(ILLEGAL_CHARS_PATTERN, "", val)
     return val
 
 
-def get_embedding_function():
-    Embedding_model = "mxbai-embed-large"
+def get_embedding_function(dim=EMBEDDING_DIM):
     return ChromaDBEmbeddingFunction(
         OllamaEmbeddings(
-            model=Embedding_model,
-            base_url="http://localhost:11434"
-        )
+            model=EMBEDDING_MODEL,
+            base_url=OLLAMA_BASE_URL
+        ),
+        dim=dim,
     )
 
 
-def init_chroma_client():
-    chroma_db_path = os.path.join(os.getcwd(), "chroma_db")
+def init_base_client(path=None):
+    # VECTOR_BACKEND=numpy 時改用 memory-mapped 的精確搜尋後端，集合介面與 ChromaDB 相同
+    if VECTOR_BACKEND == "numpy":
+        # binary 量化時以 bit 矩陣做第一階段搜尋，完整精度向量另存於磁碟供重新計分
+        kwargs = {"dtype": "binary"} if EMBEDDING_QUANTIZATION == "binary" else {}
+        return NumpyClient(path, **kwargs) if path else NumpyClient(**kwargs)
+    if EMBEDDING_QUANTIZATION == "binary":
+        print("[WARN] EMBEDDING_QUANTIZATION=binary 需要 VECTOR_BACKEND=numpy，ChromaDB 後端仍使用 float 向量")
+    chroma_db_path = path or os.path.join(os.getcwd(), "chroma_db")
     os.makedirs(chroma_db_path, exist_ok=True)
     client = chromadb.PersistentClient(path=chroma_db_path)
     return client
 
-def init_collections(client):
+def init_chroma_client():
+    # VECTOR_SHARDS > 1 時每個集合拆成多個分片，可分散到 VECTOR_SHARD_PATHS 的多個持久化目錄
+    if VECTOR_SHARDS > 1:
+        return ShardedClient([init_base_client(path) for path in VECTOR_SHARD_PATHS or [None]])
+    return init_base_client()
+
+def load_hnsw_config(path=HNSW_CONFIG_FILE):
+    """讀取 tune_hnsw.py 輸出的 HNSW 參數，只保留 ChromaDB 認得的 hnsw:* 欄位"""
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        config = json.load(f)
+    return {key: value for key, value in config.get("params", {}).items() if key in HNSW_PARAM_KEYS}
+
+
+def init_collections(client, generation=None, extra_metadata=None):
+    """
+    取得文字、圖片兩個集合。generation 未指定時使用別名檔中目前服務的世代（見 collection_alias.py）；
+    extra_metadata 只在建立新集合時生效（例如重建時調大 hnsw:sync_threshold）。
+    """
+    if generation is None:
+        generation = current_generation()
     embedding = get_embedding_function()
+    hnsw_params = load_hnsw_config()
+    # 記下建立時的截斷維度，之後設定不同時提醒重建（查詢向量與集合內向量維度必須一致）
+    representation = {EMBEDDING_DIM_KEY: EMBEDDING_DIM}
     text_collection = client.get_or_create_collection(
-        name="rag_text_collection",
-        metadata={"description": "PDF 文字內容向量資料庫", "hnsw:sync_threshold": 20000},
+        name=versioned_name(TEXT_COLLECTION_NAME, generation),
+        metadata={"description": "PDF 文字內容向量資料庫", "hnsw:sync_threshold": 20000, **hnsw_params, **representation, **(extra_metadata or {})},
         embedding_function=embedding
     )
     image_collection = client.get_or_create_collection(
-        name="rag_image_collection",
-        metadata={"description": "PDF 圖片描述向量資料庫", "hnsw:sync_threshold": 20000},
+        name=versioned_name(IMAGE_COLLECTION_NAME, generation),
+        metadata={"description": "PDF 圖片描述向量資料庫", "hnsw:sync_threshold": 20000, **hnsw_params, **representation, **(extra_metadata or {})},
         embedding_function=embedding
     )
-    return text_collection, image_collection
+    collections = []
+    for collection in (text_collection, image_collection):
+        stored_dim = collection_embedding_dim(collection)
+        if stored_dim != EMBEDDING_DIM:
+            # 模型輸出完整維度，截斷到集合建立時的維度即可繼續寫入；查詢端由 embed_queries 依集合維度截斷
+            print(
+                f"[WARN] 集合 '{collection.name}' 的截斷維度為 {stored_dim or '完整'}，與 EMBEDDING_DIM={EMBEDDING_DIM or '完整'} 不同；"
+                f"重建前文件與查詢向量沿用集合的維度，請執行 python rebuild_index.py rebuild 套用新設定"
+            )
+            collection = client.get_collection(name=collection.name, embedding_function=get_embedding_function(stored_dim))
+        collections.append(collection)
+    return tuple(collections)
+
+
+def collection_embedding_dim(collection):
+    """集合建立時的截斷維度；0 表示完整維度（包含加入此設定前建立的集合）"""
+    return int((getattr(collection, "metadata", None) or {}).get(EMBEDDING_DIM_KEY, 0))
 
 def check_collection_data(collection):
     collection_name = collection.name
-    existing_data = collection.get()
-    num_records = len(existing_data["ids"]) if "ids" in existing_data else 0
+    # count() 只讀取筆數，不載入任何文件或 metadata
+    num_records = collection.count()
     if num_records > 0:
         print(f"[INFO] 向量資料庫 '{collection_name}' 已存在 {num_records} 筆資料")
     else:
         print(f"[INFO] 向量資料庫 '{collection_name}' 為空")
+    return num_records
+
+def iter_collection_data(collection, page_size=EXPORT_PAGE_SIZE, limit=None):
+    """
+    以 limit/offset 分頁讀取集合，每次 yield 一頁的 [(id, document, metadata_json), ...]，
+    記憶體用量只與 page_size 有關。limit 可限制總筆數（例如只取樣本）。
+    """
+    offset = 0
+    while limit is None or offset < limit:
+        size = page_size if limit is None else min(page_size, limit - offset)
+        data = collection.get(limit=size, offset=offset, include=["documents", "metadatas"])
+        ids = data.get("ids", [])
+        if not ids:
+            break
+        documents = data.get("documents") or [None] * len(ids)
+        metadatas = [json.dumps(meta, ensure_ascii=False) for meta in (data.get("metadatas") or [{}] * len(ids))]
+        yield list(zip(ids, documents, metadatas))
+        offset += len(ids)
+        if len(ids) < size:
+            break
 
-def fetch_collection_data(collection):
-    data = collection.get()
-    ids = data.get("ids", [])
-    documents = data.get("documents", [])
-    metadatas = data.get("metadatas", [])
-    # 將 metadatas 轉為 JSON 字串
-    metadatas = [json.dumps(meta, ensure_ascii=False) for meta in metadatas]
-    return list(zip(ids, documents, metadatas))
+def fetch_collection_data(collection, limit=EXCEL_SAMPLE_LIMIT):
+    """讀取集合前 limit 筆資料（預設只取 Excel 用的樣本），limit=None 時讀取全部"""
+    rows = []
+    for page in iter_collection_data(collection, limit=limit):
+        rows.extend(page)
+    return rows
+
+def export_collection(collection, output_file, page_size=EXPORT_PAGE_SIZE):
+    """
+    依副檔名串流匯出整個集合（.csv / .jsonl / .parquet），邊讀邊寫，記憶體固定。
+    回傳匯出筆數。
+    """
+    ext = os.path.splitext(output_file)[1].lower()
+    pages = iter_collection_data(collection, page_size=page_size)
+    total = 0
+
+    if ext == ".csv":
+        with open(output_file, "w", encoding="utf-8-sig", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(EXPORT_COLUMNS)
+            for page in pages:
+                writer.writerows(page)
+                total += len(page)
+    elif ext == ".jsonl":
+        with open(output_file, "w", encoding="utf-8") as f:
+            for page in pages:
+                for doc_id, document, metadata in page:
+                    f.write(json.dumps({"ID": doc_id, "Content": document, "Metadata": metadata}, ensure_ascii=False) + "\n")
+                total += len(page)
+    elif ext == ".parquet":
+        schema = pa.schema([(name, pa.string()) for name in EXPORT_COLUMNS])
+        with pq.ParquetWriter(output_file, schema) as writer:
+            for page in pages:
+                columns = list(zip(*page))
+                writer.write_table(pa.Table.from_arrays([pa.array(col, pa.string()) for col in columns], schema=schema))
+                total += len(page)
+    else:
+        raise ValueError(f"不支援的匯出格式：{ext}（請使用 .csv / .jsonl / .parquet）")
+
+    print(f"[INFO] '{collection.name}' 共 {total} 筆資料已串流匯出至 {output_file}")
+    return total
 
 def save_to_excel(text_data, image_data, output_file="vector_database.xlsx"):
-    text_df = pd.DataFrame(text_data, columns=["ID", "Content", "Metadata"])
-    image_df = pd.DataFrame(image_data, columns=["ID", "Content", "Metadata"])
-    # 對整個 DataFrame 的每個 cell 清除非法字元
-    text_df = text_df.applymap(clean_illegal_chars)
-    image_df = image_df.applymap(clean_illegal_chars)
+    """xlsx 需整份載入記憶體，只適合小量樣本；完整匯出請改用 export_collection"""
+    text_df = pd.DataFrame(text_data, columns=EXPORT_COLUMNS)
+    image_df = pd.DataFrame(image_data, columns=EXPORT_COLUMNS)
+    # 以向量化的 regex 取代逐格 applymap，清除 Excel 不接受的控制字元
+    text_df = text_df.replace(ILLEGAL_CHARS_PATTERN, "", regex=True)
+    image_df = image_df.replace(ILLEGAL_CHARS_PATTERN, "", regex=True)
     with pd.ExcelWriter(output_file, engine="openpyxl") as writer:
         text_df.to_excel(writer, sheet_name="Text Data", index=False)
         image_df.to_excel(writer, sheet_name="Image Data", index=False)
@@ -89,21 +334,38 @@ def save_to_excel(text_data, image_data, output_file="vector_database.xlsx"):
 def add_documents_to_collection(collection, documents, ids, metadatas=None):
     print(f"[INFO] 正在新增 {len(documents)} 筆資料到 '{collection.name}'")
     collection.add(documents=documents, ids=ids, metadatas=metadatas)
+    # 寫入完成後才遞增世代，避免查詢在寫入前取得新世代而快取到舊結果
+    bump_generation(collection)
     print(f"[INFO] 新增成功！")
 
+def upsert_documents_to_collection(collection, documents, ids, metadatas=None):
+    """以 upsert 寫入：id 已存在就覆蓋，重跑同一批不會因重複 id 失敗"""
+    print(f"[INFO] 正在寫入 {len(documents)} 筆資料到 '{collection.name}'")
+    collection.upsert(documents=documents, ids=ids, metadatas=metadatas)
+    bump_generation(collection)
+    print(f"[INFO] 寫入成功！")
+
+def get_file_chunk_ids(collection, file_name):
+    """取得某個來源檔案目前在集合中的所有 id（只查 id，不讀文件與向量）"""
+    return set(collection.get(where={"file_name": file_name}, include=[])["ids"])
+
+def delete_ids_from_collection(collection, ids):
+    if not ids:
+        return
+    collection.delete(ids=list(ids))
+    bump_generation(collection)
+    print(f"[INFO] 從 '{collection.name}' 刪除 {len(ids)} 筆資料")
+
 def delete_documents_from_collection(collection, deleted_files):
     if not deleted_files:
         return
     for pdf_path in deleted_files:
         file_name = os.path.basename(pdf_path)
-        results = collection.get()
-        if "ids" in results and "metadatas" in results:
-            ids_to_delete = [
-                doc_id for doc_id, metadata in zip(results["ids"], results["metadatas"])
-                if metadata.get("file_name") == file_name
-            ]
-            if ids_to_delete:
-                collection.delete(ids=ids_to_delete)
-                print(f"[INFO] 從 '{collection.name}' 刪除 {len(ids_to_delete)} 筆資料 (來源: {file_name})")
-            else:
-                print(f"[INFO] '{file_name}' 在 '{collection.name}' 中無對應資料")
+        # 以 metadata 過濾只取該檔案的 id，不必把整個集合讀出來比對
+        ids_to_delete = get_file_chunk_ids(collection, file_name)
+        if ids_to_delete:
+            collection.delete(ids=list(ids_to_delete))
+            bump_generation(collection)
+            print(f"[INFO] 從 '{collection.name}' 刪除 {len(ids_to_delete)} 筆資料 (來源: {file_name})")
+        else:
+            print(f"[INFO] '{file_name}' 在 '{collection.name}' 中無對應資料")